@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+
+# --------------------------------------------------------------------------------------
+# Benchmarks for process_files.py
+#
+# Usage:
+#   benchmark.py startup [-n runs] [path] -- compare a headless (--no-viz) run against
+#                                            a full run with the visualisations
+#   benchmark.py suite [--sizes 1k,10k,100k,1m] [-o results.json]
+#                                         -- time each stage of the pipeline against
+#                                            synthetic boards, results go to JSON
+#   benchmark.py compare old.json new.json
+#                                         -- compare two sets of suite results
+#   benchmark.py generate <dir> <parts>   -- just write a synthetic board
+#
+# Startup runs are a fresh interpreter so that import costs are included, and the
+# browser is suppressed for the full runs so they can be timed unattended.
+# --------------------------------------------------------------------------------------
+
+import argparse                             # command line options
+import csv                                  # synthetic board files
+import importlib                            # timing imports
+import json                                 # results files
+import math                                 # synthetic outlines
+import os, sys                              # path manipulation
+import platform                             # recorded with the results
+import random                               # synthetic boards
+import shutil                               # copying rotations.cf
+import statistics                           # summarising timings
+import subprocess                           # running process_files.py
+import tempfile                             # scratch output directory
+import time                                 # timing
+import zlib                                 # stable LCSC numbers
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, "process_files.py")
+
+# --------------------------------------------------------------------------------------
+# STARTUP BENCHMARK
+# --------------------------------------------------------------------------------------
+
+def time_run(args, cwd, env):
+    """
+    Run process_files.py once with the given arguments and return the wall-clock
+    time in seconds.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, SCRIPT] + args, cwd=cwd, env=env, check=True,
+                    stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def bench_startup(path, runs):
+    """
+    Time headless and full runs against the given input directory and print
+    a summary of the two.
+    """
+    # "true" as the browser means show() writes the HTML but nothing is opened
+    env = dict(os.environ, BROWSER="true")
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shutil.copy(os.path.join(HERE, "rotations.cf"), tmpdir)
+        for name, args in [ ("headless", ["--no-viz", path]), ("full", [path]) ]:
+            time_run(args, tmpdir, env)                 # warm the OS file cache
+            results[name] = [ time_run(args, tmpdir, env) for i in range(runs) ]
+
+    for name, times in results.items():
+        print("%-10s median %7.3fs  min %7.3fs  (%d runs)" %
+                (name, statistics.median(times), min(times), runs))
+
+    saving = statistics.median(results["full"]) - statistics.median(results["headless"])
+    print("headless saves %.3fs per run" % saving)
+    return results
+
+# --------------------------------------------------------------------------------------
+# SYNTHETIC BOARDS
+# --------------------------------------------------------------------------------------
+
+#
+# Reference prefixes (with their share of the parts) and the footprints, values and
+# courtyard sizes (mm) used for them. The footprints are a mix of ones that match a
+# rule in rotations.cf and ones that don't.
+#
+SYNTHETIC_PARTS = [
+    ("R",  0.34, [ ("R_0402_1005Metric", 1.9, 1.0), ("R_0603_1608Metric", 2.9, 1.5) ],
+                 [ "10k", "4k7", "100R", "1M", "22", "49.9", "5.1k" ]),
+    ("C",  0.34, [ ("C_0402_1005Metric", 1.9, 1.0), ("C_0805_2012Metric", 3.4, 2.0),
+                   ("CP_Elec_6.3x5.4", 7.0, 7.0) ],
+                 [ "100nF", "0.1uF", "1uF", "10u", "22pF", "4.7n" ]),
+    ("U",  0.08, [ ("SOIC-8_3.9x4.9mm_P1.27mm", 7.0, 5.0), ("QFN-32-1EP_5x5mm_P0.5mm", 6.0, 6.0),
+                   ("LQFP-48_7x7mm_P0.5mm", 10.0, 10.0), ("TSSOP-20_4.4x6.5mm_P0.65mm", 7.5, 7.0),
+                   ("ESP32-WROOM-32", 19.0, 26.0) ],
+                 [ "STM32F103", "LM358", "ATtiny1616", "RP2040", "ESP32" ]),
+    ("D",  0.05, [ ("D_SOD-323", 3.3, 1.7), ("LED_0603_1608Metric", 3.0, 1.5), ("D_SOT-23", 3.7, 3.5) ],
+                 [ "1N4148", "BLUE", "5V6", "B5819W" ]),
+    ("Q",  0.05, [ ("SOT-23", 3.9, 3.5), ("SOT-223-3_TabPin2", 8.5, 7.5) ],
+                 [ "AO3400", "MMBT3904", "AS2324" ]),
+    ("FB", 0.02, [ ("R_0603_1608Metric", 2.9, 1.5) ], [ "600R @ 100MHz", "FerriteBead" ]),
+    ("L",  0.03, [ ("L_0805_2012Metric", 3.4, 2.0), ("L_Bourns_SRR1260", 13.0, 13.0) ],
+                 [ "10uH", "2.2uH" ]),
+    ("J",  0.03, [ ("USB_Micro-B_Molex-105017-0001", 8.5, 6.0), ("PinHeader_1x04_P2.54mm_Vertical", 3.0, 10.6) ],
+                 [ "USB", "Conn_01x04" ]),
+    ("Y",  0.01, [ ("Crystal_SMD_3225-4Pin_3.2x2.5mm", 4.2, 3.5) ], [ "12MHz", "32.768kHz" ]),
+    ("SW", 0.01, [ ("SW_SPST_PTS810", 5.2, 4.2) ], [ "SW_Push" ]),
+    ("TP", 0.04, [ ("TestPoint_Pad_D1.0mm", 1.5, 1.5) ], [ "TP" ]),
+]
+
+def synthetic_outline(rng, width, height):
+    """
+    A board outline with rounded corners (many points, as arcs come out of KiCad)
+    and a few rectangular notches along the top edge. Points are in mm.
+    """
+    r = min(width, height) * 0.05
+    points = []
+    corners = [ (width - r, r, -90), (width - r, height - r, 0), (r, height - r, 90), (r, r, 180) ]
+    for index, (cx, cy, start) in enumerate(corners):
+        for step in range(31):
+            a = math.radians(start + step * 3)
+            points.append((cx + r * math.cos(a), cy + r * math.sin(a)))
+        if (index == 3):
+            # Notches along the top edge on the way back to the start
+            x = r * 2
+            while (x < width - r * 4):
+                w = rng.uniform(r * 0.5, r * 1.5)
+                d = rng.uniform(r * 0.2, r)
+                points += [ (x, 0), (x, d), (x + w, d), (x + w, 0) ]
+                x += w + rng.uniform(r, r * 4)
+    return points
+
+def synthetic_board(directory, parts, seed=1):
+    """
+    Write a deterministic board.csv and components.csv with the given number of
+    parts into directory (in KiCad units, as the plugin would).
+    """
+    rng = random.Random(seed)
+    side = math.sqrt(parts * 40.0)                  # ~40mm^2 of board per part
+    width, height = side * 1.5, side / 1.5
+    ox, oy = 100.0, 50.0                            # somewhere on the KiCad sheet
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "board.csv"), "w", newline="") as bfile:
+        writer = csv.writer(bfile)
+        writer.writerow([ "x", "y" ])
+        for x, y in synthetic_outline(rng, width, height):
+            writer.writerow([ round((ox + x) * 1000000), round((oy + y) * 1000000) ])
+
+    prefixes = [ p[0] for p in SYNTHETIC_PARTS ]
+    weights = [ p[1] for p in SYNTHETIC_PARTS ]
+    kinds = { p[0]: p for p in SYNTHETIC_PARTS }
+    counts = {}
+
+    with open(os.path.join(directory, "components.csv"), "w", newline="") as cfile:
+        writer = csv.writer(cfile)
+        writer.writerow([ "ref", "value", "layer", "footprint", "lcsc", "x", "y", "rot",
+                            "top", "left", "bottom", "right" ])
+        for prefix in rng.choices(prefixes, weights, k=parts):
+            counts[prefix] = counts.get(prefix, 0) + 1
+            footprint, w, h = rng.choice(kinds[prefix][2])
+            value = rng.choice(kinds[prefix][3])
+            rot = rng.choice([ 0.0, 90.0, 180.0, -90.0 ])
+            if (rot in (90.0, -90.0)):
+                w, h = h, w
+            x = ox + rng.uniform(w, width - w)
+            y = oy + rng.uniform(h, height - h)
+            # Parts on the same line share an LCSC number, some have none
+            lcsc = "" if (rng.random() < 0.1) else "C%d" % (1000 + zlib.crc32((footprint + value).encode()) % 100000)
+            writer.writerow([ prefix + str(counts[prefix]), value,
+                                "F.Cu" if (rng.random() < 0.8) else "B.Cu", footprint, lcsc,
+                                round(x * 1000000), round(y * 1000000), rot,
+                                round((y - h / 2) * 1000000), round((x - w / 2) * 1000000),
+                                round((y + h / 2) * 1000000), round((x + w / 2) * 1000000) ])
+
+def parse_size(text):
+    """
+    Convert a size such as 10k or 1m (or 1M) into a number of parts.
+    """
+    text = text.strip().lower()
+    scale = { "k": 1000, "m": 1000000 }.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+# --------------------------------------------------------------------------------------
+# STAGE BENCHMARKS
+# --------------------------------------------------------------------------------------
+
+def time_stage(results, name, func, *args):
+    """
+    Run func, record how long it took in results[name] and return its result.
+    """
+    start = time.perf_counter()
+    value = func(*args)
+    results[name] = time.perf_counter() - start
+    return value
+
+def bench_stages(directory, max_viz_parts):
+    """
+    Time each stage of the pipeline against the board in directory, returning a dict
+    of stage name to seconds.
+    """
+    import process_files as pf
+
+    results = {}
+    with tempfile.TemporaryDirectory() as outdir:
+        rotdb = time_stage(results, "rotdb_load", pf.RotDB, os.path.join(HERE, "rotations.cf"))
+        board = time_stage(results, "board_parse", pf.load_board, os.path.join(directory, "board.csv"))
+        columns = time_stage(results, "csv_parse", pf.read_csv_columns, os.path.join(directory, "components.csv"),
+                                ("x", "y", "rot", "top", "left", "bottom", "right"))
+        table = time_stage(results, "component_construction", pf.ComponentTable, board, columns)
+        bom = time_stage(results, "bom_aggregation", table.bom)
+        time_stage(results, "bom_write", pf.write_bom, os.path.join(outdir, "out_bom.csv"), bom)
+        time_stage(results, "cpl_write", pf.write_cpl, os.path.join(outdir, "out_cpl.csv"),
+                        table.placementRows(rotdb))
+        time_stage(results, "design_checks", pf.check_board, board, table)
+        info = rotdb.cache_info()
+        results["rotdb_cache_hits"] = info.hits
+        results["rotdb_cache_misses"] = info.misses
+
+        time_stage(results, "pandas_import", importlib.import_module, "pandas")
+        time_stage(results, "dataframe_build", table.dataFrame)
+
+        if (len(table) <= max_viz_parts):
+            time_stage(results, "bokeh_import", importlib.import_module, "bokeh.plotting")
+            plot = time_stage(results, "bokeh_document_build", bokeh_document, pf, board, table)
+            html = time_stage(results, "bokeh_serialise", bokeh_html, plot)
+            results["html_bytes"] = len(html)
+    return results
+
+def bokeh_document(pf, board, table):
+    """
+    Build the board figure the same way as visualise() does.
+    """
+    from bokeh.plotting import figure
+
+    v1 = figure(title="PCB layout", x_axis_label="x (mm)", y_axis_label="y (mm)", match_aspect=True)
+    board.drawLevels(v1, pf.OUTLINE_TOLERANCE, line_width=2, fill_color="#002d04", line_color="black")
+    batch = pf.BatchPlot()
+    for c in table:
+        c.draw(batch)
+    batch.flush(v1)
+    return v1
+
+def bokeh_html(plot):
+    """
+    Serialise the figure to a standalone HTML document.
+    """
+    from bokeh.embed import file_html
+    from bokeh.resources import CDN
+
+    return file_html(plot, CDN, "benchmark")
+
+def bench_suite(sizes, seed, data_dir, max_viz_parts, output):
+    """
+    Generate (or reuse) a synthetic board for each size, time every stage against it
+    and write all the results to output as JSON.
+    """
+    report = {
+        "created":      time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":       platform.python_version(),
+        "platform":     platform.platform(),
+        "commit":       git_commit(),
+        "seed":         seed,
+        "sizes":        {},
+    }
+    for parts in sizes:
+        directory = os.path.join(data_dir, "synthetic-%d-%d" % (parts, seed))
+        if (not os.path.isfile(os.path.join(directory, "components.csv"))):
+            start = time.perf_counter()
+            synthetic_board(directory, parts, seed)
+            print ("generated %d parts in %.2fs" % (parts, time.perf_counter() - start))
+
+        results = bench_stages(directory, max_viz_parts)
+        report["sizes"][str(parts)] = results
+        print ("%d parts:" % parts)
+        for name, value in results.items():
+            if (isinstance(value, float)):
+                print ("    %-24s %9.4fs" % (name, value))
+            else:
+                print ("    %-24s %9d" % (name, value))
+
+    with open(output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print ("results written to " + output)
+    return report
+
+def git_commit():
+    """
+    The current git commit (if we are in a git checkout) so results can be matched
+    to versions.
+    """
+    try:
+        return subprocess.run([ "git", "rev-parse", "--short", "HEAD" ], cwd=HERE, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_compare(old_file, new_file, threshold):
+    """
+    Compare two result files stage by stage, flagging anything that got slower by
+    more than threshold (a fraction). Returns the number of regressions.
+    """
+    with open(old_file) as fh:
+        old = json.load(fh)
+    with open(new_file) as fh:
+        new = json.load(fh)
+
+    regressions = 0
+    print ("%s (%s) -> %s (%s)" % (old_file, old.get("commit"), new_file, new.get("commit")))
+    for size, stages in new["sizes"].items():
+        print ("%s parts:" % size)
+        for name, after in stages.items():
+            before = old["sizes"].get(size, {}).get(name)
+            if (not isinstance(after, float) or not isinstance(before, float) or before <= 0):
+                continue
+            ratio = after / before
+            flag = ""
+            if (ratio > 1 + threshold):
+                flag = "  << REGRESSION"
+                regressions += 1
+            print ("    %-24s %9.4fs -> %9.4fs  x%.2f%s" % (name, before, after, ratio, flag))
+    return regressions
+
+# --------------------------------------------------------------------------------------
+# MAIN
+# --------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for process_files.py")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    startup = sub.add_parser("startup", help="compare headless and full startup time")
+    startup.add_argument("path", nargs="?", default=os.path.join(HERE, "sample"),
+                            help="input directory (default: the sample board)")
+    startup.add_argument("-n", "--runs", type=int, default=5, help="runs per mode")
+
+    suite = sub.add_parser("suite", help="time each pipeline stage against synthetic boards")
+    suite.add_argument("--sizes", default="1k,10k,100k,1m",
+                            help="comma separated part counts (default: 1k,10k,100k,1m)")
+    suite.add_argument("--seed", type=int, default=1, help="seed for the synthetic boards")
+    suite.add_argument("--data-dir", default=None,
+                            help="keep the synthetic boards here for re-use (default: a temporary directory)")
+    suite.add_argument("--max-viz-parts", type=parse_size, default=100000,
+                            help="skip the Bokeh stages for bigger boards (default: 100k)")
+    suite.add_argument("-o", "--output", default="bench_results.json", help="JSON results file")
+
+    compare = sub.add_parser("compare", help="compare two suite result files")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=0.1,
+                            help="flag stages that are slower by more than this fraction (default: 0.1)")
+
+    generate = sub.add_parser("generate", help="just write a synthetic board")
+    generate.add_argument("directory")
+    generate.add_argument("parts", type=parse_size)
+    generate.add_argument("--seed", type=int, default=1)
+
+    args = parser.parse_args()
+
+    if (args.bench == "startup"):
+        bench_startup(os.path.abspath(args.path), args.runs)
+    elif (args.bench == "suite"):
+        sizes = [ parse_size(s) for s in args.sizes.split(",") ]
+        if (args.data_dir is None):
+            with tempfile.TemporaryDirectory() as data_dir:
+                bench_suite(sizes, args.seed, data_dir, args.max_viz_parts, args.output)
+        else:
+            bench_suite(sizes, args.seed, args.data_dir, args.max_viz_parts, args.output)
+    elif (args.bench == "compare"):
+        sys.exit(1 if bench_compare(args.old, args.new, args.threshold) else 0)
+    elif (args.bench == "generate"):
+        synthetic_board(args.directory, args.parts, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,9 +7,18 @@
 # This script can be run by the plugin (using the current board) or from the
 # command line if a board filename is supplied.
 #
-# In an ideal world you would do full processing in here rather than export CSV's
-# for external processing, but to make testing easier, and for testing without KiCAD
-# this allows for the provision of interim data.
+# The footprint data is handed straight to the processing in process_files.py (which
+# lives in the directory above this one, the plugin directory is normally a link to
+# this one), so the out_bom.csv and out_cpl.csv files are produced in one step. The
+# interim board.csv and components.csv files can still be written for debugging or
+# for processing without KiCad, set LIBF_EXPORT_CSV=1 in the environment (or use
+# --csv from the command line).
+#
+# The plugin remembers the footprints it exported (by UUID, with a digest of the
+# details that are cheap to read) so that on later runs only the footprints that
+# changed have their courtyard and fields queried again. The pcbnew objects are only
+# touched on KiCad's UI thread (the API isn't thread safe) with a progress dialog
+# that can be cancelled, the BOM/CPL processing runs on a worker thread.
 #
 # Also, there are some limitations here if the KiCAD directory includes multiple
 # designs as there would be a potential filename clash.
@@ -19,8 +28,27 @@ import pcbnew           # To access KiCAD functions
 import os               # To manipulate filenames
 import sys              # For argv
 import csv              # To output CSV files
+import hashlib          # For footprint digests
+import shutil           # To tidy up cancelled exports
+import tempfile         # For writing the outputs before they are kept
+import threading        # To process off the UI thread
 import wx               # For in-kicad dialog box
 
+#
+# Find process_files.py, following the link to the plugin directory if there is one
+#
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+try:
+    import process_files
+except ImportError:
+    process_files = None
+
+# The fields for each component (the columns of components.csv)
+FIELDS = [ "ref", "value", "layer", "footprint", "lcsc", "x", "y", "rot", "top", "left", "bottom", "right" ]
+
+# How many footprints are read between progress updates
+PROGRESS_STEP = 100
+
 class LIBFPlugin(pcbnew.ActionPlugin):
     ''' 
     Set the default values for the plugin, these control how the plugin appears
@@ -29,19 +57,22 @@ class LIBFPlugin(pcbnew.ActionPlugin):
     def defaults(self):
         self.name = "LIBF JLCPCBA BOM/Placement"
         self.category = "PCB Manufacture"
-        self.description = "Create interim files for processing into JLCPCB's assembly service"
+        self.description = "Create the BOM and placement files for JLCPCB's assembly service"
         self.show_toolbar_button = True
         self.icon_file_name = os.path.join(os.path.dirname(__file__), 'libf.png')
+        self.caches = {}        # A FootprintCache for each board file
    
     '''
     The main entry point for the plugin
     '''
-    def Run(self, board=None):
+    def Run(self, board=None, export_csv=None):
         #
         # Use the current board, unless one has been provided (for testing)
         #
         if board == None:
             board = pcbnew.GetBoard()
+        if export_csv == None:
+            export_csv = os.environ.get("LIBF_EXPORT_CSV", "") not in ("", "0")
 
         #
         # Work out filenames, we want to put any files in the same place as the
@@ -51,97 +82,236 @@ class LIBFPlugin(pcbnew.ActionPlugin):
         path = os.path.dirname(boardfile)
 
         #
-        # Work out the board outline
+        # Read the footprints (re-reading only those that changed), in KiCad we show
+        # progress and allow the export to be cancelled
         #
-        outline = pcbnew.SHAPE_POLY_SET()
-        board.GetBoardPolygonOutlines(outline)
-        linechain = outline.Outline(0)
+        footprints = list(board.GetFootprints())
+        progress = Progress(len(footprints))
+        cache = self.caches.setdefault(boardfile, FootprintCache())
 
-        #
-        # Now prepare to write the board.csv file which just contains a list of
-        # points from the outline...
-        #
-        with open(os.path.join(path, "board.csv"), "w") as bfile:
-            fieldnames = [ "x", "y" ]
-            writer = csv.DictWriter(bfile, fieldnames=fieldnames)
-            writer.writeheader()
+        outline = board_outline(board)
+        columns = cache.columns(footprints, progress.update)
+        if (columns == None):
+            progress.close()
+            return
 
-            #
-            # Get each point on the outline...
-            #
-            for point in linechain.CPoints():
-                writer.writerow({"x": point.x, 'y': point.y })
+        export = Export(path, outline, columns, export_csv)
+        export.start()
+        while (export.running()):
+            if (not progress.pulse("Writing the BOM and placement files...")):
+                export.cancel()
+                progress.close()
+                return
+        progress.close()
 
-
-        #
-        # Now for each component we want to dump them with enough info
-        # to do the JLCPCB stuff as well as the visualisations we need
-        #
-        with open(os.path.join(path, "components.csv"), "w") as cfile:
-            fieldnames = [ "ref", "value", "layer", "footprint", "lcsc", "x", "y", "rot", "top", "left", "bottom", "right" ]
-            writer = csv.DictWriter(cfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for fp in board.GetFootprints():
-                if (fp.IsExcludedFromBOM()):
-                    continue
-
-                #
-                # Specific support for LCSC part numbers (if we have them)
-                #
-                if (fp.HasFieldByName("LCSC")):
-                    lcsc = fp.GetFieldByName("LCSC").GetText()
-                else:
-                    lcsc = ""
-
-                x = fp.GetPosition().x
-                y = fp.GetPosition().y
-                rot = fp.GetOrientation().AsDegrees()
-                layer = fp.GetLayerName()
-                ref = fp.GetReference()
-                value = fp.GetValue()
-                fpname = fp.GetFPID().GetLibItemName()
-
-                # fp.GetBoundingBox seems to be massive, so go via GetCourtyard
-                #bb = fp.GetBoundingBox()
-                bb = fp.GetCourtyard(fp.GetLayer()).BBox()
-
-                writer.writerow({
-                    "ref":          ref,
-                    "value":        value,
-                    "layer":        layer,
-                    "footprint":    fpname,
-                    "lcsc":         lcsc,
-                    "x":            x,
-                    "y":            y,
-                    "rot":          rot,
-                    "top":          bb.GetTop(),
-                    "left":         bb.GetLeft(),
-                    "bottom":       bb.GetBottom(),
-                    "right":        bb.GetRight(),
-                })
-
-        msg = "LIBF Interim Files Created\n\n" + \
-                    "BOARD: " + os.path.join(path, "board.csv") + "\n" + \
-                    "COMPONENTS: " + os.path.join(path, "components.csv") + "\n"
+        msg = "LIBF Files Created\n\n" + "".join(name + ": " + f + "\n" for name, f in export.files) + \
+                    "\n%d of %d footprints read from the board\n" % (cache.changed, len(columns["ref"]))
         if(wx.App.Get() == None):
             print(msg)
         else:
             wx.MessageBox(msg, caption="JLCPCBA Plugin")
 
+class FootprintCache():
+    '''
+    The records of the footprints exported last time, keyed by footprint UUID along
+    with a digest of the details that are cheap to read. Only footprints whose digest
+    has changed have their courtyard and fields queried again.
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.changed = 0
+
+    '''
+    Return the dict of columns for the footprints, or None if progress(count) returns
+    False (the export was cancelled)
+    '''
+    def columns(self, footprints, progress=None):
+        entries = {}
+        records = []
+        self.changed = 0
+        for i, fp in enumerate(footprints):
+            if (progress != None and i % PROGRESS_STEP == 0 and not progress(i)):
+                return None
+            if (fp.IsExcludedFromBOM()):
+                continue
+
+            uuid = fp.m_Uuid.AsString()
+            digest = footprint_digest(fp)
+            entry = self.entries.get(uuid)
+            if (entry == None or entry[0] != digest):
+                entry = (digest, footprint_record(fp))
+                self.changed += 1
+            entries[uuid] = entry
+            records.append(entry[1])
+
+        self.entries = entries
+        return { f: [ r[i] for r in records ] for i, f in enumerate(FIELDS) }
+
+class Progress():
+    '''
+    A cancellable progress dialog when running inside KiCad, otherwise it does nothing
+    '''
+    def __init__(self, count):
+        self.dialog = None
+        if (wx.App.Get() != None):
+            self.dialog = wx.ProgressDialog("JLCPCBA Plugin", "Reading footprints...", maximum=max(count, 1),
+                            style=wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_AUTO_HIDE | wx.PD_ELAPSED_TIME)
+
+    '''
+    Show how many footprints have been read, returns False if cancelled
+    '''
+    def update(self, count):
+        return self.dialog == None or self.dialog.Update(count)[0]
+
+    '''
+    Show we are still busy (and handle any events), returns False if cancelled
+    '''
+    def pulse(self, message):
+        if (self.dialog == None):
+            return True
+        return self.dialog.Pulse(message)[0]
+
+    def close(self):
+        if (self.dialog != None):
+            self.dialog.Destroy()
+
+class Export():
+    '''
+    Writes the output files on a worker thread, into a temporary directory first so
+    that a cancelled export leaves the previous files alone.
+    '''
+    def __init__(self, path, outline, columns, export_csv):
+        self.path = path
+        self.outline = outline
+        self.columns = columns
+        self.export_csv = export_csv
+        self.files = []
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    '''
+    Wait a moment for the export, returns True if it is still running
+    '''
+    def running(self, wait=0.05):
+        self.thread.join(wait)
+        return self.thread.is_alive()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+
+    def run(self):
+        tmp = tempfile.mkdtemp(prefix=".libf", dir=self.path)
+        try:
+            files = []
+            if (self.export_csv or process_files == None):
+                files += write_interim_files(tmp, self.outline, self.columns)
+
+            if (process_files != None):
+                rotdb = process_files.RotDB(os.path.join(os.path.dirname(process_files.__file__), "rotations.cf"))
+                try:
+                    process_files.process_data(self.outline, self.columns, tmp, rotdb)
+                    files += [ ("BOM", os.path.join(tmp, "out_bom.csv")), ("CPL", os.path.join(tmp, "out_cpl.csv")) ]
+                except process_files.InvalidData as e:
+                    self.files += [ ("ERROR", e.args[-1]) ]
+
+            # Only keep the files if we weren't cancelled in the meantime
+            with self.lock:
+                if (not self.cancelled):
+                    for name, f in files:
+                        final = os.path.join(self.path, os.path.basename(f))
+                        os.replace(f, final)
+                        self.files.append((name, final))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+#
+# Return a digest of the details of a footprint that are cheap to read: position,
+# orientation, layer, FPID, the fields and the (cached) bounding box, which changes
+# if the footprint itself is edited or updated from the library
+#
+def footprint_digest(fp):
+    pos = fp.GetPosition()
+    bb = fp.GetBoundingBox()
+    details = (pos.x, pos.y, fp.GetOrientation().AsDegrees(), fp.GetLayerName(),
+                str(fp.GetFPID().GetUniStringLibId()),
+                [ (field.GetName(), field.GetText()) for field in fp.GetFields() ],
+                bb.GetLeft(), bb.GetTop(), bb.GetRight(), bb.GetBottom())
+    return hashlib.blake2b(repr(details).encode(), digest_size=16).digest()
+
+#
+# Work out the board outline, as lists of the x and y co-ordinates
+#
+def board_outline(board):
+    outline = pcbnew.SHAPE_POLY_SET()
+    board.GetBoardPolygonOutlines(outline)
+    linechain = outline.Outline(0)
+
+    xs = []
+    ys = []
+    for point in linechain.CPoints():
+        xs.append(point.x)
+        ys.append(point.y)
+    return xs, ys
+
+#
+# Return the details of a footprint we need, in the order of FIELDS, with enough
+# info to do the JLCPCB stuff as well as the visualisations we need
+#
+def footprint_record(fp):
+    #
+    # Specific support for LCSC part numbers (if we have them)
+    #
+    if (fp.HasFieldByName("LCSC")):
+        lcsc = fp.GetFieldByName("LCSC").GetText()
+    else:
+        lcsc = ""
+
+    pos = fp.GetPosition()
+
+    # fp.GetBoundingBox seems to be massive, so go via GetCourtyard
+    #bb = fp.GetBoundingBox()
+    bb = fp.GetCourtyard(fp.GetLayer()).BBox()
+
+    return (fp.GetReference(), fp.GetValue(), fp.GetLayerName(), str(fp.GetFPID().GetLibItemName()),
+            lcsc, pos.x, pos.y, fp.GetOrientation().AsDegrees(),
+            bb.GetTop(), bb.GetLeft(), bb.GetBottom(), bb.GetRight())
+
+#
+# Write the interim board.csv and components.csv files, returns a list of the
+# (name, filename) written
+#
+def write_interim_files(path, outline, columns):
+    with open(os.path.join(path, "board.csv"), "w") as bfile:
+        writer = csv.writer(bfile)
+        writer.writerow([ "x", "y" ])
+        writer.writerows(zip(*outline))
+
+    with open(os.path.join(path, "components.csv"), "w") as cfile:
+        writer = csv.writer(cfile)
+        writer.writerow(FIELDS)
+        writer.writerows(zip(*[ columns[f] for f in FIELDS ]))
+
+    return [ ("BOARD", os.path.join(path, "board.csv")), ("COMPONENTS", os.path.join(path, "components.csv")) ]
+
 #
 # Allow running from the command line for easier debugging...
 #
 if __name__ == "__main__":
-    if (len(sys.argv) != 2):
-        print ("Usage: " + sys.argv[0] + " <path_to_kicad_pcb_file>")
+    args = [ a for a in sys.argv[1:] if a != "--csv" ]
+    if (len(args) != 1):
+        print ("Usage: " + sys.argv[0] + " [--csv] <path_to_kicad_pcb_file>")
         sys.exit(1)
 
-    board_file = sys.argv[1]
+    board_file = args[0]
 
     if (not os.path.isfile(board_file)):
         print ("Error: " + board_file + " not found.")
         sys.exit(1)
 
     b = pcbnew.LoadBoard(board_file)
-    LIBFPlugin().Run(board=b)
+    LIBFPlugin().Run(board=b, export_csv=("--csv" in sys.argv[1:]) or None)
@@ -5,26 +5,87 @@
 # support the JLCPCB PCB Assembly service, namely a BOM CSV file, and a CPL CSV file.
 #
 # Usage:
-#   process_files.py -T     -- runs the unit tests
-#   process_files.py <path> -- runs the main process
+#   process_files.py -T              -- runs the unit tests
+#   process_files.py <path>          -- runs the main process
+#   process_files.py --no-viz <path> -- headless, only writes the BOM/CPL (Bokeh and
+#                                       pandas are never imported)
+#   process_files.py <file.kicad_pcb> -- reads the KiCad board directly, no pcbnew or
+#                                        interim CSV files needed
+#   process_files.py -i <path>       -- incremental, only recomputes/rewrites what
+#                                       changed since the last run
+#   process_files.py --no-viz --stream <path>
+#                                     -- writes the CPL as the components are read,
+#                                        for very large (e.g. panelised) boards
+#   process_files.py --panel 2x3 [--pitch X,Y] [--rails X,Y] [--panel-rotation DEG,...] <path>
+#                                     -- steps and repeats the board into a panel
+#   process_files.py --order [SECONDS] <path>
+#                                     -- writes the CPL in pick and place order, by
+#                                        layer and feeder, shortest travel first
+#   process_files.py --check <path>  -- also reports overlapping courtyards and parts
+#                                        off the edge of the board
+#   process_files.py --catalogue parts.db --import-catalogue jlcpcb.csv
+#                                     -- imports the JLCPCB parts list for checking
+#   process_files.py --catalogue parts.db <path>
+#                                     -- also checks the BOM LCSC numbers against it
+#   process_files.py --report report.html <path>
+#                                     -- saves the visualisation to a standalone HTML
+#                                        file, no browser is opened
+#   process_files.py --density-threshold N <path>
+#                                     -- boards with more than N (default 5000) parts
+#                                        are drawn as a heatmap
+#   process_files.py --watch [--no-viz] <path>
+#                                     -- keeps running and rebuilds when the inputs
+#                                        change, updating the served visualisation
+#   process_files.py --profile report.json <path>
+#                                     -- times each phase, writes a JSON report and
+#                                        prints a summary
+#   process_files.py --diff <old_path> <path>
+#                                     -- compares two revisions of a board, writes
+#                                        out_diff.json and plots the changes
+#   process_files.py --service PORT [-j N] [--queue N] [--timeout S]
+#                                     -- runs a local HTTP conversion service with a
+#                                        pool of warm worker processes
+#   process_files.py --batch [-j N] [-o dir] <path|glob> ...
+#                                     -- converts many boards in parallel, each into
+#                                        its own directory under dir
 #
 # For processing the board.csv and components.csv files must exist in the given
-# directory.
+# directory (unless a .kicad_pcb file is given instead).
 #
-# Output files out_bom.csv and out_cpl.csv will be created in the current directory.
+# It can also be imported as a library (as the KiCad plugin does): Board, the
+# Component classes, ComponentTable and RotDB can be used directly, and process_data()
+# writes the outputs for a board held in memory without any interim files.
+#
+# Output files out_bom.csv and out_cpl.csv will be created in the current directory
+# (or the one given with -o).
 # --------------------------------------------------------------------------------------
 
-from bokeh.plotting import figure, show     # for plotting
-from bokeh.layouts import column            # mulitple plots in a column
-from bokeh.models import ColumnDataSource, DataTable, TableColumn    # For a table 
-from bokeh.models.widgets import Div        # So we can title the table
 from math import nan                        # for Bokeh point lists
+import math                                 # for arcs and rotations
+import argparse                             # command line options
+import contextlib                           # profiling phases
+import concurrent.futures                   # for batch processing
 import csv                                  # csv import and export
 import string                               # string manipulation
-import pandas as pd                         # for visualisations
+import numpy as np                          # for symbol geometry
 import re                                   # for rotation matching
+import io                                   # for in-memory test files
+import functools                            # for rotation caching
+import gc                                   # for bulk loading
 import sys, os                              # path manipulation & exit
-import unittest                             # for testing
+import glob                                 # batch inputs
+import time                                 # batch timings
+import hashlib, pickle                      # incremental build cache
+import json                                 # profile reports
+import itertools                            # catalogue import batches
+import copy                                 # panel tables
+import collections                          # service latency window
+import threading                            # service request accounting
+
+#
+# Anything only needed for the tests, the conversion service, profiling or the parts
+# catalogue is imported where it is used, so a headless run doesn't pay for it.
+#
 
 # --------------------------------------------------------------------------------------
 # HELPER FUNCTIONS
@@ -59,10 +120,169 @@ def reftype(s):
             
     return s
 
+#
+# Helper function to resolve reftype() for a whole column of references
+#
+def reftypes(refs):
+    """
+    Return an array with reftype() of each reference, worked out once per distinct
+    prefix rather than once per row.
+    """
+    refs = np.asarray(refs, dtype=str)
+    if (len(refs) == 0):
+        return refs
+
+    # R100 and R101 share R0 (the trailing 0 marks that there were digits, reftype
+    # upper-cases in that case), XY99Z keeps its digits...
+    stems = np.char.rstrip(refs, "0123456789")
+    tagged = np.where(np.char.str_len(stems) < np.char.str_len(refs), np.char.add(stems, "0"), stems)
+    prefixes, inverse = np.unique(tagged, return_inverse=True)
+
+    types = np.array([ reftype(p) for p in prefixes.tolist() ], dtype=object)
+    result = types[inverse.reshape(-1)]
+
+    # ...except when there is no leading alpha, where the whole reference is returned
+    whole = np.array([ p == "" or not p[0].isalpha() for p in prefixes.tolist() ], dtype=bool)
+    rows = whole[inverse.reshape(-1)]
+    result[rows] = refs[rows]
+    return result
+
+#
+# Helper function to parse component values in engineering notation
+#
+# Multipliers for the SI prefixes used in values (u and the micro signs are all micro)
+SI_PREFIXES = { "p": 1e-12, "n": 1e-9, "u": 1e-6, "µ": 1e-6, "μ": 1e-6, "m": 1e-3,
+                "": 1.0, "k": 1e3, "K": 1e3, "M": 1e6, "G": 1e9 }
+
+# 100nF, 0.1 uF, 10k, 4.7uH, 1Mohm, and the 4k7 / 4R7 / 2n2 style
+VALUE_PLAIN = re.compile(r"^(\d+(?:\.\d+)?|\.\d+)\s*([pnuµμmkKMG]?)\s*(F|H|R|Ω|[oO]hms?)?$")
+VALUE_INFIX = re.compile(r"^(\d+)([pnuµμmkKMGR])(\d+)\s*(F|H|Ω|[oO]hms?)?$")
+
+# Normalise the unit spellings
+VALUE_UNITS = { "F": "F", "H": "H", "R": "Ω", "Ω": "Ω" }
+
+@functools.lru_cache(maxsize=None)
+def parse_value(text):
+    """
+    Parse a component value such as 100nF, 10k or 4k7 into a (number, unit) tuple,
+    the number in base units and the unit one of F, H, Ω or "" if not given. Returns
+    None if the value isn't a plain number (e.g. a part number).
+
+    The number is rounded to 6 significant figures so that equal values compare
+    equal however they were written (100nF and 0.1uF).
+    """
+    text = text.strip()
+    m = VALUE_PLAIN.match(text)
+    if (m):
+        number, prefix, unit = m.group(1), m.group(2), m.group(3) or ""
+    else:
+        m = VALUE_INFIX.match(text)
+        if (not m):
+            return None
+        number = m.group(1) + "." + m.group(3)
+        prefix = "" if (m.group(2) == "R") else m.group(2)
+        unit = m.group(4) or ("R" if (m.group(2) == "R") else "")
+    return float("%.6g" % (float(number) * SI_PREFIXES[prefix])), VALUE_UNITS.get(unit, "Ω" if (unit) else "")
+
+# The prefix for each power of 1000 when writing values
+ENGINEERING_PREFIXES = { -12: "p", -9: "n", -6: "u", -3: "m", 0: "", 3: "k", 6: "M", 9: "G" }
+
+def format_value(number, unit):
+    """
+    Write a number (in base units) in engineering notation, e.g. 1e-07 as 100nF
+    """
+    if (number == 0):
+        return "0" + unit
+    exponent = min(max(int(math.floor(math.log10(abs(number)) / 3)) * 3, -12), 9)
+    return "%g%s%s" % (float("%.6g" % (number / 10.0**exponent)), ENGINEERING_PREFIXES[exponent], unit)
+
+@functools.lru_cache(maxsize=None)
+def canonical_value(value, unit):
+    """
+    Return the canonical form of a value for a part with values in the given unit,
+    so 0.1uF, 100n and 100nF all become 100nF. Values that can't be parsed, or are
+    in a different unit, are returned unchanged.
+    """
+    parsed = parse_value(value)
+    if (parsed is None or parsed[1] not in ("", unit)):
+        return value
+    return format_value(parsed[0], unit)
+
+#
+# Helper function to read a CSV file a column at a time
+#
+def read_csv_columns(filename, numeric=()):
+    """
+    Read a CSV file into a dict of columns keyed by the header, the numeric columns
+    are converted into float64 arrays in one go, the rest are tuples of strings.
+    """
+    # Millions of small row lists send the garbage collector round in circles, and
+    # none of them can be in a cycle, so it is held off until we are done with them
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(filename, newline="") as fh:
+            reader = csv.reader(fh)
+            header = next(reader, [])
+            rows = [ row for row in reader if row ]
+
+        for row in rows:
+            if (len(row) != len(header)):
+                raise InvalidData(filename, "Row has the wrong number of fields: " + ",".join(row))
+
+        columns = dict(zip(header, zip(*rows))) if (rows) else { name: () for name in header }
+        del rows
+        for name in numeric:
+            if (name in columns):
+                columns[name] = np.array(columns[name], dtype=np.float64)
+    finally:
+        if (enabled):
+            gc.enable()
+    return columns
+
+#
+# Helper function to build a read-only symbol array, symbols are drawn in a unit
+# square and are shared by every instance of a component class.
+#
+def symbol(xlist, ylist):
+    """
+    Return the x and y lists as a read-only (2, N) array, nan breaks the line.
+    """
+    points = np.array([xlist, ylist], dtype=np.float64)
+    points.flags.writeable = False
+    return points
+
+#
+# Helper function to place a symbol on many components at once
+#
+def transform_symbol(points, x, y, w, h, rot):
+    """
+    Transform a unit-square symbol onto n components in a single step.
+
+    x, y, w and h are the courtyard boxes (which already reflect the rotation) and
+    rot the rotation in degrees. The symbol is rotated about its centre (shrunk so
+    it stays within the box for non-right angles) then scaled to the box. Returns
+    the (n, N) arrays of x and y co-ordinates.
+    """
+    x, y, w, h = (np.asarray(v, dtype=np.float64)[:, None] for v in (x, y, w, h))
+    theta = np.radians(np.asarray(rot, dtype=np.float64))[:, None]
+    c = np.cos(theta)
+    s = np.sin(theta)
+    k = 1.0 / (np.abs(c) + np.abs(s))
+
+    ux = points[0] - 0.5
+    uy = points[1] - 0.5
+    xs = x + w * (0.5 + k * (c * ux + s * uy))
+    ys = y + h * (0.5 + k * (c * uy - s * ux))
+    return xs, ys
+
 # --------------------------------------------------------------------------------------
 # ROTATION DATABASE CLASS
 # --------------------------------------------------------------------------------------
 
+# Characters that mean a rule is more than a simple literal prefix
+REGEX_SPECIALS = set(".^$*+?{}[]\\|()")
+
 #
 # We need to be able to support a list of footprints that need to be
 # rotated where the KiCAD symbol orientation is differnt to the JLCPCD
@@ -71,9 +291,14 @@ def reftype(s):
 class RotDB():
     """
     A Class for handling a rotations database
+
+    The rules are compiled once when the file is loaded. Rules that are just an
+    anchored literal prefix (the vast majority, e.g. ^SOT-23) are held in a prefix
+    trie, anything else is kept as a compiled regex. Results are memoized per
+    footprint name in a bounded LRU cache.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache_size=4096):
         """
         Intialise the rotation db from the supplied filename
         """
@@ -85,7 +310,58 @@ class RotDB():
                 if (line == ""):
                     continue
                 self.db.append(line.split())
-    
+
+        self.compile()
+        self._lookup = functools.lru_cache(maxsize=cache_size)(self._match)
+
+    def compile(self):
+        """
+        Build the prefix trie for the literal rules and compile the rest, keeping
+        the rule index so that first-match-wins is preserved across both.
+        """
+        self.rules = []
+        self.trie = {}
+        self.complex = []
+        for index, rot in enumerate(self.db):
+            ex = rot[0]
+            delta = float(rot[1])
+            self.rules.append((ex, delta))
+
+            if (ex.startswith("^") and not any(ch in REGEX_SPECIALS for ch in ex[1:])):
+                node = self.trie
+                for ch in ex[1:]:
+                    node = node.setdefault(ch, {})
+                node.setdefault(None, index)        # an earlier duplicate wins
+            else:
+                self.complex.append((index, re.compile(ex), delta))
+
+    def _match(self, footprint):
+        """
+        Find the first rule that matches the footprint, uncached.
+        """
+        # Walk the trie, every terminal we pass is a literal prefix that matches...
+        best = len(self.rules)
+        node = self.trie
+        if (None in node):
+            best = node[None]
+        for ch in footprint:
+            node = node.get(ch)
+            if (node is None):
+                break
+            if (None in node and node[None] < best):
+                best = node[None]
+
+        # Any complex rule that appears earlier in the file still takes priority...
+        for index, ex, delta in self.complex:
+            if (index >= best):
+                break
+            if (ex.search(footprint)):
+                return delta
+
+        if (best < len(self.rules)):
+            return self.rules[best][1]
+        return 0
+
     def possible_rotate(self, footprint):
         """
         Provide optional rotation information for a given footprint
@@ -94,17 +370,64 @@ class RotDB():
         expression that matches, if it does return the rotation value
         otherwise return 0.
         """
-        for rot in self.db:
-            ex = rot[0]
-            delta = float(rot[1])
-            if (re.search(ex, footprint)):
-                return delta
-        return 0
+        return self._lookup(footprint)
+
+    def cache_info(self):
+        """
+        Return the hit/miss counters (and size) of the footprint cache.
+        """
+        return self._lookup.cache_info()
 
 # --------------------------------------------------------------------------------------
 # BOARD CLASS
 # --------------------------------------------------------------------------------------
 
+#
+# Helper function to simplify a polyline (Ramer-Douglas-Peucker), returning a mask of
+# the points to keep so that no dropped point is more than tolerance from the result.
+#
+def simplify_polyline(xs, ys, tolerance):
+    """
+    Return a boolean array marking the points of the polyline to keep, the first and
+    last points are always kept.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    keep = np.zeros(len(xs), dtype=bool)
+    if (len(xs) < 3):
+        keep[:] = True
+        return keep
+
+    keep[0] = keep[-1] = True
+    stack = [ (0, len(xs) - 1) ]
+    while (stack):
+        first, last = stack.pop()
+        if (last - first < 2):
+            continue
+
+        # Distance of the points in between from the line first -> last (or from the
+        # point itself if the ends coincide, as they do for a closed outline)
+        dx = xs[last] - xs[first]
+        dy = ys[last] - ys[first]
+        px = xs[first+1:last] - xs[first]
+        py = ys[first+1:last] - ys[first]
+        length = math.hypot(dx, dy)
+        if (length == 0):
+            dist = np.hypot(px, py)
+        else:
+            dist = np.abs(px * dy - py * dx) / length
+
+        i = int(np.argmax(dist))
+        if (dist[i] > tolerance):
+            mid = first + 1 + i
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+    return keep
+
+# The default maximum rendering error (in mm) of the simplified board outline
+OUTLINE_TOLERANCE = 0.01
+
 class Board():
     """
     A class to encapsulate the outline of a board. We accept a series of points representing
@@ -118,8 +441,47 @@ class Board():
         """
         self.minx = -1
         self.miny = -1
-        self.xlist = []
-        self.ylist = []
+        self._xs = np.zeros(0, dtype=np.float64)
+        self._ys = np.zeros(0, dtype=np.float64)
+        self.pending = ([], [])         # points from addPoint() not yet in the arrays
+
+    def _flush(self):
+        """
+        Move any points added one at a time into the arrays (in one go, so building an
+        outline a point at a time stays linear).
+        """
+        if (self.pending[0]):
+            self._xs = np.concatenate([ self._xs, np.array(self.pending[0], dtype=np.float64) ])
+            self._ys = np.concatenate([ self._ys, np.array(self.pending[1], dtype=np.float64) ])
+            self.pending = ([], [])
+
+    @property
+    def xs(self):
+        self._flush()
+        return self._xs
+
+    @xs.setter
+    def xs(self, xs):
+        self._flush()
+        self._xs = xs
+
+    @property
+    def ys(self):
+        self._flush()
+        return self._ys
+
+    @ys.setter
+    def ys(self, ys):
+        self._flush()
+        self._ys = ys
+
+    @property
+    def xlist(self):
+        return self.xs.tolist()
+
+    @property
+    def ylist(self):
+        return self.ys.tolist()
 
     def addPoint(self, x, y):
         """
@@ -129,17 +491,30 @@ class Board():
             self.minx = x
         if (self.miny < 0 or y < self.miny):
             self.miny = y
-        self.xlist.append(x)
-        self.ylist.append(y)
+        self.pending[0].append(x)
+        self.pending[1].append(y)
+
+    def addPoints(self, xs, ys):
+        """
+        Add many points at once (e.g. arrays already converted to mm).
+        """
+        if (len(xs) == 0):
+            return
+        minx = float(np.min(xs))
+        miny = float(np.min(ys))
+        if (self.minx < 0 or minx < self.minx):
+            self.minx = minx
+        if (self.miny < 0 or miny < self.miny):
+            self.miny = miny
+        self.xs = np.concatenate([ self.xs, np.asarray(xs, dtype=np.float64) ])
+        self.ys = np.concatenate([ self.ys, np.asarray(ys, dtype=np.float64) ])
 
     def shiftByAmount(self, movex, movey):
         """
         Move all the points by the given amounts.
         """
-        for index, x in enumerate(self.xlist):
-            self.xlist[index] = x - movex
-        for index, y in enumerate(self.ylist):
-            self.ylist[index] = y - movey
+        self.xs = self.xs - movex
+        self.ys = self.ys - movey
         
     def shiftToZero(self):
         """
@@ -147,12 +522,74 @@ class Board():
         """
         self.shiftByAmount(self.minx, self.miny)
 
-    def draw(self, plot, **kwargs):
+    def simplify(self, tolerance):
+        """
+        Return the x and y arrays of the outline simplified so that it is never more
+        than tolerance (mm) away from the original.
+        """
+        # Closing the polygon lets the simplifier treat it as one polyline
+        keep = simplify_polyline(np.append(self.xs, self.xs[:1]), np.append(self.ys, self.ys[:1]), tolerance)[:-1]
+        if (np.count_nonzero(keep) < 3):
+            return self.xs, self.ys
+        return self.xs[keep], self.ys[keep]
+
+    def levels(self, tolerance=OUTLINE_TOLERANCE, factor=4, maximum=8):
+        """
+        Return a list of (tolerance, xs, ys) for the outline at increasingly coarse
+        levels of detail, stopping once a level no longer drops any points.
+        """
+        levels = []
+        while (len(levels) < maximum):
+            xs, ys = self.simplify(tolerance)
+            if (levels and len(xs) >= len(levels[-1][1])):
+                break
+            levels.append((tolerance, xs, ys))
+            tolerance *= factor
+        return levels
+
+    def draw(self, plot, tolerance=None, **kwargs):
         """
         Draw the outline (closing the polygon) and pass any additional arguments on to
-        the patch() call.
+        the patch() call. The outline is simplified first if a tolerance is given.
         """
-        plot.patch(self.xlist + [self.xlist[0]], self.ylist + [self.ylist[0]], **kwargs)
+        xs, ys = (self.xs, self.ys) if (tolerance is None) else self.simplify(tolerance)
+        plot.patch(xs.tolist() + xs[:1].tolist(), ys.tolist() + ys[:1].tolist(), **kwargs)
+
+    def drawLevels(self, plot, tolerance=OUTLINE_TOLERANCE, **kwargs):
+        """
+        Draw the outline with a level of detail to suit the zoom, every level is sent
+        with the plot and a callback on the x range swaps in the coarsest one whose
+        error is still under a pixel. Returns the patch renderer.
+        """
+        from bokeh.models import ColumnDataSource, CustomJS
+
+        levels = self.levels(tolerance)
+        tolerances = [ t for t, xs, ys in levels ]
+        data = [ { "x": np.append(xs, xs[:1]), "y": np.append(ys, ys[:1]) } for t, xs, ys in levels ]
+
+        # Start with the level that suits the whole board
+        width = float(np.ptp(self.xs)) if (len(self.xs)) else 0.0
+        pixel = width / (plot.width or 600)
+        initial = max([ i for i, t in enumerate(tolerances) if t <= pixel ], default=0)
+
+        source = ColumnDataSource(data=dict(data[initial]), tags=[ initial ])
+        renderer = plot.patch("x", "y", source=source, **kwargs)
+
+        callback = CustomJS(args=dict(source=source, levels=data, tolerances=tolerances,
+                                        plot=plot, xr=plot.x_range), code="""
+            const pixel = (xr.end - xr.start) / Math.max(plot.inner_width, 1);
+            let pick = 0;
+            for (let i = 0; i < tolerances.length; i++) {
+                if (tolerances[i] <= pixel) pick = i;
+            }
+            if (source.tags[0] !== pick) {
+                source.tags = [pick];
+                source.data = levels[pick];
+            }
+        """)
+        plot.x_range.js_on_change("start", callback)
+        plot.x_range.js_on_change("end", callback)
+        return renderer
 
 # --------------------------------------------------------------------------------------
 # PLOTTABLE CLASS
@@ -162,6 +599,8 @@ class Point():
     '''
     Helper class to group x and y co-ordinates
     '''
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -170,6 +609,8 @@ class Size():
     '''
     Helper class to group width and height co-ordinates
     '''
+    __slots__ = ("w", "h")
+
     def __init__(self, w, h):
         self.w = w
         self.h = h
@@ -180,6 +621,8 @@ class Plottable():
     A class that puts a vaneer around the Bokeh plotting functions so that
     we can use percentage based co-ordinates for ease of scale drawing
     '''
+    __slots__ = ("origin", "size")
+
     def __init__(self, x, y, w, h):
         self.origin = Point(x, y)
         self.size = Size(w, h)
@@ -200,11 +643,20 @@ class Plottable():
                     fill_alpha=0.0, line_alpha=0.0, hatch_scale=8)
 
     def line(self, plot, xlist, ylist, **kwargs):
-        for i, x in enumerate(xlist):
-            xlist[i] = self.origin.x + (self.size.w * x)
-        for i, y in enumerate(ylist):
-            ylist[i] = self.origin.y + (self.size.h * y)
-        plot.line(xlist, ylist, **kwargs)
+        plot.line(self.origin.x + (self.size.w * np.asarray(xlist)),
+                  self.origin.y + (self.size.h * np.asarray(ylist)), **kwargs)
+
+    def symbol(self, plot, points, rot, **kwargs):
+        """
+        Draw a unit-square symbol rotated by rot. A BatchPlot defers the transform so
+        that all instances can be done together, otherwise it is done here.
+        """
+        if (isinstance(plot, BatchPlot)):
+            plot.symbol(points, self, rot, **kwargs)
+        else:
+            xs, ys = transform_symbol(points, [self.origin.x], [self.origin.y],
+                                        [self.size.w], [self.size.h], [rot])
+            plot.line(xs[0], ys[0], **kwargs)
 
     def circle(self, plot, dia, **kwargs):
         """
@@ -215,6 +667,172 @@ class Plottable():
         plot.ellipse(x=self.origin.x + (self.size.w * 0.5), y=self.origin.y + (self.size.h * 0.5),
         width=mindim*dia, height=mindim*dia, **kwargs)
 
+# --------------------------------------------------------------------------------------
+# BATCHED PLOTTING CLASS
+# --------------------------------------------------------------------------------------
+
+class BatchPlot():
+    '''
+    Stands in for a Bokeh figure while the components are drawn. Rather than a glyph
+    renderer per call, the geometry is collected into columnar buffers (one per glyph
+    type and style) and flush() then draws the whole board with a handful of glyphs,
+    each backed by a single ColumnDataSource.
+
+    The columns are float32 numpy arrays, which Bokeh sends as base64 binary, and all
+    the lines of a style are a single NaN separated line (a multi_line would send
+    each line as an array of its own).
+    '''
+    DTYPE = np.float32
+    def __init__(self):
+        self.groups = {}
+        self.symbols = {}
+
+    def _buffer(self, glyph, kwargs, columns):
+        """
+        Return the column buffer for this glyph and style, creating it if needed.
+        """
+        key = (glyph, tuple(sorted(kwargs.items())))
+        if (not key in self.groups):
+            self.groups[key] = { col: [] for col in columns }
+        return self.groups[key]
+
+    def block(self, x, y, width, height, **kwargs):
+        buf = self._buffer("block", kwargs, ("x", "y", "width", "height"))
+        buf["x"].append(x)
+        buf["y"].append(y)
+        buf["width"].append(width)
+        buf["height"].append(height)
+
+    def line(self, xlist, ylist, **kwargs):
+        buf = self._buffer("line", kwargs, ("x", "y"))
+        buf["x"].append(np.append(np.asarray(xlist, dtype=self.DTYPE), np.nan))
+        buf["y"].append(np.append(np.asarray(ylist, dtype=self.DTYPE), np.nan))
+
+    def symbol(self, points, plotter, rot, **kwargs):
+        """
+        Queue a symbol, these are transformed together (per symbol) at flush() time.
+        """
+        key = (id(points), tuple(sorted(kwargs.items())))
+        if (not key in self.symbols):
+            self.symbols[key] = (points, kwargs, { col: [] for col in ("x", "y", "w", "h", "rot") })
+        buf = self.symbols[key][2]
+        buf["x"].append(plotter.origin.x)
+        buf["y"].append(plotter.origin.y)
+        buf["w"].append(plotter.size.w)
+        buf["h"].append(plotter.size.h)
+        buf["rot"].append(rot)
+
+    def ellipse(self, x, y, width, height, **kwargs):
+        buf = self._buffer("ellipse", kwargs, ("x", "y", "width", "height"))
+        buf["x"].append(x)
+        buf["y"].append(y)
+        buf["width"].append(width)
+        buf["height"].append(height)
+
+    def flush(self, plot):
+        """
+        Draw everything collected so far onto the real plot, one glyph per buffer,
+        and return the list of renderers.
+        """
+        from bokeh.models import ColumnDataSource
+
+        # Each symbol is placed on all of its components in one go, and the rows
+        # (each ended with a NaN) are then just one more piece of line...
+        for points, kwargs, buf in self.symbols.values():
+            xs, ys = transform_symbol(points, buf["x"], buf["y"], buf["w"], buf["h"], buf["rot"])
+            gap = np.full((len(xs), 1), np.nan)
+            lines = self._buffer("line", kwargs, ("x", "y"))
+            lines["x"].append(np.hstack([ xs, gap ]).astype(self.DTYPE).ravel())
+            lines["y"].append(np.hstack([ ys, gap ]).astype(self.DTYPE).ravel())
+        self.symbols = {}
+
+        renderers = []
+        for (glyph, style), columns in self.groups.items():
+            if (glyph == "line"):
+                data = { col: np.concatenate(pieces) for col, pieces in columns.items() }
+            else:
+                data = { col: np.asarray(values, dtype=self.DTYPE) for col, values in columns.items() }
+            source = ColumnDataSource(data=data)
+            fields = { col: col for col in columns }
+            renderers.append(getattr(plot, glyph)(source=source, **fields, **dict(style)))
+        self.groups = {}
+        return renderers
+
+# --------------------------------------------------------------------------------------
+# DENSITY VIEW
+# --------------------------------------------------------------------------------------
+
+#
+# Past a few thousand parts the individual outlines and symbols are unreadable (and
+# slow to build), so big boards are drawn as a heatmap instead: the courtyard area of
+# each component binned at its centre, as a single image over the board outline.
+#
+
+# Boards with more components than this are drawn as a heatmap
+DENSITY_THRESHOLD = 5000
+
+# The number of bins along the longer side of the heatmap
+DENSITY_BINS = 128
+
+def density_grids(table, bins=DENSITY_BINS):
+    """
+    Bin the courtyard areas of the components at their centres with a 2D histogram,
+    as a fraction of the area of each bin. Returns the (x, y, width, height) covered
+    and a dict of grids (rows in y) for all the components, each layer, and each type
+    (as per getName()) on each layer.
+    """
+    x = (table.left + table.right) / 2
+    y = (table.top + table.bottom) / 2
+    area = np.abs((table.right - table.left) * (table.bottom - table.top))
+
+    x0, y0 = float(np.min(table.left)), float(np.min(table.top))
+    width, height = float(np.max(table.right)) - x0, float(np.max(table.bottom)) - y0
+    size = max(width, height, 1e-6) / bins
+    nx = max(int(math.ceil(width / size)), 1)
+    ny = max(int(math.ceil(height / size)), 1)
+    ix = np.clip(((x - x0) / size).astype(np.int64), 0, nx - 1)
+    iy = np.clip(((y - y0) / size).astype(np.int64), 0, ny - 1)
+
+    # One bincount does every layer and type at once
+    nlayers, nclasses = len(table.layer.categories), len(table.classes)
+    group = table.layer.codes.astype(np.int64) * nclasses + table.cls
+    counts = np.bincount((group * ny + iy) * nx + ix, weights=area, minlength=nlayers * nclasses * ny * nx)
+    grids = counts.reshape(nlayers, nclasses, ny, nx) / (size * size)
+
+    result = { "All": grids.sum(axis=(0, 1)) }
+    for l, layer in enumerate(table.layer.categories):
+        result[layer] = grids[l].sum(axis=0)
+        for c, objclass in enumerate(table.classes):
+            if (grids[l, c].any()):
+                result[layer + " " + objclass.__name__] = grids[l, c]
+    return (x0, y0, nx * size, ny * size), result
+
+def draw_density(plot, table, bins=DENSITY_BINS):
+    """
+    Draw the density_grids() of the components as an image on the plot, returning a
+    Select to choose between all the components, a layer, or a type on a layer.
+    """
+    from bokeh.models import ColorBar, ColumnDataSource, CustomJS, LinearColorMapper, Select
+    from bokeh.palettes import Viridis256
+
+    (x, y, width, height), grids = density_grids(table, bins)
+
+    # Empty bins are left transparent so the board shows through
+    images = { name: np.where(g > 0, g, np.nan).astype(np.float32) for name, g in grids.items() }
+    highs = { name: float(g.max()) or 1.0 for name, g in grids.items() }
+
+    mapper = LinearColorMapper(palette=Viridis256, low=0, high=highs["All"], nan_color=(0, 0, 0, 0))
+    source = ColumnDataSource(data={ "image": [ images["All"] ] })
+    plot.image(image="image", x=x, y=y, dw=width, dh=height, source=source, color_mapper=mapper, global_alpha=0.85)
+    plot.add_layout(ColorBar(color_mapper=mapper, title="Courtyard coverage"), "right")
+
+    select = Select(title="Components", value="All", options=list(images))
+    select.js_on_change("value", CustomJS(args=dict(source=source, images=images, highs=highs, mapper=mapper), code="""
+        source.data = { image: [ images[cb_obj.value] ] };
+        mapper.high = highs[cb_obj.value];
+    """))
+    return select
+
 # --------------------------------------------------------------------------------------
 # CUSTOM EXCEPTION
 # --------------------------------------------------------------------------------------
@@ -276,17 +894,27 @@ class Component():
         """
         return type(self).__name__
 
+    # The unit of the value, for classes whose values are normalised in the BOM key
+    VALUE_UNIT = None
+
     def getBOMKey(self):
         """
-        Return a key that uniquely identifies a BOM item
+        Return a key that uniquely identifies a BOM item, equivalent values (such as
+        0.1uF and 100n on a capacitor) give the same key.
         """
-        return "//".join([self.value, self.footprint, self.lcsc])
+        value = self.value if (self.VALUE_UNIT is None) else canonical_value(self.value, self.VALUE_UNIT)
+        return "//".join([value, self.footprint, self.lcsc])
+
+    # The unit-square symbol (if any) drawn over the outline, see symbol()
+    SYMBOL = None
 
     def draw(self, plot):
         """
-        Draw the component, just the ouline for the base Component.
+        Draw the component, the outline plus the symbol for the class (if it has one).
         """
         self.plotter.outline(plot)
+        if (self.SYMBOL is not None):
+            self.plotter.symbol(plot, self.SYMBOL, self.rot, color="yellow", line_width=1)
 
 # --------------------------------------------------------------------------------------
 # COMPONENT SUBCLASES
@@ -299,12 +927,9 @@ class Unknown(Component):
 
 
 class Resistor(Component):
-    def draw(self, plot):
-        super().draw(plot)
-        self.plotter.line(plot, 
-                    [0.1, 0.3, 0.3, 0.7, 0.7, 0.9, nan, 0.7, 0.7, 0.3, 0.3],
-                    [0.5, 0.5, 0.2, 0.2, 0.5, 0.5, nan, 0.5, 0.8, 0.8, 0.5],
-                    color="yellow", line_width=1)
+    VALUE_UNIT = "Ω"
+    SYMBOL = symbol([0.1, 0.3, 0.3, 0.7, 0.7, 0.9, nan, 0.7, 0.7, 0.3, 0.3],
+                    [0.5, 0.5, 0.2, 0.2, 0.5, 0.5, nan, 0.5, 0.8, 0.8, 0.5])
 
 class FerriteBead(Resistor):
     def draw(self, plot):
@@ -314,277 +939,1203 @@ class FerriteBead(Resistor):
                     fill_alpha=0.0, line_alpha=0.0, hatch_scale=3)
 
 class Capacitor(Component):
-    def draw(self, plot):
-        super().draw(plot)
-        self.plotter.line(plot, 
-                    [0.1, 0.4, nan, 0.4, 0.4, nan, 0.6, 0.6, nan, 0.6, 0.9],
-                    [0.5, 0.5, nan, 0.2, 0.8, nan, 0.2, 0.8, nan, 0.5, 0.5],
-                    color="yellow", line_width=1)
+    VALUE_UNIT = "F"
+    SYMBOL = symbol([0.1, 0.4, nan, 0.4, 0.4, nan, 0.6, 0.6, nan, 0.6, 0.9],
+                    [0.5, 0.5, nan, 0.2, 0.8, nan, 0.2, 0.8, nan, 0.5, 0.5])
+
+#
+# The inductor symbol is three humps between two leads
+#
+def inductor_symbol():
+    t = np.linspace(np.pi, 0, 9)
+    xx = [ 0.1, 0.2 ]
+    yy = [ 0.5, 0.5 ]
+    for centre in [ 0.3, 0.5, 0.7 ]:
+        xx += (centre - 0.1 * np.cos(t)).tolist()
+        yy += (0.5 - 0.15 * np.sin(t)).tolist()
+    return symbol(xx + [ 0.9 ], yy + [ 0.5 ])
+
+class Inductor(Component):
+    VALUE_UNIT = "H"
+    SYMBOL = inductor_symbol()
 
 class Transistor(Component):
     def draw(self, plot):
         super().draw(plot)
         self.plotter.circle(plot, 0.9, color="yellow", line_width=1);
 
-class IC(Component):
-    def draw(self, plot):
-        super().draw(plot)
-
-        xx = [ 0.3, 0.7, 0.7, 0.3, 0.3, nan ];      # Main box
-        yy = [ 0.2, 0.2, 0.8, 0.8, 0.2, nan ];      # Main box
-        for i in [ 0.3, 0.4, 0.5, 0.6, 0.7 ]:       # Add legs to both sides
-            xx += [ 0.1, 0.3, nan ]
-            yy += [ i, i, nan ]
-            xx += [ 0.7, 0.9, nan ]
-            yy += [ i, i, nan ]
+#
+# The IC symbol is a box with five legs on each side
+#
+def ic_symbol():
+    xx = [ 0.3, 0.7, 0.7, 0.3, 0.3, nan ];      # Main box
+    yy = [ 0.2, 0.2, 0.8, 0.8, 0.2, nan ];      # Main box
+    for i in [ 0.3, 0.4, 0.5, 0.6, 0.7 ]:       # Add legs to both sides
+        xx += [ 0.1, 0.3, nan ]
+        yy += [ i, i, nan ]
+        xx += [ 0.7, 0.9, nan ]
+        yy += [ i, i, nan ]
+    return symbol(xx, yy)
 
-        self.plotter.line(plot, xx, yy, color="yellow", line_width=1)
+class IC(Component):
+    SYMBOL = ic_symbol()
 
 
 class Diode(Component):
-    def draw(self, plot):
-        super().draw(plot)
-        self.plotter.line(plot,
-                    [0.1, 0.3, 0.3, 0.7, 0.3, 0.3, nan, 0.7, 0.7, nan, 0.7, 0.9], 
-                    [0.5, 0.5, 0.3, 0.5, 0.7, 0.5, nan, 0.3, 0.7, nan, 0.5, 0.5],
-                    color="yellow", line_width=1)
+    SYMBOL = symbol([0.1, 0.3, 0.3, 0.7, 0.3, 0.3, nan, 0.7, 0.7, nan, 0.7, 0.9],
+                    [0.5, 0.5, 0.3, 0.5, 0.7, 0.5, nan, 0.3, 0.7, nan, 0.5, 0.5])
 
 # --------------------------------------------------------------------------------------
-# TEST CASES
+# COMPONENT TABLE
 # --------------------------------------------------------------------------------------
 
-class Dummy():
-    """
-    A dummy object to help with unit testing, we can manually set attributes to
-    simulate an object that will have methods called.
-    """
-    def __init__(self):
-        pass
+#
+# Support automatically mapping from reference to object type...
+#
+CLASS_MAPPING = { "FB": FerriteBead, "R": Resistor, "C": Capacitor, "L": Inductor,
+                  "Q": Transistor, "U": IC, "D": Diode }
 
+# The fields each component needs (the columns of components.csv)
+COMPONENT_FIELDS = [ "ref", "value", "layer", "footprint", "lcsc", "x", "y", "rot",
+                        "top", "left", "bottom", "right" ]
 
-class TestSupportingFunctions(unittest.TestCase):
-    
-    def test_kicad_num(self):
-        self.assertEqual(kicad_num("123450000"), 123.45)
-        self.assertEqual(kicad_num("0"), 0.00)
-        self.assertEqual(kicad_num("-100500000"), -100.5)
-
-    def test_reftype(self):
-        self.assertEqual(reftype("R100"), "R")
-        self.assertEqual(reftype("FB101"), "FB")
-        self.assertEqual(reftype("q100"), "Q")
-        self.assertEqual(reftype("+45"), "+45")
-        self.assertEqual(reftype("ABC"), "ABC")
-        self.assertEqual(reftype("XY99Z"), "XY")
-
-    def test_rotdb(self):
-        rdb = RotDB("rotations.cf")
-        self.assertEqual(rdb.possible_rotate("non-matching-footprint"), 0)
-        self.assertEqual(rdb.possible_rotate("SOT-23"), 180)
-        self.assertEqual(rdb.possible_rotate("TDK_ATB"), 90)
-
-    def test_board(self):
-        board = Board()
-        board.addPoint(200, 400)
-        board.addPoint(200, 500)
-        board.addPoint(300, 500)
-        board.addPoint(300, 400)
-        board.shiftToZero()
-        self.assertEqual(board.xlist, [0, 0, 100, 100])
-        self.assertEqual(board.ylist, [0, 100, 100, 0])
-
-        def dummy_patch(xl, yl, **kwargs):
-            self.assertEqual(xl, [0, 0, 100, 100, 0])
-            self.assertEqual(yl, [0, 100, 100, 0, 0])
-            self.assertEqual(kwargs["foo"], 100)
-            self.assertEqual(kwargs["bar"], 200)
-
-        plot = Dummy()
-        setattr(plot, "patch", dummy_patch)
-        board.draw(plot, foo=100, bar=200)
-
-    def test_component(self):
-        # Create Dummy() board for minx/miny values
-        board = Dummy()
-        setattr(board, "minx", 100)
-        setattr(board, "miny", 200)
-        fields = { "ref": "R100", "value": "1k", "layer": "F.Cu", "footprint": "0402", "lcsc": "", 
-                    "x": str(500*1000000), "y": str(300*1000000), "rot": str(0),
-                    "left": str(480*1000000), "top": str(290*1000000), 
-                    "right": str(520*1000000), "bottom": str(310*1000000) }
-        # Test Component is created...
-        comp = Component(board, fields)
-        self.assertIsNotNone(comp)
-        # Check the re-alignment to the board is ok...
-        self.assertEqual(comp.plotter.origin.x, 380)
-        self.assertEqual(comp.plotter.origin.y, 90)
-        self.assertEqual(comp.plotter.size.w, 40)
-        self.assertEqual(comp.plotter.size.h, 20)
-        # Check it fails if fields are wrong...
-        del fields["footprint"]
-        with self.assertRaises(InvalidData):
-            comp = Component(board, fields)
+class Categorical():
+    '''
+    A column of interned strings, each distinct string is held once in categories and
+    the rows are just an array of codes into it.
+    '''
+    __slots__ = ("codes", "categories")
 
-# --------------------------------------------------------------------------------------
-# MAIN
-# --------------------------------------------------------------------------------------
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
 
-def main():
-    # First process the command line argument...
-    # (1) command <path_to_input_file_dir>
-    # (2) command -T [any other test arguments]
-    if (len(sys.argv) < 2):
-        print ("Usage: " + sys.argv[0] + " <-T [test_args] | path_to_input_file_dir>")
-        sys.exit(1)
+    @classmethod
+    def fromValues(cls, values):
+        """
+        Build the column from a sequence of strings, categories are in the order they
+        are first seen.
+        """
+        index = {}
+        codes = np.fromiter((index.setdefault(v, len(index)) for v in values), dtype=np.int32, count=len(values))
+        return cls(codes, list(index))
 
-    # Kick off the unit tests...
-    if (sys.argv[1] == "-T"):
-        del sys.argv[1]             # -T confuses unittest!
-        unittest.main()
-        sys.exit(0)
+    def __getitem__(self, i):
+        return self.categories[self.codes[i]]
 
-    # Otherwise we are running against the input dir...
-    file_path = sys.argv[1]
+    def __len__(self):
+        return len(self.codes)
 
-    if (not os.path.isdir(file_path)):
-        print ("Error: " + path + " is not a directory.")
-        sys.exit(1)
+    def __iter__(self):
+        categories = self.categories
+        return (categories[code] for code in self.codes.tolist())
 
-    board_file = os.path.join(file_path, "board.csv")
-    component_file = os.path.join(file_path, "components.csv")
+class ComponentView():
+    '''
+    A lightweight view of a single row of a ComponentTable. A view class is made for
+    each Component subclass (see view_class()) so that the usual Component methods,
+    such as getName(), getBOMKey() and draw(), work on the row without a full object.
+    '''
+    __slots__ = ("table", "index")
 
-    if (not os.path.isfile(board_file)):
-        print ("Error: board.csv not found in " + path)
-        sys.exit(1)
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
 
-    if (not os.path.isfile(component_file)):
-        print ("Error: components.csv not found in " + path)
-        sys.exit(1)
+    ref = property(lambda self: self.table.ref[self.index])
+    value = property(lambda self: self.table.value[self.index])
+    layer = property(lambda self: self.table.layer[self.index])
+    footprint = property(lambda self: self.table.footprint[self.index])
+    lcsc = property(lambda self: self.table.lcsc[self.index])
+    x = property(lambda self: float(self.table.x[self.index]))
+    y = property(lambda self: -float(self.table.y[self.index]))
+    rot = property(lambda self: float(self.table.rot[self.index]))
 
-    #
-    # Create the rotations database object...
-    #
-    rotdb = RotDB("rotations.cf")
+    @property
+    def plotter(self):
+        t = self.table
+        i = self.index
+        return Plottable(float(t.left[i]), float(t.top[i]),
+                            float(t.right[i] - t.left[i]), float(t.bottom[i] - t.top[i]))
 
-    #
-    # Support automatically mapping from reference to object type...
-    mapping = { "FB": FerriteBead, "R": Resistor, "C": Capacitor, 
-                "Q": Transistor, "U": IC, "D": Diode }
+@functools.lru_cache(maxsize=None)
+def view_class(objclass):
+    """
+    Return the view class for a Component subclass (keeping the same name, so that
+    getName() is unchanged).
+    """
+    return type(objclass.__name__, (ComponentView, objclass), { "__slots__": () })
 
-    #
-    # Now create the Board object...
-    #
-    board = Board()
-    with open(board_file) as bfile:
-    # with open("/home/essele/kicad/sample/board.csv") as bfile:
-        reader = csv.DictReader(bfile)
-        for row in reader:
-            board.addPoint(kicad_num(row["x"]), kicad_num(row["y"]))
+class ComponentTable():
+    '''
+    A columnar store of all the components on a board. Co-ordinates, courtyard boxes
+    and rotations are NumPy arrays and the strings are Categorical columns, so a board
+    with many thousands of placements costs a handful of arrays rather than several
+    objects per component. The BOM, CPL and pandas stages all read from the columns.
+    '''
+    def __init__(self, board, columns, mapping=CLASS_MAPPING):
+        """
+        Build the table from a dict of columns (with the same names and units as
+        components.csv). String columns may already be Categorical.
+        """
+        for f in COMPONENT_FIELDS:
+            if not f in columns:
+                raise InvalidData(f, "Field missing from supplied data")
 
-        board.shiftToZero()
+        for f in [ "ref", "value", "layer", "footprint", "lcsc" ]:
+            col = columns[f]
+            setattr(self, f, col if (isinstance(col, Categorical)) else Categorical.fromValues(col))
 
-    #
-    # Draw the board outline...
-    #
+        # Position stays in KiCad units (as per Component)...
+        self.x = np.asarray(columns["x"], dtype=np.float64)
+        self.y = np.asarray(columns["y"], dtype=np.float64)
+        self.rot = np.asarray(columns["rot"], dtype=np.float64)
 
-    # create a new plot with a title and axis labels
-    v1 = figure(title="PCB layout", x_axis_label="x (mm)", y_axis_label="y (mm)", match_aspect=True)
-    board.draw(v1, line_width=2, fill_color="#002d04", line_color="black")
+        # The courtyard is converted to mm, relative to the board...
+        self.left = np.asarray(columns["left"], dtype=np.float64) / 1000000.0 - board.minx
+        self.top = np.asarray(columns["top"], dtype=np.float64) / 1000000.0 - board.miny
+        self.right = np.asarray(columns["right"], dtype=np.float64) / 1000000.0 - board.minx
+        self.bottom = np.asarray(columns["bottom"], dtype=np.float64) / 1000000.0 - board.miny
 
-    #
-    # Now run through the components... prepare the visualations as well as the BOM/CPL info
-    #
+        # The Component subclass for each row, as a code into self.classes
+        self.classes = []
+        codes = {}
+        types, inverse = np.unique(reftypes(self.ref.categories).astype(str), return_inverse=True)
+        typecode = np.array([ codes.setdefault(mapping.get(t, Unknown), len(codes)) for t in types.tolist() ],
+                                dtype=np.int8)
+        self.cls = typecode[inverse.reshape(-1)][self.ref.codes] if (len(types)) else np.zeros(0, dtype=np.int8)
+        self.classes = list(codes)
 
-    # We will build a BOM dict as we go, combining like elements...
-    bom = {}
+    @classmethod
+    def fromRecords(cls, board, records, mapping=CLASS_MAPPING):
+        """
+        Build the table from a list of dicts (such as the rows of components.csv)
+        """
+        if (records):
+            for f in COMPONENT_FIELDS:
+                if not f in records[0]:
+                    raise InvalidData(f, "Field missing from supplied data")
+        return cls(board, { f: [ r[f] for r in records ] for f in COMPONENT_FIELDS }, mapping)
 
-    # Placement will be a list of dicts for output...
-    placement = []
+    def __len__(self):
+        return len(self.x)
 
-    # Data for pandas and reporting
-    data = []
+    def view(self, i):
+        """
+        Return the view (behaving as the right Component subclass) of row i
+        """
+        return view_class(self.classes[self.cls[i]])(self, i)
 
-    with open(component_file) as cfile:
-    # with open("/home/essele/kicad/sample/components.csv") as cfile:
-        reader = csv.DictReader(cfile)
-        for row in reader:
-            # Get the reference type from the ref (i.e. R from R100)
-            rt = reftype(row["ref"]);
+    def __iter__(self):
+        return (self.view(i) for i in range(len(self)))
 
-            # Get the Class for that type of ref, otherwise an Unknown
-            objclass = mapping.get(rt, Unknown)
+    def bom(self):
+        """
+        Build the BOM dict (as per build_bom) from the columns. Rows are grouped by
+        their codes first so getBOMKey() is only called once per distinct part.
+        """
+        bom = {}
+        if (len(self) == 0):
+            return bom
 
-            # Instantiate the object of the right class...
-            c = objclass(board, row)
+        combo = np.stack([ self.cls, self.value.codes, self.footprint.codes, self.lcsc.codes ], axis=1)
+        uniq, first, inverse = np.unique(combo, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
 
-            # And draw the component for the board visualisation
-            c.draw(v1)
+        # The rows for each distinct combination, in row order...
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.concatenate([ [0], np.cumsum(np.bincount(inverse, minlength=len(uniq))) ])
 
-            # Now prepare the BOM info ... combine like components ...
+        rows = {}
+        for u in np.argsort(first).tolist():
+            c = self.view(int(first[u]))
             key = c.getBOMKey()
             if (not key in bom):
-                bom[key] = { "Component": c.value, "Footprint": c.footprint, "JLCPCB": c.lcsc, "refs": [ c.ref ] }
-            else:
-                bom[key]["refs"].append(c.ref)
+                bom[key] = { "Component": c.value, "Footprint": c.footprint, "JLCPCB": c.lcsc }
+                rows[key] = []
+            rows[key].append(order[bounds[u]:bounds[u+1]])
 
-            # Now we can work on the placement information...
-            layername = "top" if (c.layer == "F.Cu") else "bottom"
-            rotation = (c.rot + rotdb.possible_rotate(c.footprint)) % 360
+        refs = self.ref.categories
+        codes = self.ref.codes
+        for key, parts in rows.items():
+            index = parts[0] if (len(parts) == 1) else np.sort(np.concatenate(parts))
+            bom[key]["refs"] = [ refs[code] for code in codes[index].tolist() ]
+        return bom
 
-            placement.append({
-                "Designator":   c.ref,
-                "Mid X":        c.x / 1000000.0,
-                "Mid Y":        -c.y / 1000000.0,        # y direction is reversed
-                "Layer":        layername,
-                "Rotation":     rotation,
-            })
+    def bomKeys(self):
+        """
+        Return the BOM key (as per getBOMKey()) of each row as a Categorical column,
+        getBOMKey() is only called once per distinct part.
+        """
+        if (len(self) == 0):
+            return Categorical(np.zeros(0, dtype=np.int32), [])
+        # The four codes as one integer (much faster to unique than rows)
+        columns = [ self.cls, self.value.codes, self.footprint.codes, self.lcsc.codes ]
+        combo = np.ravel_multi_index(columns, [ int(c.max()) + 1 for c in columns ])
+        uniq, first, inverse = np.unique(combo, return_index=True, return_inverse=True)
+        # Keys are numbered in the order they first appear (as the BOM lines are)
+        index = {}
+        codes = np.zeros(len(uniq), dtype=np.int32)
+        for u in np.argsort(first).tolist():
+            codes[u] = index.setdefault(self.view(int(first[u])).getBOMKey(), len(index))
+        return Categorical(codes[inverse.reshape(-1)], list(index))
 
-            data.append({
-                "Reference":    c.ref,
-                "Layer":        c.layer,
-                "Type":         c.getName(),
-                "Value":        c.value,
-                "LCSC":         c.lcsc,
-            })
+    def rotations(self, rotdb):
+        """
+        Return the output rotation of each row, the rotations database is only
+        consulted once per distinct footprint.
+        """
+        delta = np.array([ rotdb.possible_rotate(fp) for fp in self.footprint.categories ], dtype=np.float64)
+        return (self.rot + delta[self.footprint.codes]) % 360
 
+    def placementRows(self, rotdb, order=None):
+        """
+        Generate the placement information (as per build_placement) from the columns,
+        in row order or the order given (an array of rows, see placement_order()).
+        """
+        layername = [ "top" if (layer == "F.Cu") else "bottom" for layer in self.layer.categories ]
+        rows = slice(None) if (order is None) else order
+        refs = self.ref.categories
+        for ref, x, y, layer, rotation in zip(self.ref.codes[rows].tolist(), (self.x[rows] / 1000000.0).tolist(),
+                                                (self.y[rows] / 1000000.0).tolist(), self.layer.codes[rows].tolist(),
+                                                self.rotations(rotdb)[rows].tolist()):
+            yield {
+                "Designator":   refs[ref],
+                "Mid X":        x,
+                "Mid Y":        y,
+                "Layer":        layername[layer],
+                "Rotation":     rotation,
+            }
 
-    #
-    # Now we can output the BOM...
-    #
-    with open("out_bom.csv", "w") as bomfile:
-        writer = csv.DictWriter(bomfile, quoting=csv.QUOTE_ALL,
-            fieldnames=["Component", "Designator", "Footprint", "JLCPCB"])
-        writer.writeheader()
-        for key, bominfo in bom.items():
-            # Replace list of refs with comma separated string...
-            bominfo["Designator"] = ",".join(bominfo["refs"])
-            del bominfo["refs"]
-            writer.writerow(bominfo)
+    def dataFrame(self):
+        """
+        Return a pandas dataframe of the components for reporting, the string
+        columns become pandas categoricals sharing our codes.
+        """
+        import pandas as pd
 
-    #
-    # And the placement information
-    #
-    with open("out_cpl.csv", "w") as cplfile:
-        writer = csv.DictWriter(cplfile, quoting=csv.QUOTE_NONNUMERIC,
-            fieldnames=["Designator", "Mid X", "Mid Y", "Layer", "Rotation"])
-        writer.writeheader()
-        for item in placement:
-            writer.writerow(item)
+        def categorical(col):
+            return pd.Categorical.from_codes(col.codes, col.categories)
+
+        return pd.DataFrame({
+            "Reference":    categorical(self.ref),
+            "Layer":        categorical(self.layer),
+            "Type":         pd.Categorical.from_codes(self.cls, [ c.__name__ for c in self.classes ]),
+            "Value":        categorical(self.value),
+            "LCSC":         categorical(self.lcsc),
+        })
+
+# --------------------------------------------------------------------------------------
+# PROFILING
+# --------------------------------------------------------------------------------------
+
+#
+# Instrumentation for --profile. The phases of a run are wrapped in profiler.phase()
+# and the per-call timings come from profiler.timed() wrappers. The NullProfiler used
+# when profiling is off hands back nullcontext() and the unwrapped functions, so the
+# cost when off is next to nothing.
+#
+
+class NullProfiler():
+    """
+    Stands in for a Profiler when profiling is off.
+    """
+    enabled = False
+
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+    def timed(self, name, func, key=None):
+        return func
+
+NULL_PROFILER = NullProfiler()
+
+class Profiler():
+    """
+    Collects the time (and optionally memory) of each phase of a run, and counters
+    for individual calls such as Component.draw and RotDB.possible_rotate keyed by
+    component or footprint. Optionally runs cProfile over the whole run as well.
+    """
+    enabled = True
+
+    def __init__(self, cprofile=False, memory=False):
+        self.start = time.perf_counter()
+        self.phases = []
+        self.calls = {}
+        self.keys = {}
+        self.memory = memory
+        self.cprofile = None
+        if (cprofile):
+            import cProfile
+            self.cprofile = cProfile.Profile()
+        if (self.memory):
+            import tracemalloc
+            tracemalloc.start()
+        if (self.cprofile is not None):
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time the body of the with statement as the named phase.
+        """
+        if (self.memory):
+            import tracemalloc
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = { "name": name, "seconds": time.perf_counter() - start }
+            if (self.memory):
+                current, peak = tracemalloc.get_traced_memory()
+                entry["memory_delta"] = current - before
+                entry["memory_peak"] = peak
+            self.phases.append(entry)
+
+    def timed(self, name, func, key=None):
+        """
+        Return a wrapper for func that counts and times each call under name, and per
+        key(*args) if a key function is given.
+        """
+        counter = self.calls.setdefault(name, [ 0, 0.0 ])
+        per_key = self.keys.setdefault(name, {})
+        clock = time.perf_counter
+
+        def wrapper(*args):
+            start = clock()
+            result = func(*args)
+            elapsed = clock() - start
+            counter[0] += 1
+            counter[1] += elapsed
+            if (key is not None):
+                k = key(*args)
+                entry = per_key.get(k)
+                if (entry is None):
+                    per_key[k] = [ 1, elapsed ]
+                else:
+                    entry[0] += 1
+                    entry[1] += elapsed
+            return result
+        return wrapper
+
+    def stop(self):
+        """
+        Stop any cProfile/tracemalloc collection.
+        """
+        if (self.cprofile is not None):
+            self.cprofile.disable()
+        if (self.memory):
+            import tracemalloc
+            if (tracemalloc.is_tracing()):
+                tracemalloc.stop()
+
+    def slowest(self, name, top, group=None):
+        """
+        Return the top slowest keys for a call name, optionally grouping the keys
+        with group(key) first (e.g. components by footprint).
+        """
+        totals = {}
+        for k, (count, seconds) in self.keys.get(name, {}).items():
+            g = group(k) if (group is not None) else k
+            entry = totals.setdefault(g, [ 0, 0.0 ])
+            entry[0] += count
+            entry[1] += seconds
+        ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return [ { "key": k, "calls": count, "seconds": seconds } for k, (count, seconds) in ranked ]
+
+    def report(self, top=10, rotdb=None):
+        """
+        Return the machine readable report as a dict (suitable for JSON).
+        """
+        report = {
+            "total_seconds":    time.perf_counter() - self.start,
+            "phases":           self.phases,
+            "calls":            { name: { "calls": count, "seconds": seconds }
+                                    for name, (count, seconds) in self.calls.items() },
+            "slowest_components": self.slowest("Component.draw", top),
+            "slowest_footprints": self.slowest("Component.draw", top, group=lambda k: k[1]),
+            "slowest_rotations":  self.slowest("RotDB.possible_rotate", top),
+        }
+        for entry in report["slowest_components"]:
+            entry["key"] = entry["key"][0]
+        if (rotdb is not None):
+            info = rotdb.cache_info()
+            report["rotdb_cache"] = { "hits": info.hits, "misses": info.misses, "size": info.currsize }
+        if (self.cprofile is not None):
+            import pstats
+            stats = pstats.Stats(self.cprofile)
+            ranked = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            report["cprofile"] = [ { "function": "%s:%d(%s)" % func, "calls": nc, "cumulative": ct }
+                                    for func, (cc, nc, tt, ct, callers) in ranked ]
+        return report
+
+    def summary(self, report):
+        """
+        Return a human readable summary of a report.
+        """
+        lines = [ "Profile: %.3fs total" % report["total_seconds"] ]
+        for phase in report["phases"]:
+            line = "  %-22s %9.4fs" % (phase["name"], phase["seconds"])
+            if ("memory_peak" in phase):
+                line += "  peak %8.1f KiB" % (phase["memory_peak"] / 1024.0)
+            lines.append(line)
+        for name, entry in report["calls"].items():
+            lines.append("  %-22s %9.4fs over %d calls" % (name, entry["seconds"], entry["calls"]))
+        if ("rotdb_cache" in report):
+            lines.append("  RotDB cache: %(hits)d hits, %(misses)d misses" % report["rotdb_cache"])
+        for title, key in [ ("components", "slowest_components"), ("footprints", "slowest_footprints"),
+                            ("rotation lookups", "slowest_rotations") ]:
+            if (report[key]):
+                lines.append("  Slowest %s:" % title)
+                for entry in report[key]:
+                    lines.append("    %-30s %9.6fs (%d calls)" % (entry["key"], entry["seconds"], entry["calls"]))
+        return "\n".join(lines)
+
+# --------------------------------------------------------------------------------------
+# DESIGN CHECKS
+# --------------------------------------------------------------------------------------
+
+#
+# Checks run with --check to catch overlapping courtyards and parts off the edge of
+# the board before the fab does. Courtyards are bucketed in a grid and the board
+# edge is tested with a sweep line, so only nearby pairs are ever compared, rather
+# than every pair.
+#
+
+# Limit on the number of candidate pairs expanded at once (bounds the memory used)
+CHECK_CHUNK = 1 << 20
+
+# Courtyard boxes include the width of the courtyard line, so parts whose courtyards
+# just touch overlap by a line width (0.05mm each side), anything up to this is allowed
+COURTYARD_TOLERANCE = 0.1
+
+def ragged_ranges(starts, ends):
+    """
+    Return (group, position) arrays covering position in range(starts[g], ends[g])
+    for every group g, in group order.
+    """
+    lengths = np.maximum(ends - starts, 0)
+    group = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(len(group)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return group, starts[group] + offsets
+
+def chunked(lengths, limit=CHECK_CHUNK):
+    """
+    Generate slices over lengths so that each covers no more than limit in total
+    (or a single entry if that alone is bigger).
+    """
+    total = np.cumsum(lengths)
+    start = 0
+    while (start < len(lengths)):
+        base = total[start - 1] if (start) else 0
+        end = max(int(np.searchsorted(total, base + limit, side="right")), start + 1)
+        yield slice(start, end)
+        start = end
+
+def points_in_polygon(px, py, xs, ys):
+    """
+    Return a boolean array saying whether each point is inside the polygon (even-odd
+    rule). Points are sorted by y so that each edge is only tested against the points
+    level with it.
+    """
+    px = np.asarray(px, dtype=np.float64)
+    py = np.asarray(py, dtype=np.float64)
+    order = np.argsort(py, kind="stable")
+    sorted_y = py[order]
+
+    x0, y0 = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    flat = y0 != y1
+    x0, y0, x1, y1 = x0[flat], y0[flat], x1[flat], y1[flat]
+
+    # Each edge crosses the horizontal rays of the points with y in [low, high)
+    starts = np.searchsorted(sorted_y, np.minimum(y0, y1), side="left")
+    ends = np.searchsorted(sorted_y, np.maximum(y0, y1), side="left")
+
+    crossings = np.zeros(len(px), dtype=np.int64)
+    for part in chunked(ends - starts):
+        edge, pos = ragged_ranges(starts[part], ends[part])
+        edge += part.start
+        point = order[pos]
+        cross = x0[edge] + (py[point] - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+        crossings += np.bincount(point[px[point] < cross], minlength=len(px))
+    return (crossings % 2) == 1
+
+def courtyard_overlaps(table, tolerance=COURTYARD_TOLERANCE):
+    """
+    Return an (n, 2) array of the row pairs of the table whose courtyards overlap
+    by more than tolerance (mm) on the same layer, each pair in row order.
+    """
+    n = len(table)
+    if (n < 2):
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # Shrinking each box by half the tolerance on every side turns "overlap by more
+    # than tolerance" into a plain overlap, boxes with nothing left can't overlap...
+    left = table.left + tolerance / 2
+    right = table.right - tolerance / 2
+    top = table.top + tolerance / 2
+    bottom = table.bottom - tolerance / 2
+    rows = np.flatnonzero((left < right) & (top < bottom))
+    if (len(rows) < 2):
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # ...then each box goes into every cell of a grid (on both axes, so the shape of
+    # the layout doesn't matter) that it covers, with cells about the size of a part
+    size = max(float(np.median(np.maximum(right[rows] - left[rows], bottom[rows] - top[rows]))), 1e-6)
+    x0 = float(left[rows].min())
+    y0 = float(top[rows].min())
+    cx0 = ((left[rows] - x0) // size).astype(np.int64)
+    cx1 = ((right[rows] - x0) // size).astype(np.int64)
+    cy0 = ((top[rows] - y0) // size).astype(np.int64)
+    cy1 = ((bottom[rows] - y0) // size).astype(np.int64)
+    cols = int(cx1.max()) + 1
+    height = int(cy1.max()) + 1
+
+    wide = cx1 - cx0 + 1
+    box, pos = ragged_ranges(np.zeros(len(rows), dtype=np.int64), wide * (cy1 - cy0 + 1))
+    cell_x = cx0[box] + pos % wide[box]
+    cell_y = cy0[box] + pos // wide[box]
+    key = (table.layer.codes[rows[box]].astype(np.int64) * cols + cell_x) * height + cell_y
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    member = rows[box[order]]
+    corner = (cell_x[order], cell_y[order])
+
+    # Every later entry in the same cell is a candidate, and a pair is only taken in
+    # the cell holding the top left corner of the overlap (so it is found just once)
+    starts = np.arange(1, len(key))
+    ends = np.searchsorted(key, key[:-1], side="right")
+
+    pairs = []
+    for part in chunked(np.maximum(ends - starts, 0)):
+        i, j = ragged_ranges(starts[part], ends[part])
+        i += part.start
+        a = member[i]
+        b = member[j]
+        hit = ((left[b] < right[a]) & (left[a] < right[b]) & (top[a] < bottom[b]) & (top[b] < bottom[a]) &
+                ((np.maximum(left[a], left[b]) - x0) // size == corner[0][i]) &
+                ((np.maximum(top[a], top[b]) - y0) // size == corner[1][i]))
+        pairs.append(np.stack([ np.minimum(a[hit], b[hit]), np.maximum(a[hit], b[hit]) ], axis=1))
+
+    pairs = np.concatenate(pairs) if (pairs) else np.zeros((0, 2), dtype=np.int64)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+def board_placement(board, table, tolerance=COURTYARD_TOLERANCE):
+    """
+    Return two boolean arrays for the rows of the table: whether the centre is off
+    the board, and whether any corner of the courtyard (less half the tolerance, its
+    line width) is.
+    """
+    xs = table.x / 1000000.0 - board.minx
+    ys = table.y / 1000000.0 - board.miny
+    inset = tolerance / 2
+    left, right = table.left + inset, table.right - inset
+    top, bottom = table.top + inset, table.bottom - inset
+    px = np.concatenate([ xs, left, right, right, left ])
+    py = np.concatenate([ ys, top, top, bottom, bottom ])
+    inside = points_in_polygon(px, py, board.xs, board.ys).reshape(5, len(table))
+    return ~inside[0], ~inside[1:].all(axis=0)
+
+def check_board(board, table, tolerance=COURTYARD_TOLERANCE):
+    """
+    Run the design checks, returning a dict of the overlapping pairs of refs, and
+    the refs of parts placed off the board or whose courtyard crosses its edge.
+    """
+    refs = list(table.ref)
+    off, outside = board_placement(board, table, tolerance)
+    return {
+        "overlaps":     [ (refs[a], refs[b]) for a, b in courtyard_overlaps(table, tolerance).tolist() ],
+        "off_board":    [ refs[i] for i in np.flatnonzero(off).tolist() ],
+        "overhanging":  [ refs[i] for i in np.flatnonzero(outside & ~off).tolist() ],
+    }
+
+def check_summary(report):
+    """
+    Return a human readable summary of a check_board() report.
+    """
+    lines = [ "Check: %d overlapping courtyards, %d parts off the board, %d overhanging the edge" %
+                (len(report["overlaps"]), len(report["off_board"]), len(report["overhanging"])) ]
+    lines += [ "  overlap:     %s / %s" % pair for pair in report["overlaps"] ]
+    lines += [ "  off board:   " + ref for ref in report["off_board"] ]
+    lines += [ "  overhanging: " + ref for ref in report["overhanging"] ]
+    return "\n".join(lines)
+
+# --------------------------------------------------------------------------------------
+# PLACEMENT ORDER
+# --------------------------------------------------------------------------------------
+
+#
+# out_cpl.csv normally follows the order of components.csv (KiCad's own order), which
+# leaves the pick and place head criss-crossing the board. --order sorts the placements
+# by layer (top first) and then BOM line (i.e. feeder), and within each group visits
+# the parts as a nearest-neighbour tour, found with a grid index, that is then
+# improved by 2-opt for as long as the time budget allows. Travel is estimated as the
+# straight line distance between consecutive placements.
+#
+
+# The default time (in seconds) spent improving the tours
+ORDER_TIME = 2.0
+
+# How far apart (in tour positions) the two edges swapped by 2-opt may be
+ORDER_WINDOW = 50
+
+def tour_length(xs, ys, order):
+    """
+    Return the length of the path through the points in the given order
+    """
+    if (len(order) < 2):
+        return 0.0
+    return float(np.hypot(np.diff(xs[order]), np.diff(ys[order])).sum())
+
+def grid_tour(xs, ys, start=0):
+    """
+    Return a nearest-neighbour tour (an array of indices) of the points starting from
+    start. The points are bucketed into a grid of about one point per cell and the
+    search widens a ring of cells at a time, the grid is rebuilt coarser as the points
+    are used up so that the search never has to cross too many empty cells.
+    """
+    n = len(xs)
+    tour = np.empty(n, dtype=np.int64)
+    if (n == 0):
+        return tour
+    px = xs.tolist()
+    py = ys.tolist()
+    left = float(xs.min())
+    top = float(ys.min())
+    width = max(float(xs.max()) - left, 1e-9)
+    height = max(float(ys.max()) - top, 1e-9)
+    visited = [ False ] * n
+
+    current = start
+    visited[current] = True
+    tour[0] = current
+    remaining = n - 1
+    rebuild = remaining + 1
+    for k in range(1, n):
+        if (remaining < rebuild):
+            # Cells sized for about one remaining point each...
+            size = max(math.sqrt(width * height / remaining), width / remaining, height / remaining)
+            cols = int(width / size) + 1
+            rows = int(height / size) + 1
+            cells = {}
+            for p in range(n):
+                if (not visited[p]):
+                    cells.setdefault((int((px[p] - left) / size), int((py[p] - top) / size)), []).append(p)
+            rebuild = remaining // 4
+
+        x = px[current]
+        y = py[current]
+        cx = int((x - left) / size)
+        cy = int((y - top) / size)
+        best = -1
+        bestd = math.inf
+        r = 0
+        while True:
+            # Scan the ring of cells r away from the current one
+            for i in range(max(cx - r, 0), min(cx + r, cols - 1) + 1):
+                for j in ((cy - r, cy + r) if (abs(i - cx) != r and r) else range(cy - r, cy + r + 1)):
+                    cell = cells.get((i, j))
+                    if (cell):
+                        for p in cell:
+                            d = (px[p] - x) ** 2 + (py[p] - y) ** 2
+                            if (d < bestd):
+                                best = p
+                                bestd = d
+            # Anything further out is at least r cells away
+            if (best >= 0 and bestd <= (r * size) ** 2):
+                break
+            r += 1
+
+        cells[(int((px[best] - left) / size), int((py[best] - top) / size))].remove(best)
+        visited[best] = True
+        tour[k] = best
+        current = best
+        remaining -= 1
+    return tour
+
+def two_opt(xs, ys, tour, deadline, window=ORDER_WINDOW):
+    """
+    Improve an (open) tour with 2-opt until there is nothing more to gain or the
+    deadline (a time.perf_counter() value) passes. Only edges up to window positions
+    apart are swapped: for each distance the gains are worked out along the whole
+    tour at once, and the best moves that don't overlap are then all made together.
+    """
+    tour = tour.copy()
+    n = len(tour)
+    improved = True
+    while (improved and time.perf_counter() < deadline):
+        improved = False
+        for w in range(2, min(window, n - 2) + 1):
+            if (time.perf_counter() >= deadline):
+                break
+            # Swapping edges a-b and c-d (w apart) for a-c and b-d...
+            a, b, c, d = tour[:n-w-1], tour[1:n-w], tour[w:n-1], tour[w+1:]
+            gain = (np.hypot(xs[a] - xs[b], ys[a] - ys[b]) + np.hypot(xs[c] - xs[d], ys[c] - ys[d]) -
+                    np.hypot(xs[a] - xs[c], ys[a] - ys[c]) - np.hypot(xs[b] - xs[d], ys[b] - ys[d]))
+            moves = np.flatnonzero(gain > 1e-9)
+            if (len(moves) == 0):
+                continue
+
+            # ...which reverses b..c, each move touches positions i to i+w+1
+            used = np.zeros(n, dtype=bool)
+            for i in moves[np.argsort(-gain[moves], kind="stable")].tolist():
+                if (not used[i:i+w+2].any()):
+                    used[i:i+w+2] = True
+                    tour[i+1:i+w+1] = tour[i+1:i+w+1][::-1]
+            improved = True
+    return tour
+
+def placement_order(table, budget=ORDER_TIME):
+    """
+    Work out the order to place the components of a ComponentTable in, grouped by
+    layer and BOM line with each group toured as above, spending up to budget seconds
+    on 2-opt (shared out by group size). Returns the row order and a report of the
+    estimated travel (in mm) before and after.
+    """
+    start = time.perf_counter()
+    xs = table.x / 1000000.0
+    ys = table.y / 1000000.0
+    n = len(table)
+
+    # Top before bottom, then the BOM lines in the order they first appear
+    keys = table.bomKeys()
+    layer = np.array([ layer != "F.Cu" for layer in table.layer.categories ], dtype=np.int64).reshape(-1)
+    group = layer[table.layer.codes] * (len(keys.categories) + 1) + keys.codes if (n) else np.zeros(0, dtype=np.int64)
+    groups, inverse = np.unique(group, return_inverse=True)
+    members = np.argsort(inverse.reshape(-1), kind="stable")
+    bounds = np.concatenate([ [0], np.cumsum(np.bincount(inverse.reshape(-1), minlength=len(groups))) ])
+
+    tours = []
+    nearest = 0.0
+    x, y = (float(xs.min()), float(ys.min())) if (n) else (0.0, 0.0)
+    for g in range(len(groups)):
+        rows = members[bounds[g]:bounds[g+1]]
+        gx = xs[rows]
+        gy = ys[rows]
+        # Start from the part nearest to where the last group finished
+        tour = grid_tour(gx, gy, int(np.argmin(np.hypot(gx - x, gy - y))))
+        nearest += tour_length(gx, gy, tour)
+        deadline = time.perf_counter() + budget * len(rows) / n
+        tour = two_opt(gx, gy, tour, deadline)
+        tours.append(rows[tour])
+        x = float(gx[tour[-1]])
+        y = float(gy[tour[-1]])
+
+    order = np.concatenate(tours) if (tours) else np.zeros(0, dtype=np.int64)
+    report = {
+        "placements":   n,
+        "groups":       len(groups),
+        "before_mm":    tour_length(xs, ys, np.arange(n)),
+        "nearest_mm":   nearest,
+        "after_mm":     tour_length(xs, ys, order),
+        "seconds":      time.perf_counter() - start,
+    }
+    return order, report
+
+def order_summary(report):
+    """
+    Return a printable summary of a placement order report
+    """
+    # Keeping each feeder together can cost travel when a board has few parts per line
+    change = 100.0 * (report["after_mm"] / report["before_mm"] - 1.0) if (report["before_mm"]) else 0.0
+    return ("Placement order: %d placements in %d groups, travel %.0fmm -> %.0fmm (%.0f%% %s) in %.2fs" %
+            (report["placements"], report["groups"], report["before_mm"], report["after_mm"], abs(change),
+                "more" if (change > 0) else "less", report["seconds"]))
+
+# --------------------------------------------------------------------------------------
+# PARTS CATALOGUE
+# --------------------------------------------------------------------------------------
+
+#
+# An offline copy of the JLCPCB parts list (their CSV download) imported into SQLite,
+# so the LCSC numbers in the BOM can be checked (and suggested where missing) without
+# going near the web. LCSC numbers are stored as the integer primary key, and values
+# are indexed by unit, package and magnitude (then basic parts and stock, so the best
+# candidates come straight off the index) so every lookup is a single index probe.
+#
+
+# The names the columns go by in the various JLCPCB/LCSC downloads
+CATALOGUE_COLUMNS = {
+    "lcsc":         [ "lcsc part", "lcsc", "lcsc part #", "lcsc_part" ],
+    "mfr":          [ "mfr.part", "mfr part", "mfr", "manufacturer part" ],
+    "package":      [ "package", "footprint" ],
+    "library":      [ "library type", "library", "type" ],
+    "stock":        [ "stock" ],
+    "description":  [ "description" ],
+}
+
+# Values with units in a part description, e.g. 100nF, 4.7kΩ or 10uH
+DESCRIPTION_VALUE = re.compile(r"(?<![\w.])(\d+(?:\.\d+)?\s*[pnuµμmkKMG]?(?:F|H|Ω))")
+
+# The unit of the values for each reference type
+REFTYPE_UNITS = { "R": "Ω", "C": "F", "L": "H" }
+
+# How many LCSC numbers go into each lookup query (SQLite's variable limit is 999)
+CATALOGUE_BATCH = 500
+
+class Catalogue():
+    """
+    A read only view of an imported parts catalogue.
+    """
+    def __init__(self, filename):
+        if (not os.path.isfile(filename)):
+            raise InvalidData(filename, "Parts catalogue " + filename + " not found")
+        import sqlite3
+        self.db = sqlite3.connect("file:" + filename + "?mode=ro", uri=True)
+
+    def close(self):
+        self.db.close()
+
+    def lookup(self, numbers):
+        """
+        Return a dict of LCSC number (e.g. C1525) to a dict of its details, for the
+        numbers found in the catalogue.
+        """
+        ids = sorted({ lcsc_number(n) for n in numbers } - { None })
+        found = {}
+        for i in range(0, len(ids), CATALOGUE_BATCH):
+            batch = ids[i:i + CATALOGUE_BATCH]
+            rows = self.db.execute("SELECT lcsc, mfr, package, library, stock, description FROM parts "
+                                    "WHERE lcsc IN (%s)" % ",".join("?" * len(batch)), batch)
+            for lcsc, mfr, package, library, stock, description in rows:
+                found["C%d" % lcsc] = { "mfr": mfr, "package": package, "library": library,
+                                        "stock": stock, "description": description }
+        return found
+
+    def suggest(self, value, footprint, unit, limit=3):
+        """
+        Return up to limit LCSC numbers with the same value (in the given unit) and
+        package as the footprint, basic parts first then by stock.
+        """
+        parsed = parse_value(value)
+        if (parsed is None or parsed[1] not in ("", unit)):
+            return []
+        rows = self.db.execute("SELECT lcsc FROM parts WHERE unit = ? AND package = ? AND magnitude = ? "
+                                "ORDER BY basic DESC, stock DESC LIMIT ?",
+                                (unit, footprint_package(footprint), parsed[0], limit))
+        return [ "C%d" % lcsc for (lcsc,) in rows ]
+
+def lcsc_number(text):
+    """
+    Return the integer part of an LCSC number (C1525 -> 1525), or None if it isn't one.
+    """
+    text = text.strip().upper()
+    if (len(text) > 1 and text[0] == "C" and text[1:].isdigit()):
+        return int(text[1:])
+    return None
+
+def footprint_package(footprint):
+    """
+    Return the package name JLCPCB would use for a KiCad footprint, e.g. 0402 for
+    C_0402_1005Metric or SOT-23-3 for SOT-23-3.
+    """
+    name = footprint.split(":")[-1]
+    m = re.search(r"(?:^|_)(0201|0402|0603|0805|1206|1210|1812|2010|2512)(?:_|$)", name)
+    if (m):
+        return m.group(1)
+    return name.split("_")[0]
+
+def catalogue_columns(header):
+    """
+    Map our column names onto the positions of the columns in a catalogue header.
+    """
+    names = [ h.strip().lower() for h in header ]
+    columns = {}
+    for column, aliases in CATALOGUE_COLUMNS.items():
+        for alias in aliases:
+            if (alias in names):
+                columns[column] = names.index(alias)
+                break
+    for f in [ "lcsc", "package" ]:
+        if not f in columns:
+            raise InvalidData(f, "Column missing from parts catalogue")
+    return columns
+
+def import_catalogue(csv_file, db_file, batch=10000):
+    """
+    Import a JLCPCB parts CSV into a new SQLite catalogue, returning the number of
+    parts. The value (if any) is pulled from the description for the value index.
+    """
+    import sqlite3
+
+    if (os.path.exists(db_file)):
+        os.remove(db_file)
+    db = sqlite3.connect(db_file)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("CREATE TABLE parts (lcsc INTEGER PRIMARY KEY, mfr TEXT, package TEXT, library TEXT, "
+                "basic INTEGER, stock INTEGER, description TEXT, unit TEXT, magnitude REAL)")
+
+    def rows(reader, columns):
+        get = lambda row, name: row[columns[name]].strip() if (name in columns and columns[name] < len(row)) else ""
+        for row in reader:
+            lcsc = lcsc_number(get(row, "lcsc"))
+            if (lcsc is None):
+                continue
+            description = get(row, "description")
+            stock = get(row, "stock")
+            unit = magnitude = None
+            m = DESCRIPTION_VALUE.search(description)
+            if (m):
+                magnitude, unit = parse_value(m.group(1))
+            library = get(row, "library")
+            yield (lcsc, get(row, "mfr"), get(row, "package"), library, int(library.lower() == "basic"),
+                    int(stock) if (stock.isdigit()) else 0, description, unit, magnitude)
+
+    with open(csv_file, newline="", encoding="utf-8-sig") as fh:
+        reader = csv.reader(fh)
+        generator = rows(reader, catalogue_columns(next(reader, [])))
+        while (True):
+            chunk = list(itertools.islice(generator, batch))
+            if (not chunk):
+                break
+            db.executemany("INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", chunk)
+
+    db.execute("CREATE INDEX parts_value ON parts (unit, package, magnitude, basic DESC, stock DESC)")
+    db.commit()
+    count = db.execute("SELECT COUNT(*) FROM parts").fetchone()[0]
+    db.close()
+    return count
+
+def check_bom(bom, catalogue):
+    """
+    Check the LCSC number of every BOM line against the catalogue, returning a list
+    of the problems (dicts with the BOM line, the LCSC number, the problem and any
+    suggested parts). Problems are missing, unknown, out of stock and extended.
+    """
+    lines = list(bom.items())
+    found = catalogue.lookup([ info["JLCPCB"] for key, info in lines ])
+
+    problems = []
+    for key, info in lines:
+        lcsc = info["JLCPCB"].strip()
+        entry = { "key": key, "value": info["Component"], "footprint": info["Footprint"],
+                    "lcsc": lcsc, "refs": len(info["refs"]) }
+        if (not lcsc):
+            unit = REFTYPE_UNITS.get(reftype(info["refs"][0]))
+            suggestions = catalogue.suggest(info["Component"], info["Footprint"], unit) if (unit) else []
+            problems.append(dict(entry, problem="missing", suggestions=suggestions))
+            continue
+        part = found.get("C%d" % lcsc_number(lcsc)) if (lcsc_number(lcsc) is not None) else None
+        if (part is None):
+            problems.append(dict(entry, problem="unknown"))
+        elif (part["stock"] <= 0):
+            problems.append(dict(entry, problem="out of stock"))
+        elif (part["library"].lower() == "extended"):
+            problems.append(dict(entry, problem="extended"))
+    return problems
+
+def catalogue_summary(problems):
+    """
+    Return a human readable summary of the check_bom() problems.
+    """
+    lines = [ "Catalogue: %d BOM lines with problems" % len(problems) ]
+    for p in problems:
+        line = "  %-12s %-20s %-30s %s" % (p["problem"], p["value"], p["footprint"], p["lcsc"])
+        if (p.get("suggestions")):
+            line += " (try " + ", ".join(p["suggestions"]) + ")"
+        lines.append(line)
+    return "\n".join(lines)
+
+# --------------------------------------------------------------------------------------
+# PROCESSING FUNCTIONS
+# --------------------------------------------------------------------------------------
+
+def load_board(board_file):
+    """
+    Create a Board from a board.csv file and shift it to (0,0)
+    """
+    columns = read_csv_columns(board_file, numeric=("x", "y"))
+    for f in [ "x", "y" ]:
+        if not f in columns:
+            raise InvalidData(f, "Field missing from " + board_file)
+
+    board = Board()
+    board.addPoints(columns["x"] / 1000000.0, columns["y"] / 1000000.0)
+    board.shiftToZero()
+    return board
+
+def load_components(component_file, board, mapping=CLASS_MAPPING):
+    """
+    Create a ComponentTable from a components.csv file, read a column at a time with
+    the numbers converted in bulk. The class of each row comes from the mapping of
+    its reference type (i.e. R from R100)
+    """
+    columns = read_csv_columns(component_file, numeric=("x", "y", "rot", "top", "left", "bottom", "right"))
+    return ComponentTable(board, columns, mapping)
+
+def build_bom(components):
+    """
+    Build a BOM dict from the components, combining like elements...
+    """
+    bom = {}
+    for c in components:
+        key = c.getBOMKey()
+        if (not key in bom):
+            bom[key] = { "Component": c.value, "Footprint": c.footprint, "JLCPCB": c.lcsc, "refs": [ c.ref ] }
+        else:
+            bom[key]["refs"].append(c.ref)
+    return bom
+
+def placement_row(c, delta):
+    """
+    Return the placement information (a dict for output) for a component, delta
+    is the extra rotation from the rotations database.
+    """
+    layername = "top" if (c.layer == "F.Cu") else "bottom"
+    rotation = (c.rot + delta) % 360
+
+    return {
+        "Designator":   c.ref,
+        "Mid X":        c.x / 1000000.0,
+        "Mid Y":        -c.y / 1000000.0,        # y direction is reversed
+        "Layer":        layername,
+        "Rotation":     rotation,
+    }
+
+def build_placement(components, rotdb):
+    """
+    Build the placement list (a list of dicts for output) for the components
+    """
+    return [ placement_row(c, rotdb.possible_rotate(c.footprint)) for c in components ]
+
+def write_bom(filename, bom):
+    """
+    Output the BOM in the format needed for JLCPCB (the csv module writes the line
+    endings itself, so the file is opened with newline="" as everywhere we write CSV)
+    """
+    with open(filename, "w", newline="") as bomfile:
+        write_bom_csv(bomfile, bom)
+
+def write_bom_csv(bomfile, bom):
+    """
+    Write the BOM csv to an open file
+    """
+    writer = csv.DictWriter(bomfile, quoting=csv.QUOTE_ALL,
+        fieldnames=["Component", "Designator", "Footprint", "JLCPCB"])
+    writer.writeheader()
+    for key, bominfo in bom.items():
+        # Replace list of refs with comma separated string...
+        writer.writerow({
+            "Component":    bominfo["Component"],
+            "Designator":   ",".join(bominfo["refs"]),
+            "Footprint":    bominfo["Footprint"],
+            "JLCPCB":       bominfo["JLCPCB"],
+        })
+
+def write_cpl(filename, placement):
+    """
+    Output the placement information in the format needed for JLCPCB
+    """
+    with open(filename, "w", newline="") as cplfile:
+        write_cpl_csv(cplfile, placement)
+
+def write_cpl_csv(cplfile, placement):
+    """
+    Write the placement csv to an open file
+    """
+    writer = csv.DictWriter(cplfile, quoting=csv.QUOTE_NONNUMERIC,
+        fieldnames=["Designator", "Mid X", "Mid Y", "Layer", "Rotation"])
+    writer.writeheader()
+    for item in placement:
+        writer.writerow(item)
+
+#
+# Bokeh and pandas account for most of the startup time, so they are only imported
+# here, when a visualisation is actually requested.
+#
+def visualise(board, table, profiler=NULL_PROFILER, tolerance=OUTLINE_TOLERANCE, report=None,
+                density_threshold=DENSITY_THRESHOLD):
+    """
+    Show the visualisations of the board and components (a ComponentTable) in the
+    browser, or save them to the report file if one is given, and print the dataframe
+    of the components.
+    """
+    p, d = visualise_layout(board, table, profiler, tolerance, density_threshold)
+    with profiler.phase("dataframe print"):
+        print(d)
+
+    if (report is not None):
+        with profiler.phase("report save"):
+            save_report(p, report)
+        return
+
+    from bokeh.plotting import show
+    with profiler.phase("show"):
+        show(p)
+
+def save_report(layout, filename, title="PCB layout"):
+    """
+    Save a layout as a standalone HTML file (with Bokeh loaded from its CDN) without
+    opening a browser, so it works on headless build servers.
+    """
+    from bokeh.embed import file_html
+    from bokeh.resources import CDN
+
+    with open(filename, "w", encoding="utf-8") as fh:
+        fh.write(file_html(layout, CDN, title))
+
+def visualise_layout(board, table, profiler=NULL_PROFILER, tolerance=OUTLINE_TOLERANCE,
+                        density_threshold=DENSITY_THRESHOLD):
+    """
+    Draw the board and components (a ComponentTable), and produce the additional
+    visualisations from a pandas dataframe of the components. Boards with more than
+    density_threshold components are drawn as a heatmap. Returns the layout and the
+    dataframe.
+    """
+    with profiler.phase("viz imports"):
+        from bokeh.plotting import figure           # for plotting
+        from bokeh.layouts import column            # mulitple plots in a column
+        from bokeh.models import ColumnDataSource, DataTable, TableColumn    # For a table
+        from bokeh.models.widgets import Div        # So we can title the table
+        import pandas as pd                         # for visualisations
+
+    #
+    # Draw the board outline...
+    #
+
+    # create a new plot with a title and axis labels
+    v1 = figure(title="PCB layout", x_axis_label="x (mm)", y_axis_label="y (mm)", match_aspect=True,
+                output_backend="webgl")
+    board.drawLevels(v1, tolerance, line_width=2, fill_color="#002d04", line_color="black")
+
+    controls = []
+    if (len(table) > density_threshold):
+        with profiler.phase("density draw"):
+            controls.append(draw_density(v1, table))
+    else:
+        # Components draw into a batch, which is then drawn with a handful of glyphs
+        batch = BatchPlot()
+
+        with profiler.phase("component draw"):
+            draw = profiler.timed("Component.draw", lambda c: c.draw(batch),
+                                    key=lambda c: (c.ref, c.footprint))
+            for c in table:
+                # Draw the component for the board visualisation
+                draw(c)
+
+        with profiler.phase("glyph flush"):
+            batch.flush(v1)
 
     #
     # Now generate a range of additional visualisations by creating a Pandas dataframe
-    # from the data we have build up...
+    # straight from the columns of the component table...
     #
-    d = pd.DataFrame(data)
-    print(d)
+    with profiler.phase("dataframe build"):
+        d = table.dataFrame()
 
     #
     # Produce a bar chart showing how many of each component type are used in the
     # board...
     #
-    v2 = figure(x_range=d["Type"].unique(), height=500, title="Bar Chart of Counts of Component Types",
+    counts = d["Type"].value_counts(sort=False)
+    types = [ str(t) for t in counts.index ]
+    v2 = figure(x_range=types, height=500, title="Bar Chart of Counts of Component Types",
                 x_axis_label="Component Types", y_axis_label="Quantity")
-    v2.vbar(x=d["Type"].unique(), top=d["Type"].value_counts(), width=0.6)
+    v2.vbar(x=types, top=counts.values, width=0.6)
 
     #
     # Produce a table with all of our coponent information...
@@ -595,10 +2146,2684 @@ def main():
     v3title = Div(text="<h3><b>Table of Components</b></h3>")
 
     # Now plot the visualisation vertically
-    p = column(v1, v2, v3title, v3)
-    show(p)
+    return column(*controls, v1, v2, v3title, v3), d
 
+# --------------------------------------------------------------------------------------
+# KICAD PCB PARSER
+# --------------------------------------------------------------------------------------
 
-if __name__ == '__main__':
-    main()
+#
+# A streaming reader for .kicad_pcb files so that the board can be processed without
+# pcbnew (or the interim CSV files). The file is tokenized a line at a time and only
+# the top level items we care about (footprints and the Edge.Cuts graphics) are built
+# into small trees, everything else (tracks, zones etc.) is skipped as it streams past.
+#
+
+SEXPR_TOKEN = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+SEXPR_ESCAPE = re.compile(r'\\(.)')
+
+# Top level items we build trees for
+KICAD_OUTLINE_ITEMS = ( "gr_line", "gr_arc", "gr_rect", "gr_poly", "gr_circle" )
+KICAD_FOOTPRINT_ITEMS = ( "footprint", "module" )
+
+# Footprint graphics that make up a courtyard
+KICAD_COURTYARD_ITEMS = ( "fp_line", "fp_arc", "fp_rect", "fp_poly", "fp_circle" )
+
+def sexpr_tokens(fh):
+    """
+    Generate the tokens from an S-expression file, "(" and ")" are returned as is,
+    quoted strings are unquoted. Strings that span lines are joined first.
+    """
+    pending = ""
+    for line in fh:
+        line = pending + line
+        if (line.count('"') - line.count('\\"')) % 2:
+            pending = line
+            continue
+        pending = ""
+        for tok in SEXPR_TOKEN.findall(line):
+            if (tok[0] == '"'):
+                yield SEXPR_ESCAPE.sub(r'\1', tok[1:-1])
+            else:
+                yield tok
+
+def sexpr_tree(tokens, head):
+    """
+    Build the tree (a list, with the head first) for the item just opened. Child
+    items are lists as well.
+    """
+    tree = [ head ]
+    for tok in tokens:
+        if (tok == "("):
+            tree.append(sexpr_tree(tokens, next(tokens)))
+        elif (tok == ")"):
+            return tree
+        else:
+            tree.append(tok)
+    raise InvalidData(head, "Unexpected end of file")
+
+def sexpr_skip(tokens):
+    """
+    Consume the tokens of the item just opened without building anything.
+    """
+    depth = 1
+    for tok in tokens:
+        if (tok == "("):
+            depth += 1
+        elif (tok == ")"):
+            depth -= 1
+            if (depth == 0):
+                return
+    raise InvalidData("sexpr", "Unexpected end of file")
+
+def sexpr_items(tokens, wanted):
+    """
+    Generate (head, tree) for each top level item whose head is in wanted.
+    """
+    if (next(tokens, None) != "(" or next(tokens, None) != "kicad_pcb"):
+        raise InvalidData("kicad_pcb", "Not a KiCad PCB file")
+
+    for tok in tokens:
+        if (tok == ")"):
+            return
+        if (tok != "("):
+            continue
+        head = next(tokens)
+        if (head in wanted):
+            yield head, sexpr_tree(tokens, head)
+        else:
+            sexpr_skip(tokens)
+
+def sexpr_find(tree, name):
+    """
+    Return the first child item of the tree with the given head (or None)
+    """
+    for item in tree:
+        if (isinstance(item, list) and item[0] == name):
+            return item
+    return None
+
+def sexpr_point(tree, name):
+    """
+    Return the (x, y) in mm from a child item such as (start x y)
+    """
+    item = sexpr_find(tree, name)
+    return (float(item[1]), float(item[2]))
+
+def arc_points(start, mid, end, step=10.0):
+    """
+    Approximate the arc through start, mid and end with a list of points (including
+    both ends) no more than step degrees apart.
+    """
+    (ax, ay), (bx, by), (cx, cy) = start, mid, end
+    d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if (abs(d) < 1e-12):
+        return [ start, end ]                   # really a straight line
+    ux = ((ax*ax + ay*ay) * (by - cy) + (bx*bx + by*by) * (cy - ay) + (cx*cx + cy*cy) * (ay - by)) / d
+    uy = ((ax*ax + ay*ay) * (cx - bx) + (bx*bx + by*by) * (ax - cx) + (cx*cx + cy*cy) * (bx - ax)) / d
+    r = math.hypot(ax - ux, ay - uy)
+
+    a0 = math.atan2(ay - uy, ax - ux)
+    a1 = math.atan2(by - uy, bx - ux)
+    a2 = math.atan2(cy - uy, cx - ux)
+    # Go the way round that passes through mid...
+    sweep = (a2 - a0) % (2 * math.pi)
+    if ((a1 - a0) % (2 * math.pi) > sweep):
+        sweep -= 2 * math.pi
+
+    n = max(2, int(math.ceil(abs(math.degrees(sweep)) / step)))
+    return [ (ux + r * math.cos(a0 + sweep * i / n), uy + r * math.sin(a0 + sweep * i / n))
+                for i in range(n + 1) ]
+
+def circle_points(centre, edge, step=10.0):
+    """
+    Approximate a circle with a closed list of points.
+    """
+    r = math.hypot(edge[0] - centre[0], edge[1] - centre[1])
+    n = int(math.ceil(360.0 / step))
+    return [ (centre[0] + r * math.cos(2 * math.pi * i / n), centre[1] + r * math.sin(2 * math.pi * i / n))
+                for i in range(n + 1) ]
+
+def shape_points(tree):
+    """
+    Return a list of polylines (lists of (x, y) in mm) for a graphic item, whether
+    a board (gr_) or footprint (fp_) one.
+    """
+    kind = tree[0][3:]
+    if (kind == "line"):
+        return [ [ sexpr_point(tree, "start"), sexpr_point(tree, "end") ] ]
+    if (kind == "arc"):
+        if (sexpr_find(tree, "mid") is None):
+            # Older files have the centre as start, the start as end, and an angle
+            centre, first = sexpr_point(tree, "start"), sexpr_point(tree, "end")
+            angle = math.radians(float(sexpr_find(tree, "angle")[1]))
+            r = math.hypot(first[0] - centre[0], first[1] - centre[1])
+            a0 = math.atan2(first[1] - centre[1], first[0] - centre[0])
+            mid = (centre[0] + r * math.cos(a0 + angle / 2), centre[1] + r * math.sin(a0 + angle / 2))
+            end = (centre[0] + r * math.cos(a0 + angle), centre[1] + r * math.sin(a0 + angle))
+            return [ arc_points(first, mid, end) ]
+        return [ arc_points(sexpr_point(tree, "start"), sexpr_point(tree, "mid"), sexpr_point(tree, "end")) ]
+    if (kind == "rect"):
+        (x0, y0), (x1, y1) = sexpr_point(tree, "start"), sexpr_point(tree, "end")
+        return [ [ (x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0) ] ]
+    if (kind == "poly"):
+        pts = [ (float(xy[1]), float(xy[2])) for xy in sexpr_find(tree, "pts")[1:] if xy[0] == "xy" ]
+        return [ pts + pts[:1] ]
+    if (kind == "circle"):
+        return [ circle_points(sexpr_point(tree, "center"), sexpr_point(tree, "end")) ]
+    return []
+
+def chain_segments(polylines, tolerance=1e-4):
+    """
+    Join polylines end to end into closed loops, returning a list of loops (each a
+    list of points without the closing point repeated).
+    """
+    def key(p):
+        return (round(p[0] / tolerance), round(p[1] / tolerance))
+
+    # Index each polyline by both of its ends...
+    ends = {}
+    for index, pl in enumerate(polylines):
+        ends.setdefault(key(pl[0]), []).append(index)
+        ends.setdefault(key(pl[-1]), []).append(index)
 
+    used = set()
+    loops = []
+    for index, pl in enumerate(polylines):
+        if (index in used):
+            continue
+        used.add(index)
+        loop = list(pl)
+        while (key(loop[-1]) != key(loop[0])):
+            nxt = [ i for i in ends.get(key(loop[-1]), []) if not i in used ]
+            if (not nxt):
+                break                           # open outline, just use what we have
+            used.add(nxt[0])
+            other = polylines[nxt[0]]
+            if (key(other[0]) != key(loop[-1])):
+                other = other[::-1]
+            loop.extend(other[1:])
+        if (key(loop[-1]) == key(loop[0]) and len(loop) > 1):
+            loop.pop()
+        loops.append(loop)
+    return loops
+
+def polygon_area(points):
+    """
+    The (absolute) area of a polygon using the shoelace formula.
+    """
+    area = 0.0
+    for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+        area += x0 * y1 - x1 * y0
+    return abs(area) / 2
+
+def footprint_record(tree):
+    """
+    Convert a footprint tree into a dict with the same fields (and units) as a row of
+    components.csv, or None if the footprint is excluded from the BOM.
+    """
+    attr = sexpr_find(tree, "attr")
+    if (attr is not None and "exclude_from_bom" in attr):
+        return None
+
+    layer = sexpr_find(tree, "layer")[1]
+    at = sexpr_find(tree, "at")
+    x, y = float(at[1]), float(at[2])
+    rot = float(at[3]) if (len(at) > 3) else 0.0
+
+    # Reference/value are properties in newer files, fp_text in older ones...
+    fields = {}
+    for item in tree:
+        if (isinstance(item, list) and len(item) > 2):
+            if (item[0] == "property"):
+                fields[item[1]] = item[2]
+            elif (item[0] == "fp_text" and item[1] in ("reference", "value")):
+                fields[item[1].capitalize()] = item[2]
+
+    # Courtyard is in footprint co-ordinates, so rotate and move into place. KiCad
+    # inflates the courtyard by the line width (less 1nm) when it gives the bbox.
+    courtyard = "B.CrtYd" if (layer == "B.Cu") else "F.CrtYd"
+    c = math.cos(math.radians(rot))
+    s = math.sin(math.radians(rot))
+    xs, ys = [], []
+    for item in tree:
+        if (isinstance(item, list) and item[0] in KICAD_COURTYARD_ITEMS):
+            if (sexpr_find(item, "layer")[1] != courtyard):
+                continue
+            stroke = sexpr_find(item, "stroke")
+            width = float(sexpr_find(stroke, "width")[1]) if (stroke is not None) else \
+                        float(sexpr_find(item, "width")[1])
+            for pl in shape_points(item):
+                for px, py in pl:
+                    bx = x + px * c + py * s
+                    by = y - px * s + py * c
+                    xs += [ bx - width, bx + width ]
+                    ys += [ by - width, by + width ]
+
+    if (not xs):
+        xs, ys = [ x, x ], [ y, y ]             # no courtyard, just use the position
+
+    return {
+        "ref":          fields.get("Reference", ""),
+        "value":        fields.get("Value", ""),
+        "layer":        layer,
+        "footprint":    tree[1].split(":")[-1],
+        "lcsc":         fields.get("LCSC", ""),
+        "x":            round(x * 1000000),
+        "y":            round(y * 1000000),
+        "rot":          rot,
+        "top":          round(min(ys) * 1000000) + 1,
+        "left":         round(min(xs) * 1000000) + 1,
+        "bottom":       round(max(ys) * 1000000) - 1,
+        "right":        round(max(xs) * 1000000) - 1,
+    }
+
+def read_kicad_pcb(filename):
+    """
+    Read a .kicad_pcb file in a single pass, returning the board outline (a list of
+    (x, y) points in KiCad units) and a list of component records (as per the rows
+    of components.csv).
+    """
+    polylines = []
+    records = []
+    with open(filename, "r", encoding="utf-8") as fh:
+        for head, tree in sexpr_items(sexpr_tokens(fh), KICAD_OUTLINE_ITEMS + KICAD_FOOTPRINT_ITEMS):
+            if (head in KICAD_FOOTPRINT_ITEMS):
+                record = footprint_record(tree)
+                if (record is not None):
+                    records.append(record)
+            elif (sexpr_find(tree, "layer")[1] == "Edge.Cuts"):
+                polylines += shape_points(tree)
+
+    # The outline is the biggest loop, anything else is a cut-out
+    loops = chain_segments(polylines)
+    if (not loops):
+        raise InvalidData(filename, "No Edge.Cuts outline found")
+    outline = max(loops, key=polygon_area)
+    return [ (round(x * 1000000), round(y * 1000000)) for x, y in outline ], records
+
+def load_kicad_pcb(filename, mapping=CLASS_MAPPING):
+    """
+    Create the Board and ComponentTable directly from a .kicad_pcb file
+    """
+    outline, records = read_kicad_pcb(filename)
+    board = outline_board(outline)
+    return board, ComponentTable.fromRecords(board, records, mapping)
+
+def outline_board(outline):
+    """
+    Create a Board from a list of (x, y) outline points in KiCad units and shift it
+    to (0,0)
+    """
+    points = np.array(outline, dtype=np.float64).reshape(-1, 2)
+    return points_board(points[:, 0], points[:, 1])
+
+def points_board(xs, ys):
+    """
+    Create a Board from the x and y outline co-ordinates in KiCad units and shift it
+    to (0,0)
+    """
+    board = Board()
+    board.addPoints(np.asarray(xs, dtype=np.float64) / 1000000.0, np.asarray(ys, dtype=np.float64) / 1000000.0)
+    board.shiftToZero()
+    return board
+
+# --------------------------------------------------------------------------------------
+# BOARD PROCESSING
+# --------------------------------------------------------------------------------------
+
+def input_files(file_path):
+    """
+    Return the list of input files for a board, either the .kicad_pcb file itself or
+    the board.csv and components.csv files in the directory.
+    """
+    if (os.path.isfile(file_path) and file_path.endswith(".kicad_pcb")):
+        return [ file_path ]
+
+    if (not os.path.isdir(file_path)):
+        raise InvalidData(file_path, file_path + " is not a directory.")
+
+    board_file = os.path.join(file_path, "board.csv")
+    component_file = os.path.join(file_path, "components.csv")
+
+    if (not os.path.isfile(board_file)):
+        raise InvalidData(board_file, "board.csv not found in " + file_path)
+
+    if (not os.path.isfile(component_file)):
+        raise InvalidData(component_file, "components.csv not found in " + file_path)
+
+    return [ board_file, component_file ]
+
+def load_input(file_path, mapping=CLASS_MAPPING):
+    """
+    Create the Board object, and the ComponentTable of the components on it, either
+    straight from a KiCad file or from the interim CSV files in a directory.
+    """
+    files = input_files(file_path)
+    if (len(files) == 1):
+        return load_kicad_pcb(files[0], mapping)
+
+    board = load_board(files[0])
+    return board, load_components(files[1], board, mapping)
+
+def process_board(file_path, output_dir, rotdb, mapping=CLASS_MAPPING, profiler=NULL_PROFILER, order=None):
+    """
+    Load a board and write its out_bom.csv and out_cpl.csv into output_dir (in pick
+    and place order if order is given, see write_outputs()), the board and component
+    table are returned for any visualisation.
+    """
+    with profiler.phase("load input"):
+        board, table = load_input(file_path, mapping)
+    report = write_outputs(table, output_dir, rotdb, profiler, order)
+    if (report is not None):
+        print (order_summary(report))
+    return board, table
+
+def process_data(outline, columns, output_dir, rotdb, mapping=CLASS_MAPPING):
+    """
+    Write out_bom.csv and out_cpl.csv for a board that is already in memory (e.g.
+    handed over by the KiCad plugin) without any interim files. outline is a pair of
+    x and y sequences and columns a dict of the components.csv columns, with the
+    positions and courtyards as numbers in KiCad units. Returns the board and table.
+    """
+    board = points_board(*outline)
+    table = ComponentTable(board, columns, mapping)
+    write_outputs(table, output_dir, rotdb)
+    return board, table
+
+def write_outputs(table, output_dir, rotdb, profiler=NULL_PROFILER, order=None, bom=None):
+    """
+    Write the out_bom.csv and out_cpl.csv for a ComponentTable into output_dir (with
+    the BOM built from the table unless one is given). If order (a time budget in
+    seconds) is given the placements are put in pick and place order, and the report
+    of that is returned.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if (bom is None):
+        with profiler.phase("bom build"):
+            bom = table.bom()
+    with profiler.phase("bom write"):
+        write_bom(os.path.join(output_dir, "out_bom.csv"), bom)
+    rows = report = None
+    if (order is not None):
+        with profiler.phase("placement order"):
+            rows, report = placement_order(table, order)
+    with profiler.phase("cpl write"):
+        write_cpl(os.path.join(output_dir, "out_cpl.csv"), table.placementRows(rotdb, rows))
+    return report
+
+#
+# Batch mode, each worker process loads the rotations database (and class mapping)
+# once in batch_init() and then keeps them for every board it is given.
+#
+batch_state = {}
+
+def batch_init(rotations_file):
+    """
+    Initialise a batch worker process.
+    """
+    batch_state["rotations_file"] = rotations_file
+    batch_state["rotdb"] = RotDB(rotations_file)
+    batch_state["mapping"] = CLASS_MAPPING
+
+def batch_worker(file_path, output_dir, incremental=False, stream=False):
+    """
+    Process a single board in a batch worker, returning the number of components.
+    """
+    if (stream):
+        return process_board_streaming(file_path, output_dir, batch_state["rotdb"], batch_state["mapping"])
+
+    if (incremental):
+        board, table, report = process_board_incremental(file_path, output_dir, batch_state["rotdb"],
+                                            batch_state["rotations_file"], batch_state["mapping"])
+        return report["reused"] + report["changed"] + report["rotated"]
+
+    board, table = process_board(file_path, output_dir, batch_state["rotdb"], batch_state["mapping"])
+    return len(table)
+
+def expand_inputs(patterns):
+    """
+    Expand any glob patterns in the list of inputs (plain paths are kept as is).
+    """
+    paths = []
+    for pattern in patterns:
+        if (glob.has_magic(pattern)):
+            paths += sorted(glob.glob(pattern))
+        else:
+            paths.append(pattern)
+    return paths
+
+def output_names(paths):
+    """
+    Work out a unique output directory name for each input path, the directory name
+    (or board file name) with a suffix if that has been used already.
+    """
+    names = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+        unique = name
+        count = 1
+        while (unique in names):
+            count += 1
+            unique = name + "-" + str(count)
+        names.append(unique)
+    return names
+
+def run_batch(paths, output_dir, rotations_file, workers=None, incremental=False, stream=False):
+    """
+    Process many boards across a pool of worker processes, the outputs for each go
+    into their own directory under output_dir. Prints a summary and returns a list
+    of result dicts (with an "error" for any board that failed).
+    """
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=batch_init,
+                                                initargs=(rotations_file,)) as pool:
+        futures = {}
+        for path, name in zip(paths, output_names(paths)):
+            outdir = os.path.join(output_dir, name)
+            futures[pool.submit(timed_call, batch_worker, path, outdir, incremental, stream)] = (path, outdir)
+
+        for future in concurrent.futures.as_completed(futures):
+            path, outdir = futures[future]
+            result = { "path": path, "output": outdir }
+            try:
+                result["components"], result["seconds"] = future.result()
+            except Exception as e:
+                result["error"] = e.args[-1] if (isinstance(e, InvalidData)) else repr(e)
+            results.append(result)
+
+    results.sort(key=lambda r: paths.index(r["path"]))
+    for r in results:
+        if ("error" in r):
+            print ("FAILED  %s: %s" % (r["path"], r["error"]))
+        else:
+            print ("%7.3fs %s -> %s (%d components)" % (r["seconds"], r["path"], r["output"], r["components"]))
+    failed = sum(1 for r in results if "error" in r)
+    print ("%d boards, %d ok, %d failed" % (len(results), len(results) - failed, failed))
+    return results
+
+def timed_call(func, *args):
+    """
+    Call func and return its result along with the time it took (in seconds).
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+# --------------------------------------------------------------------------------------
+# PANELISATION
+# --------------------------------------------------------------------------------------
+
+#
+# --panel steps and repeats a single board export into a rows x columns panel, rather
+# than a panel components.csv being built by hand. The columns of the one board are
+# transformed for every instance at once (broadcasting instances against rows), so
+# nothing is re-parsed and no components are built, and the designators of each
+# instance get a suffix (R1_1, R1_2 ...). The BOM is the single board BOM with the
+# references of each line repeated for every instance.
+#
+
+# The suffix added to the designators of each instance (numbered from 1, row by row)
+PANEL_SUFFIX = "_%d"
+
+def panel_size(text):
+    """
+    Parse a panel size such as 2x3 (rows x columns)
+    """
+    rows, cols = [ int(n) for n in text.lower().split("x") ]
+    if (rows < 1 or cols < 1):
+        raise ValueError(text)
+    return rows, cols
+
+def mm_pair(text):
+    """
+    Parse an x,y pair of distances in mm (a single number is used for both)
+    """
+    values = [ float(n) for n in text.split(",") ]
+    if (len(values) == 1):
+        values = values * 2
+    x, y = values
+    return x, y
+
+def angle_list(text):
+    """
+    Parse a comma separated list of angles in degrees
+    """
+    return [ float(n) for n in text.split(",") ]
+
+def rotation_terms(angles):
+    """
+    Return the cos and sin of each angle (in degrees), exact for multiples of 90 so
+    that unrotated (or squarely rotated) instances don't pick up rounding errors.
+    """
+    angles = np.asarray(angles, dtype=np.float64) % 360
+    radians = np.radians(angles)
+    square = (angles % 90) == 0
+    return (np.where(square, np.round(np.cos(radians)), np.cos(radians)),
+            np.where(square, np.round(np.sin(radians)), np.sin(radians)))
+
+def rotate_offsets(x, y, cx, cy, cos, sin):
+    """
+    Return how far each point (x, y) moves when rotated counterclockwise (as seen on
+    the board, y is down) about (cx, cy), one row per angle. Working in offsets keeps
+    the points of unrotated instances exact.
+    """
+    dx = x[None, :] - cx
+    dy = y[None, :] - cy
+    cos = cos[:, None]
+    sin = sin[:, None]
+    return dx * (cos - 1.0) + dy * sin, dy * (cos - 1.0) - dx * sin
+
+def panelize(board, table, rows, cols, pitch=None, rails=(0.0, 0.0), rotations=None, suffix=PANEL_SUFFIX):
+    """
+    Step and repeat a board (and its ComponentTable) into a rows x cols panel. pitch is
+    the (x, y) distance in mm from one instance to the next (by default the size of the
+    largest instance, so the boards touch), rails the (x, y) width in mm of the rails
+    on each side, and rotations the angle of each instance about its centre (one
+    angle for all, or one per instance row by row). Returns the panel board (the
+    outline of the panel frame), the panel ComponentTable and the designator suffixes.
+    """
+    count = rows * cols
+    angles = np.zeros(count) if (rotations is None) else np.asarray(rotations, dtype=np.float64).reshape(-1)
+    if (len(angles) == 1):
+        angles = np.repeat(angles, count)
+    if (len(angles) != count):
+        raise InvalidData("rotations", "Need one rotation, or one for each of the %d boards" % count)
+    cos, sin = rotation_terms(angles)
+
+    # Each instance is rotated about the board centre, and then moved so the corner of
+    # its outline sits at the corner of its place in the panel (all in mm from the board
+    # origin)...
+    cx = float(board.xs.max()) / 2
+    cy = float(board.ys.max()) / 2
+    ox, oy = rotate_offsets(board.xs, board.ys, cx, cy, cos, sin)
+    ox += board.xs
+    oy += board.ys
+    left = ox.min(axis=1)
+    top = oy.min(axis=1)
+    width = ox.max(axis=1) - left
+    height = oy.max(axis=1) - top
+    if (pitch is None):
+        pitch = (float(width.max()), float(height.max()))
+    shiftx = rails[0] + (np.arange(count) % cols) * pitch[0] - left
+    shifty = rails[1] + (np.arange(count) // cols) * pitch[1] - top
+
+    # Placements (in KiCad units)...
+    dx, dy = rotate_offsets(table.x, table.y, (board.minx + cx) * 1000000.0, (board.miny + cy) * 1000000.0, cos, sin)
+    panel = copy.copy(table)
+    panel.x = (table.x[None, :] + dx + shiftx[:, None] * 1000000.0).ravel()
+    panel.y = (table.y[None, :] + dy + shifty[:, None] * 1000000.0).ravel()
+    panel.rot = (table.rot[None, :] + angles[:, None]).ravel()
+
+    # ...the courtyards are the boxes around their rotated corners (in mm)
+    corners = [ rotate_offsets(x, y, cx, cy, cos, sin) + (x, y)
+                for x, y in [ (table.left, table.top), (table.right, table.top),
+                                (table.left, table.bottom), (table.right, table.bottom) ] ]
+    xs = np.stack([ cdx + x for cdx, cdy, x, y in corners ])
+    ys = np.stack([ cdy + y for cdx, cdy, x, y in corners ])
+    panel.left = (xs.min(axis=0) + shiftx[:, None]).ravel()
+    panel.right = (xs.max(axis=0) + shiftx[:, None]).ravel()
+    panel.top = (ys.min(axis=0) + shifty[:, None]).ravel()
+    panel.bottom = (ys.max(axis=0) + shifty[:, None]).ravel()
+
+    # The strings are shared, only the references are new (one set per instance)
+    suffixes = [ suffix % (k + 1) for k in range(count) ]
+    refs = table.ref.categories
+    panel.ref = Categorical((table.ref.codes[None, :] + (np.arange(count) * len(refs))[:, None]).ravel().astype(np.int32),
+                            [ ref + s for s in suffixes for ref in refs ])
+    for f in [ "value", "layer", "footprint", "lcsc" ]:
+        col = getattr(table, f)
+        setattr(panel, f, Categorical(np.tile(col.codes, count), col.categories))
+    panel.cls = np.tile(table.cls, count)
+
+    # The panel outline is the frame around all the instances and the rails
+    right = float((shiftx + left + width).max()) + rails[0]
+    bottom = float((shifty + top + height).max()) + rails[1]
+    frame = Board()
+    frame.addPoints(board.minx + np.array([ 0.0, right, right, 0.0 ]), board.miny + np.array([ 0.0, 0.0, bottom, bottom ]))
+    frame.shiftToZero()
+    return frame, panel, suffixes
+
+def panel_bom(bom, suffixes):
+    """
+    Return the BOM for a panel from the BOM dict of a single board, the references of
+    each line repeated for every instance (in instance order).
+    """
+    return { key: dict(line, refs=[ ref + s for s in suffixes for ref in line["refs"] ])
+                for key, line in bom.items() }
+
+def process_panel(file_path, output_dir, rotdb, size, pitch=None, rails=(0.0, 0.0), rotations=None,
+                    mapping=CLASS_MAPPING, profiler=NULL_PROFILER, order=None):
+    """
+    Load a board and write the out_bom.csv and out_cpl.csv of a panel of it into
+    output_dir (size is the rows and columns, see panelize()). The panel board and
+    component table are returned for any visualisation.
+    """
+    with profiler.phase("load input"):
+        board, table = load_input(file_path, mapping)
+    with profiler.phase("panelise"):
+        frame, panel, suffixes = panelize(board, table, size[0], size[1], pitch, rails, rotations)
+        bom = panel_bom(table.bom(), suffixes)
+    report = write_outputs(panel, output_dir, rotdb, profiler, order, bom)
+    print ("Panel of %d x %d boards, %d placements" % (size[0], size[1], len(panel)))
+    if (report is not None):
+        print (order_summary(report))
+    return frame, panel
+
+# --------------------------------------------------------------------------------------
+# STREAMING EXPORT
+# --------------------------------------------------------------------------------------
+
+#
+# For very large (e.g. panelised) jobs --stream writes each CPL row as the component
+# is read and only keeps the BOM index in memory, so the export runs in near constant
+# memory. It is only used when no visualisation is wanted, as that needs every row.
+#
+
+class StreamingBOM():
+    """
+    A BOM built up a row at a time, with the same lines (and order) as build_bom().
+    Each line keeps its refs as a single comma separated bytearray rather than a list
+    of strings, and the BOM key is only worked out once for each distinct part.
+    """
+    def __init__(self, board, mapping=CLASS_MAPPING):
+        self.board = board
+        self.mapping = mapping
+        self.keys = {}          # (class, value, footprint, lcsc) -> BOM key
+        self.lines = {}         # BOM key -> [ bom info, refs ]
+
+    def add(self, record):
+        """
+        Add a component (a dict with the components.csv fields) to the BOM
+        """
+        ref = record["ref"]
+        objclass = self.mapping.get(reftype(ref), Unknown)
+        part = (objclass, record["value"], record["footprint"], record["lcsc"])
+        key = self.keys.get(part)
+        if (key is None):
+            c = objclass(self.board, record)
+            key = self.keys[part] = c.getBOMKey()
+            if (not key in self.lines):
+                info = { "Component": c.value, "Footprint": c.footprint, "JLCPCB": c.lcsc }
+                self.lines[key] = [ info, bytearray(ref.encode()) ]
+                return
+        self.lines[key][1] += b"," + ref.encode()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def items(self):
+        """
+        Generate (key, bom info) pairs as per a build_bom() dict, the refs list for
+        each line is only created as it is written.
+        """
+        for key, (info, refs) in self.lines.items():
+            yield key, dict(info, refs=refs.decode().split(","))
+
+def stream_input(file_path):
+    """
+    Return the Board and an iterator over the component records (dicts with the
+    components.csv fields). components.csv is read a row at a time, a .kicad_pcb
+    file is parsed up front as the records come out of one pass over the file.
+    """
+    files = input_files(file_path)
+    if (len(files) == 1):
+        outline, records = read_kicad_pcb(files[0])
+        return outline_board(outline), iter(records)
+
+    return load_board(files[0]), stream_csv_records(files[1])
+
+def stream_csv_records(component_file):
+    """
+    Generate the rows of a components.csv file as dicts, one at a time.
+    """
+    with open(component_file, newline="") as fh:
+        reader = csv.reader(fh)
+        header = next(reader, [])
+        for f in COMPONENT_FIELDS:
+            if not f in header:
+                raise InvalidData(f, "Field missing from " + component_file)
+        for row in reader:
+            if (not row):
+                continue
+            if (len(row) != len(header)):
+                raise InvalidData(component_file, "Row has the wrong number of fields: " + ",".join(row))
+            yield dict(zip(header, row))
+
+def stream_placement(records, rotdb, bom):
+    """
+    Generate the placement rows (as per build_placement) for the records, adding
+    each one to the StreamingBOM as it goes.
+    """
+    for record in records:
+        bom.add(record)
+        yield {
+            "Designator":   record["ref"],
+            "Mid X":        float(record["x"]) / 1000000.0,
+            "Mid Y":        float(record["y"]) / 1000000.0,
+            "Layer":        "top" if (record["layer"] == "F.Cu") else "bottom",
+            "Rotation":     (float(record["rot"]) + rotdb.possible_rotate(record["footprint"])) % 360,
+        }
+
+def process_board_streaming(file_path, output_dir, rotdb, mapping=CLASS_MAPPING, profiler=NULL_PROFILER):
+    """
+    Write out_bom.csv and out_cpl.csv for a board without building a ComponentTable,
+    returns the number of components.
+    """
+    with profiler.phase("load board"):
+        board, records = stream_input(file_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    count = [ 0 ]
+    def counted(records):
+        for record in records:
+            count[0] += 1
+            yield record
+
+    bom = StreamingBOM(board, mapping)
+    with profiler.phase("cpl stream"):
+        write_cpl(os.path.join(output_dir, "out_cpl.csv"), stream_placement(counted(records), rotdb, bom))
+    with profiler.phase("bom write"):
+        write_bom(os.path.join(output_dir, "out_bom.csv"), bom)
+    return count[0]
+
+# --------------------------------------------------------------------------------------
+# INCREMENTAL BUILDS
+# --------------------------------------------------------------------------------------
+
+#
+# For the edit/re-run design loop we keep the results of the last build in a cache
+# beside the outputs. Each input file is hashed, as is each component row, so on a
+# re-run only the rows that changed (or whose rotation changed because rotations.cf
+# did) are recomputed, and the outputs are only rewritten if their content differs.
+#
+
+def file_hash(filename):
+    """
+    Return the sha256 (hex) of the contents of a file.
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def row_hash(record):
+    """
+    Return a stable hash of a component row (python's own hash() changes per run).
+    """
+    return hashlib.blake2b("\x1f".join(str(record[f]) for f in COMPONENT_FIELDS).encode(),
+                            digest_size=16).digest()
+
+def read_records(file_path):
+    """
+    Read the board outline points and component rows without creating any objects,
+    from either a .kicad_pcb file or the interim CSV files.
+    """
+    files = input_files(file_path)
+    if (len(files) == 1):
+        return read_kicad_pcb(files[0])
+
+    with open(files[0]) as bfile:
+        outline = [ (row["x"], row["y"]) for row in csv.DictReader(bfile) ]
+    with open(files[1]) as cfile:
+        records = list(csv.DictReader(cfile))
+    return outline, records
+
+def write_if_changed(filename, writer, data):
+    """
+    Produce the output with writer(fh, data) but only write the file if the content
+    differs from what is there already. Returns True if the file was written. The
+    file is opened as write_bom()/write_cpl() do, so the bytes are the same either way.
+    """
+    text = io.StringIO()
+    writer(text, data)
+    text = text.getvalue()
+    try:
+        with open(filename, "r", newline="") as fh:
+            if (fh.read() == text):
+                return False
+    except OSError:
+        pass
+    with open(filename, "w", newline="") as fh:
+        fh.write(text)
+    return True
+
+class BuildCache():
+    """
+    The state of the last build in an output directory, kept in a pickle beside the
+    outputs: the hashes of the inputs and outputs, the results for each component
+    row (keyed by the row hash) and the rotation used for each footprint.
+    """
+    FILENAME = ".libf_cache.pickle"
+    VERSION = 2
+
+    def __init__(self, output_dir):
+        """
+        Load the cache for the output directory, anything unreadable (or from a
+        different version) just means starting from scratch.
+        """
+        self.filename = os.path.join(output_dir, self.FILENAME)
+        self.inputs = {}
+        self.outputs = {}
+        self.rows = {}
+        self.deltas = {}
+        try:
+            with open(self.filename, "rb") as fh:
+                state = pickle.load(fh)
+            if (state["version"] == self.VERSION):
+                self.inputs = state["inputs"]
+                self.outputs = state["outputs"]
+                self.rows = state["rows"]
+                self.deltas = state["deltas"]
+        except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+            pass
+
+    def save(self):
+        """
+        Write the cache out (via a temporary file so a crash can't leave it half written)
+        """
+        state = { "version": self.VERSION, "inputs": self.inputs, "outputs": self.outputs,
+                    "rows": self.rows, "deltas": self.deltas }
+        with open(self.filename + ".tmp", "wb") as fh:
+            pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def outputsIntact(self):
+        """
+        Check the outputs are still there, and still what we wrote last time.
+        """
+        return bool(self.outputs) and all(os.path.isfile(f) and file_hash(f) == h
+                                            for f, h in self.outputs.items())
+
+def process_board_incremental(file_path, output_dir, rotdb, rotations_file, mapping=CLASS_MAPPING,
+                                need_components=False, cache=None, force=False):
+    """
+    As process_board() but using (and updating) the BuildCache in output_dir, or the
+    one given (as kept in memory by watch mode). Returns the board and ComponentTable
+    (the table only if need_components, components aren't otherwise created for
+    unchanged rows) along with a report dict of what was reused. If nothing at all
+    has changed the board and table are None, unless force is set (when the caller
+    needs them regardless).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if (cache is None):
+        cache = BuildCache(output_dir)
+    bom_file = os.path.join(output_dir, "out_bom.csv")
+    cpl_file = os.path.join(output_dir, "out_cpl.csv")
+
+    files = input_files(file_path)
+    inputs = { os.path.basename(f): file_hash(f) for f in files }
+    inputs["rotations"] = file_hash(rotations_file)
+
+    report = { "reused": 0, "changed": 0, "rotated": 0, "bom": "unchanged", "cpl": "unchanged" }
+    if (inputs == cache.inputs and cache.outputsIntact() and not force):
+        report["reused"] = len(cache.rows)
+        return None, None, report
+
+    # If the rotations changed then the rotation for every footprint is looked up again
+    if (inputs["rotations"] != cache.inputs.get("rotations")):
+        deltas = { fp: rotdb.possible_rotate(fp) for fp in cache.deltas }
+    else:
+        deltas = cache.deltas
+
+    outline, records = read_records(file_path)
+    board = outline_board(outline)
+
+    rows = {}
+    seen = {}
+    bom = {}
+    placement = []
+    for record in records:
+        h = row_hash(record)
+        entry = cache.rows.get(h)
+        fp = record["footprint"]
+        if (not fp in deltas):
+            deltas[fp] = rotdb.possible_rotate(fp)
+        seen[fp] = deltas[fp]
+
+        c = None
+        if (entry is None or entry["delta"] != deltas[fp]):
+            if (entry is None):
+                report["changed"] += 1
+            else:
+                report["rotated"] += 1
+            c = mapping.get(reftype(record["ref"]), Unknown)(board, record)
+            entry = { "key": c.getBOMKey(), "ref": c.ref, "value": c.value, "footprint": c.footprint,
+                        "lcsc": c.lcsc, "delta": deltas[fp], "placement": placement_row(c, deltas[fp]) }
+        else:
+            report["reused"] += 1
+        rows[h] = entry
+
+        if (entry["key"] in bom):
+            bom[entry["key"]]["refs"].append(entry["ref"])
+        else:
+            bom[entry["key"]] = { "Component": entry["value"], "Footprint": entry["footprint"],
+                                    "JLCPCB": entry["lcsc"], "refs": [ entry["ref"] ] }
+        placement.append(entry["placement"])
+
+    if (write_if_changed(bom_file, write_bom_csv, bom)):
+        report["bom"] = "written"
+    if (write_if_changed(cpl_file, write_cpl_csv, placement)):
+        report["cpl"] = "written"
+
+    cache.inputs = inputs
+    cache.outputs = { bom_file: file_hash(bom_file), cpl_file: file_hash(cpl_file) }
+    cache.rows = rows
+    cache.deltas = seen
+    cache.save()
+    return board, ComponentTable.fromRecords(board, records, mapping) if (need_components) else None, report
+
+def incremental_unchanged(report):
+    """
+    True if an incremental build changed nothing at all
+    """
+    return (report["changed"] == 0 and report["rotated"] == 0 and report["bom"] == "unchanged"
+            and report["cpl"] == "unchanged")
+
+def incremental_summary(report):
+    """
+    A one line description of what an incremental build did.
+    """
+    if (incremental_unchanged(report)):
+        return "nothing changed, %d rows reused" % report["reused"]
+    return ("%d rows recomputed (%d for rotation changes), %d reused; out_bom.csv %s, out_cpl.csv %s" %
+            (report["changed"] + report["rotated"], report["rotated"], report["reused"],
+                report["bom"], report["cpl"]))
+
+# --------------------------------------------------------------------------------------
+# REVISION DIFF
+# --------------------------------------------------------------------------------------
+
+#
+# --diff compares two revisions of a board before a re-order. The components are
+# joined on their reference (a dict from each reference to its row, so it is linear in
+# the number of parts) and every comparison is then done on whole columns: position
+# and output rotation (after the rotations database) within tolerances, the layer,
+# value, footprint and LCSC number, and the BOM line each part lands on. BOM lines
+# whose parts now sit on several lines (split) or that gather parts from several old
+# lines (merged) are reported too.
+#
+
+# Default tolerances for a part to count as moved (mm) or rotated (degrees)
+DIFF_POSITION_TOLERANCE = 0.001
+DIFF_ROTATION_TOLERANCE = 0.01
+
+# The string columns compared for each part, and the name of the change
+DIFF_FIELDS = [ ("layer", "layer"), ("value", "value"), ("footprint", "footprint"), ("lcsc", "lcsc") ]
+
+def first_rows(column):
+    """
+    Return the row of the first occurrence of each category of a Categorical column,
+    and the number of times each occurs.
+    """
+    rows = np.full(len(column.categories), -1, dtype=np.int64)
+    rows[column.codes[::-1]] = np.arange(len(column.codes) - 1, -1, -1)
+    return rows, np.bincount(column.codes, minlength=len(column.categories))
+
+def translate_codes(old, new):
+    """
+    Return an array mapping the category codes of the new Categorical column to
+    those of the old one (-1 where the string isn't in the old column).
+    """
+    index = { s: i for i, s in enumerate(old.categories) }
+    return np.array([ index.get(s, -1) for s in new.categories ], dtype=np.int64).reshape(-1)
+
+def diff_part(table, i, rotation):
+    """
+    Return a dict describing row i of a table (for the diff report)
+    """
+    return { "value": table.value[i], "footprint": table.footprint[i], "lcsc": table.lcsc[i],
+                "layer": table.layer[i], "x": float(table.x[i]) / 1000000.0,
+                "y": float(table.y[i]) / 1000000.0, "rotation": float(rotation[i]) }
+
+def bom_moves(keys_from, keys_to, refs, names_from, names_to):
+    """
+    Find the BOM lines (codes in keys_from) whose matched parts now sit on more than one
+    line (codes in keys_to), returning a list of { "line": key, "into": { key: [refs] } }.
+    """
+    width = max(len(names_to), 1)
+    pairs, inverse = np.unique(keys_from.astype(np.int64) * width + keys_to, return_inverse=True)
+    lines, counts = np.unique(pairs // width, return_counts=True)
+    split = np.isin(pairs // width, lines[counts > 1])
+    if (not split.any()):
+        return []
+
+    # Only the parts on the lines that split are gathered up
+    moves = {}
+    inverse = inverse.reshape(-1)
+    for i in np.flatnonzero(split[inverse]).tolist():
+        pair = int(pairs[inverse[i]])
+        line = names_from[pair // width]
+        if (not line in moves):
+            moves[line] = {}
+        moves[line].setdefault(names_to[pair % width], []).append(refs[i])
+    return [ { "line": line, "into": into } for line, into in moves.items() ]
+
+def diff_boards(old, new, rotdb, position_tolerance=DIFF_POSITION_TOLERANCE,
+                rotation_tolerance=DIFF_ROTATION_TOLERANCE):
+    """
+    Compare two ComponentTables (old and new revisions of a board) and return the
+    change report, a dict of the added and removed parts, the changed parts (with
+    what changed), the BOM lines added, removed, split and merged, and a summary of
+    the counts.
+    """
+    # Join each new row to the old row with the same reference...
+    old_rows, old_counts = first_rows(old.ref)
+    new_rows, new_counts = first_rows(new.ref)
+    to_old = translate_codes(old.ref, new.ref)
+    matched = to_old >= 0
+    ni = new_rows[matched]
+    oi = old_rows[to_old[matched]]
+    order = np.argsort(ni, kind="stable")
+    ni = ni[order]
+    oi = oi[order]
+
+    seen = np.zeros(len(old.ref.categories), dtype=bool)
+    seen[to_old[matched]] = True
+    removed = np.sort(old_rows[~seen])
+    added = np.sort(new_rows[~matched])
+
+    # Then compare the matched pairs a column at a time...
+    old_rotation = old.rotations(rotdb)
+    new_rotation = new.rotations(rotdb)
+    distance = np.hypot(new.x[ni] - old.x[oi], new.y[ni] - old.y[oi]) / 1000000.0
+    turn = np.abs((new_rotation[ni] - old_rotation[oi] + 180.0) % 360.0 - 180.0)
+    changes = { "moved": distance > position_tolerance, "rotated": turn > rotation_tolerance }
+    for field, name in DIFF_FIELDS:
+        codes = translate_codes(getattr(old, field), getattr(new, field))
+        changes[name] = codes[getattr(new, field).codes[ni]] != getattr(old, field).codes[oi]
+
+    old_keys = old.bomKeys()
+    new_keys = new.bomKeys()
+    key_codes = translate_codes(old_keys, new_keys)
+    changes["bom line"] = key_codes[new_keys.codes[ni]] != old_keys.codes[oi]
+
+    # Each combination of changes is a bit pattern, named once
+    names = list(changes)
+    pattern = np.zeros(len(ni), dtype=np.int64)
+    for bit, n in enumerate(names):
+        pattern |= changes[n].astype(np.int64) << bit
+    changed = np.flatnonzero(pattern)
+    described = { p: [ n for bit, n in enumerate(names) if p & (1 << bit) ] for p in np.unique(pattern[changed]).tolist() }
+
+    report = { "tolerance": { "position_mm": position_tolerance, "rotation_deg": rotation_tolerance } }
+    report["added"] = [ dict(ref=new.ref[i], **diff_part(new, i, new_rotation)) for i in added.tolist() ]
+    report["removed"] = [ dict(ref=old.ref[i], **diff_part(old, i, old_rotation)) for i in removed.tolist() ]
+    report["changed"] = []
+    for c in changed.tolist():
+        o = int(oi[c])
+        n = int(ni[c])
+        report["changed"].append({ "ref": new.ref[n], "changes": list(described[int(pattern[c])]),
+                                    "moved_mm": float(distance[c]), "rotated_deg": float(turn[c]),
+                                    "old": diff_part(old, o, old_rotation), "new": diff_part(new, n, new_rotation) })
+
+    # BOM lines, split and merged lines only consider the parts on both boards...
+    refs = [ new.ref[i] for i in ni.tolist() ]
+    old_lines = set(old_keys.categories)
+    new_lines = set(new_keys.categories)
+    report["bom"] = {
+        "added":    [ k for k in new_keys.categories if not k in old_lines ],
+        "removed":  [ k for k in old_keys.categories if not k in new_lines ],
+        "split":    bom_moves(old_keys.codes[oi], new_keys.codes[ni], refs, old_keys.categories, new_keys.categories),
+        "merged":   [ { "line": m["line"], "from": m["into"] }
+                        for m in bom_moves(new_keys.codes[ni], old_keys.codes[oi], refs,
+                                            new_keys.categories, old_keys.categories) ],
+    }
+    report["duplicates"] = sorted(set([ old.ref.categories[i] for i in np.flatnonzero(old_counts > 1).tolist() ] +
+                                        [ new.ref.categories[i] for i in np.flatnonzero(new_counts > 1).tolist() ]))
+
+    summary = { "old parts": len(old), "new parts": len(new), "added": len(added), "removed": len(removed),
+                "changed": len(changed), "unchanged": len(ni) - len(changed) }
+    summary.update({ n: int(np.count_nonzero(changes[n])) for n in names })
+    summary.update({ "bom " + k: len(v) for k, v in report["bom"].items() })
+    report["summary"] = summary
+    return report
+
+def diff_summary(report):
+    """
+    Return a printable summary of a diff report
+    """
+    s = report["summary"]
+    lines = [ "%d parts added, %d removed, %d changed (%d unchanged)" % (s["added"], s["removed"], s["changed"],
+                                                                        s["unchanged"]) ]
+    detail = [ "%d %s" % (s[n], n) for n in [ "moved", "rotated", "layer", "value", "footprint", "lcsc" ] if s[n] ]
+    if (detail):
+        lines.append("  " + ", ".join(detail))
+    lines.append("BOM lines: %d added, %d removed, %d split, %d merged" % (s["bom added"], s["bom removed"],
+                                                                            s["bom split"], s["bom merged"]))
+    if (report["duplicates"]):
+        lines.append("Duplicate references (only the first of each compared): " + ", ".join(report["duplicates"]))
+    return "\n".join(lines)
+
+def diff_layout(old_board, old, new_board, new, report, tolerance=OUTLINE_TOLERANCE):
+    """
+    Draw the new board with the old one overlaid and the changed parts highlighted:
+    added parts in green, removed in red (where they were), moved or rotated in orange
+    (with a line from where they were) and other changes in blue. Returns the layout.
+    """
+    from bokeh.plotting import figure
+    from bokeh.layouts import column
+    from bokeh.models import ColumnDataSource, DataTable, TableColumn, HoverTool
+    from bokeh.models.widgets import Div
+
+    plot = figure(title="PCB changes", x_axis_label="x (mm)", y_axis_label="y (mm)", match_aspect=True,
+                    output_backend="webgl")
+    new_board.draw(plot, tolerance, line_width=2, fill_color="#002d04", line_color="black")
+
+    # The old board (and parts) are drawn relative to the new board's origin
+    dx = old_board.minx - new_board.minx
+    dy = old_board.miny - new_board.miny
+    if (dx or dy or len(old_board.xs) != len(new_board.xs) or not np.allclose(old_board.xs, new_board.xs)
+            or not np.allclose(old_board.ys, new_board.ys)):
+        xs, ys = old_board.simplify(tolerance)
+        plot.patch(xs + dx, ys + dy, fill_alpha=0.0, line_color="grey", line_dash="dashed", line_width=2)
+
+    def rows(table, index, shift=(0.0, 0.0), changes=None):
+        index = np.asarray(index, dtype=np.int64)
+        return {
+            "x":        (table.left[index] + shift[0]).astype(np.float32),
+            "y":        (table.top[index] + shift[1]).astype(np.float32),
+            "width":    (table.right[index] - table.left[index]).astype(np.float32),
+            "height":   (table.bottom[index] - table.top[index]).astype(np.float32),
+            "ref":      [ table.ref[i] for i in index.tolist() ],
+            "changes":  changes if (changes is not None) else [ "" ] * len(index),
+        }
+
+    new_index = { r: i for i, r in enumerate(new.ref) }
+    old_index = { r: i for i, r in enumerate(old.ref) }
+    changed = report["changed"]
+    moved = [ c for c in changed if ("moved" in c["changes"] or "rotated" in c["changes"]) ]
+    other = [ c for c in changed if not ("moved" in c["changes"] or "rotated" in c["changes"]) ]
+    unchanged = np.ones(len(new), dtype=bool)
+    unchanged[[ new_index[c["ref"]] for c in changed ] + [ new_index[a["ref"]] for a in report["added"] ]] = False
+
+    renderers = []
+    for data, style, label in [
+            (rows(new, np.flatnonzero(unchanged)), dict(line_color="#dddddd", line_alpha=0.5), None),
+            (rows(old, [ old_index[r["ref"]] for r in report["removed"] ], (dx, dy), [ "removed" ] * len(report["removed"])),
+                dict(line_color="red", fill_color="red", fill_alpha=0.3), "removed"),
+            (rows(new, [ new_index[a["ref"]] for a in report["added"] ], changes=[ "added" ] * len(report["added"])),
+                dict(line_color="lime", fill_color="lime", fill_alpha=0.3), "added"),
+            (rows(new, [ new_index[c["ref"]] for c in moved ], changes=[ ", ".join(c["changes"]) for c in moved ]),
+                dict(line_color="orange", fill_color="orange", fill_alpha=0.3), "moved/rotated"),
+            (rows(new, [ new_index[c["ref"]] for c in other ], changes=[ ", ".join(c["changes"]) for c in other ]),
+                dict(line_color="deepskyblue", fill_color="deepskyblue", fill_alpha=0.3), "changed") ]:
+        if (label is None):
+            plot.block(source=ColumnDataSource(data), fill_alpha=0.0, line_dash="dotted", **style)
+        elif (len(data["ref"])):
+            renderers.append(plot.block(source=ColumnDataSource(data), legend_label=label, **style))
+
+    # Lines from where the moved parts were to where they are now
+    if (moved):
+        o = np.array([ old_index[c["ref"]] for c in moved ])
+        n = np.array([ new_index[c["ref"]] for c in moved ])
+        plot.segment(x0=(old.left[o] + old.right[o]) / 2 + dx, y0=(old.top[o] + old.bottom[o]) / 2 + dy,
+                        x1=(new.left[n] + new.right[n]) / 2, y1=(new.top[n] + new.bottom[n]) / 2,
+                        line_color="orange", line_width=2)
+    if (renderers):
+        plot.add_tools(HoverTool(renderers=renderers, tooltips=[ ("ref", "@ref"), ("change", "@changes") ]))
+
+    source = ColumnDataSource({
+        "ref":      [ c["ref"] for c in changed ],
+        "changes":  [ ", ".join(c["changes"]) for c in changed ],
+        "old":      [ "%(value)s %(footprint)s %(lcsc)s" % c["old"] for c in changed ],
+        "new":      [ "%(value)s %(footprint)s %(lcsc)s" % c["new"] for c in changed ],
+        "moved":    [ round(c["moved_mm"], 3) for c in changed ],
+        "rotated":  [ round(c["rotated_deg"], 2) for c in changed ],
+    })
+    table = DataTable(source=source, columns=[ TableColumn(field=f, title=f) for f in source.data ])
+    summary = Div(text="<pre>" + diff_summary(report) + "</pre>")
+    return column(summary, plot, Div(text="<h3><b>Changed parts</b></h3>"), table)
+
+def run_diff(old_path, new_path, output_dir, rotdb, position_tolerance=DIFF_POSITION_TOLERANCE,
+                rotation_tolerance=DIFF_ROTATION_TOLERANCE, viz=True, report_file=None,
+                tolerance=OUTLINE_TOLERANCE):
+    """
+    Compare two revisions of a board, writing out_diff.json into output_dir and
+    printing the summary, then show (or save) the overlay plot. Returns the report.
+    """
+    old_board, old = load_input(old_path)
+    new_board, new = load_input(new_path)
+    report = diff_boards(old, new, rotdb, position_tolerance, rotation_tolerance)
+    report["old"] = old_path
+    report["new"] = new_path
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "out_diff.json"), "w") as fh:
+        json.dump(report, fh, indent=2)
+    print (diff_summary(report))
+
+    if (viz):
+        layout = diff_layout(old_board, old, new_board, new, report, tolerance)
+        if (report_file is not None):
+            save_report(layout, report_file, "PCB changes")
+        else:
+            from bokeh.plotting import show
+            show(layout)
+    return report
+
+# --------------------------------------------------------------------------------------
+# WATCH MODE
+# --------------------------------------------------------------------------------------
+
+#
+# --watch keeps running, with the rotations database, class mapping and build cache
+# held in memory, and rebuilds whenever the inputs change. The inputs are polled
+# (os.stat is cheap and needs nothing outside the standard library) and a rebuild
+# waits until they have been left alone for a moment, as the plugin writes board.csv
+# and components.csv one after the other.
+#
+
+class Watcher():
+    """
+    Watches the inputs (and rotations database) of a board and rebuilds its outputs
+    incrementally once they have changed and settled.
+    """
+    def __init__(self, file_path, output_dir, rotations_file, mapping=CLASS_MAPPING,
+                    debounce=0.3, need_components=False):
+        self.file_path = file_path
+        self.output_dir = output_dir
+        self.rotations_file = rotations_file
+        self.mapping = mapping
+        self.debounce = debounce
+        self.need_components = need_components
+        self.built = None               # the stamp of the inputs last built
+        self.pending = None             # (stamp, time first seen) of a change
+        self.rotstamp = None
+        self.rotdb = None
+        self.cache = None
+        self.board = None
+        self.table = None
+
+    def stamp(self):
+        """
+        Return the modification time and size of each input (None if it is missing)
+        """
+        try:
+            files = input_files(self.file_path)
+        except InvalidData:
+            files = []
+        stamp = []
+        for f in files + [ self.rotations_file ]:
+            try:
+                st = os.stat(f)
+                stamp.append((f, st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append((f, None, None))
+        return tuple(stamp)
+
+    def poll(self, now=None):
+        """
+        Check the inputs, rebuilding if they changed and have then been left alone for
+        the debounce time. Returns the incremental build report if there was a build.
+        """
+        now = time.monotonic() if (now is None) else now
+        stamp = self.stamp()
+        if (stamp == self.built):
+            self.pending = None
+            return None
+        if (self.pending is None or self.pending[0] != stamp):
+            self.pending = (stamp, now)
+            return None
+        if (now - self.pending[1] < self.debounce):
+            return None
+        return self.rebuild(stamp)
+
+    def rebuild(self, stamp=None):
+        """
+        Rebuild the outputs now, the rotations database is only reloaded if it changed.
+        A failed build (e.g. a half written file) is retried when the inputs next change.
+        """
+        stamp = self.stamp() if (stamp is None) else stamp
+        self.built = stamp
+        self.pending = None
+        if (stamp[-1] != self.rotstamp):
+            self.rotdb = RotDB(self.rotations_file)
+            self.rotstamp = stamp[-1]
+        if (self.cache is None):
+            self.cache = BuildCache(self.output_dir)
+
+        # Until there is a board in memory (e.g. starting on the cache of an earlier
+        # run) it is loaded even if nothing has changed, otherwise there is nothing to draw
+        board, table, report = process_board_incremental(self.file_path, self.output_dir, self.rotdb,
+                                        self.rotations_file, self.mapping, self.need_components, self.cache,
+                                        force=self.board is None)
+        if (board is not None):
+            self.board, self.table = board, table
+        return report
+
+def watch(file_path, output_dir, rotations_file, interval=0.2, debounce=0.3, port=None,
+            tolerance=OUTLINE_TOLERANCE):
+    """
+    Rebuild the outputs for a board whenever its inputs change, until interrupted. If
+    a port is given the visualisation is served from a Bokeh server on it, and every
+    open page is updated after each rebuild.
+    """
+    watcher = Watcher(file_path, output_dir, rotations_file, debounce=debounce, need_components=port is not None)
+
+    def check():
+        start = time.perf_counter()
+        try:
+            report = watcher.poll()
+        except (InvalidData, ValueError) as e:
+            print ("Error: " + str(e.args[-1]))
+            return False
+        if (report is None):
+            return False
+        print ("Rebuilt in %.3fs: %s" % (time.perf_counter() - start, incremental_summary(report)))
+        return True
+
+    watcher.pending = (watcher.stamp(), float("-inf"))       # build straight away
+    check()
+    print ("Watching " + file_path + " (Ctrl-C to stop)")
+
+    try:
+        if (port is None):
+            while (True):
+                time.sleep(interval)
+                check()
+        else:
+            serve_watch(watcher, check, port, interval, tolerance)
+    except KeyboardInterrupt:
+        pass
+
+def serve_watch(watcher, check, port, interval, tolerance):
+    """
+    Serve the visualisation of the watched board from a Bokeh server, checking the
+    inputs from the server's own event loop and redrawing every open session when
+    there has been a rebuild.
+    """
+    from bokeh.application import Application
+    from bokeh.application.handlers.function import FunctionHandler
+    from bokeh.server.server import Server
+    from tornado.ioloop import PeriodicCallback
+
+    documents = set()
+
+    def redraw(doc):
+        doc.clear()
+        if (watcher.board is not None):
+            doc.add_root(visualise_layout(watcher.board, watcher.table, tolerance=tolerance)[0])
+
+    def session(doc):
+        documents.add(doc)
+        doc.on_session_destroyed(lambda context: documents.discard(doc))
+        redraw(doc)
+
+    def update():
+        if (check()):
+            for doc in list(documents):
+                doc.add_next_tick_callback(functools.partial(redraw, doc))
+
+    server = Server({ "/": Application(FunctionHandler(session)) }, port=port)
+    server.start()
+    PeriodicCallback(update, interval * 1000).start()
+    print ("Serving the visualisation on http://localhost:%d/" % port)
+    server.io_loop.add_callback(server.show, "/")
+    server.io_loop.start()
+
+# --------------------------------------------------------------------------------------
+# CONVERSION SERVICE
+# --------------------------------------------------------------------------------------
+
+#
+# --service runs a local HTTP service so that other systems can convert boards
+# without paying the interpreter startup (and rotations.cf load) for each one. The
+# conversions run in worker processes that stay warm (set up once by batch_init() as
+# in batch mode), one that takes longer than the timeout is killed and replaced. Only
+# so many requests are let in at once, beyond that they are turned away with a 503
+# rather than queueing without limit.
+#
+#   POST /convert   {"path": "..."} or {"board": "<board.csv>", "components": "<components.csv>"}
+#                   returns {"components": n, "bom": "<out_bom.csv>", "cpl": "<out_cpl.csv>"}
+#   GET  /metrics   request counts, queue depth and latency percentiles
+#   GET  /health
+#
+
+# The number of recent request latencies kept for the percentiles
+SERVICE_LATENCY_WINDOW = 1000
+
+def service_worker(payload):
+    """
+    Convert a board in a service worker process, either from a path or from the
+    contents of the two CSV files.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if ("path" in payload):
+            file_path = payload["path"]
+        else:
+            file_path = os.path.join(tmp, "in")
+            os.makedirs(file_path)
+            for name in [ "board", "components" ]:
+                with open(os.path.join(file_path, name + ".csv"), "w", newline="") as fh:
+                    fh.write(payload[name])
+
+        board, table = process_board(file_path, tmp, batch_state["rotdb"], batch_state["mapping"])
+        result = { "components": len(table) }
+        for name in [ "bom", "cpl" ]:
+            with open(os.path.join(tmp, "out_" + name + ".csv"), newline="") as fh:
+                result[name] = fh.read()
+    return result
+
+def service_loop(connection, rotations_file, job):
+    """
+    The main loop of a service worker process, it is set up once (as in batch mode)
+    and then runs a job for each payload sent down the connection, sending back
+    (True, result) or (False, exception).
+    """
+    batch_init(rotations_file)
+    while (True):
+        try:
+            payload = connection.recv()
+        except EOFError:
+            return
+        try:
+            connection.send((True, job(payload)))
+        except Exception as e:
+            connection.send((False, e))
+
+class ServiceWorker():
+    """
+    A warm worker process that converts one board at a time, and that can be killed
+    (and replaced) if a conversion takes too long.
+    """
+    def __init__(self, rotations_file, job):
+        import multiprocessing
+
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=service_loop, args=(child, rotations_file, job), daemon=True)
+        self.process.start()
+        child.close()
+
+    def run(self, payload, timeout):
+        """
+        Run the job for a payload, returning the result (or raising the exception it
+        raised). Returns None if it hasn't finished within timeout seconds, the worker
+        is then in an unknown state and must be killed.
+        """
+        self.connection.send(payload)
+        if (not self.connection.poll(max(timeout, 0))):
+            return None
+        ok, result = self.connection.recv()
+        if (not ok):
+            raise result
+        return result
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+class ConversionService():
+    """
+    A set of warm worker processes with a limit on the requests in progress (running
+    or waiting) and a timeout for each, along with the metrics of the requests. A
+    conversion that times out has its worker killed and replaced, so stuck requests
+    can't hold on to the workers.
+    """
+    def __init__(self, rotations_file, workers=None, queue=None, timeout=30.0, job=service_worker):
+        self.rotations_file = rotations_file
+        self.job = job
+        self.workers = workers or os.cpu_count() or 1
+        self.limit = self.workers + (self.workers if (queue is None) else queue)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.available = threading.Condition(threading.Lock())
+        self.idle = [ ServiceWorker(rotations_file, job) for i in range(self.workers) ]
+        self.in_flight = 0
+        self.counts = { "requests": 0, "ok": 0, "errors": 0, "rejected": 0, "timeouts": 0 }
+        self.latencies = collections.deque(maxlen=SERVICE_LATENCY_WINDOW)
+
+    def convert(self, payload):
+        """
+        Convert a board as per the request payload, returning an HTTP status and the
+        response (a dict). The timeout covers waiting for a worker as well.
+        """
+        start = time.perf_counter()
+        with self.lock:
+            self.counts["requests"] += 1
+            if (self.in_flight >= self.limit):
+                self.counts["rejected"] += 1
+                return 503, { "error": "Too many requests in progress, try again later" }
+            self.in_flight += 1
+
+        try:
+            if (not isinstance(payload, dict) or not ("path" in payload or ("board" in payload and "components" in payload))):
+                return self.record(400, { "error": "Need a path, or board and components" }, start)
+
+            deadline = start + self.timeout
+            worker = self.take(deadline)
+            if (worker is None):
+                return self.timedOut(start)
+            try:
+                result = worker.run(payload, deadline - time.perf_counter())
+            except InvalidData as e:
+                self.give(worker)
+                return self.record(422, { "error": e.args[-1] }, start)
+            except (EOFError, OSError):
+                self.replace(worker)            # the worker died
+                return self.record(500, { "error": "The conversion worker failed" }, start)
+            except Exception as e:
+                self.give(worker)
+                return self.record(500, { "error": repr(e) }, start)
+
+            if (result is None):
+                self.replace(worker)            # it's still busy, so stop it
+                return self.timedOut(start)
+            self.give(worker)
+            return self.record(200, result, start)
+        finally:
+            self.finished()
+
+    def take(self, deadline):
+        """
+        Take an idle worker, waiting until the deadline for one (None if none came free)
+        """
+        with self.available:
+            while (not self.idle):
+                remaining = deadline - time.perf_counter()
+                if (remaining <= 0):
+                    return None
+                self.available.wait(remaining)
+            return self.idle.pop()
+
+    def give(self, worker):
+        with self.available:
+            self.idle.append(worker)
+            self.available.notify()
+
+    def replace(self, worker):
+        """
+        Kill a worker and put a new one in its place
+        """
+        worker.kill()
+        self.give(ServiceWorker(self.rotations_file, self.job))
+
+    def timedOut(self, start):
+        with self.lock:
+            self.counts["timeouts"] += 1
+        return self.record(504, { "error": "Timed out after %gs" % self.timeout }, start)
+
+    def finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def record(self, status, response, start):
+        """
+        Record the outcome and latency of a request, passing the response through.
+        """
+        with self.lock:
+            if (status == 200):
+                self.counts["ok"] += 1
+                self.latencies.append((time.perf_counter() - start) * 1000.0)
+            elif (status != 504):
+                self.counts["errors"] += 1
+        return status, response
+
+    def metrics(self):
+        """
+        Return the metrics: request counts, work in progress and the latency
+        percentiles (in ms) of the recent successful requests.
+        """
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64)
+            metrics = dict(self.counts, workers=self.workers, limit=self.limit, in_flight=self.in_flight,
+                            queue_depth=max(self.in_flight - self.workers, 0))
+        metrics["latency_ms"] = { "count": len(latencies) }
+        if (len(latencies)):
+            for p in [ 50, 90, 99 ]:
+                metrics["latency_ms"]["p%d" % p] = float(np.percentile(latencies, p))
+            metrics["latency_ms"]["max"] = float(latencies.max())
+        return metrics
+
+    def close(self):
+        with self.available:
+            for worker in self.idle:
+                worker.kill()
+            self.idle = []
+
+class ServiceHandler():
+    """
+    The HTTP front end to the ConversionService (self.server.service), mixed in with
+    http.server's request handler by service_server().
+    """
+    def do_GET(self):
+        if (self.path == "/metrics"):
+            self.reply(200, self.server.service.metrics())
+        elif (self.path == "/health"):
+            self.reply(200, { "ok": True })
+        else:
+            self.reply(404, { "error": "Not found" })
+
+    def do_POST(self):
+        if (self.path != "/convert"):
+            self.reply(404, { "error": "Not found" })
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.reply(400, { "error": "The request isn't valid JSON" })
+            return
+        self.reply(*self.server.service.convert(payload))
+
+    def reply(self, status, response):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if (status == 503):
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def service_server(service, host="127.0.0.1", port=0):
+    """
+    Create the HTTP server for a ConversionService (port 0 picks a free port, see
+    server.server_address), call serve_forever() to run it.
+    """
+    import http.server
+
+    handler = type("ServiceRequestHandler", (ServiceHandler, http.server.BaseHTTPRequestHandler), {})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+def run_service(rotations_file, host, port, workers=None, queue=None, timeout=30.0):
+    """
+    Run the conversion service until interrupted.
+    """
+    service = ConversionService(rotations_file, workers, queue, timeout)
+    server = service_server(service, host, port)
+    print ("Conversion service on http://%s:%d/ (%d workers, up to %d requests in progress)" %
+            (server.server_address[0], server.server_address[1], service.workers, service.limit))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+# --------------------------------------------------------------------------------------
+# TEST CASES
+# --------------------------------------------------------------------------------------
+
+def slow_service_worker(payload):
+    """
+    A service job that takes as long as the payload says (for testing timeouts), it
+    is outside the tests below so that worker processes can always find it.
+    """
+    time.sleep(payload.get("sleep", 0))
+    return service_worker(payload)
+
+#
+# The tests are only defined when they are run (-T), so that other runs (and importing
+# this as a library) don't import unittest and the modules only the tests use.
+#
+if (__name__ == "__main__" and sys.argv[1:2] == [ "-T" ]):
+    import unittest                             # for testing
+    import tempfile                             # for test fixtures
+    import shutil, subprocess                   # for running headless tests
+    import urllib.request, urllib.error         # for testing the service
+
+    class Dummy():
+        """
+        A dummy object to help with unit testing, we can manually set attributes to
+        simulate an object that will have methods called.
+        """
+        def __init__(self):
+            pass
+
+
+    class TestSupportingFunctions(unittest.TestCase):
+
+        def test_kicad_num(self):
+            self.assertEqual(kicad_num("123450000"), 123.45)
+            self.assertEqual(kicad_num("0"), 0.00)
+            self.assertEqual(kicad_num("-100500000"), -100.5)
+
+        def test_reftype(self):
+            self.assertEqual(reftype("R100"), "R")
+            self.assertEqual(reftype("FB101"), "FB")
+            self.assertEqual(reftype("q100"), "Q")
+            self.assertEqual(reftype("+45"), "+45")
+            self.assertEqual(reftype("ABC"), "ABC")
+            self.assertEqual(reftype("XY99Z"), "XY")
+
+        def test_rotdb(self):
+            rdb = RotDB("rotations.cf")
+            self.assertEqual(rdb.possible_rotate("non-matching-footprint"), 0)
+            self.assertEqual(rdb.possible_rotate("SOT-23"), 180)
+            self.assertEqual(rdb.possible_rotate("TDK_ATB"), 90)
+
+        def test_rotdb_first_match(self):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filename = os.path.join(tmpdir, "rot.cf")
+                with open(filename, "w") as fh:
+                    fh.write("^Pulse_PH9585_TDK  90\n"
+                             "^Pulse_PH9585      270\n"
+                             "_ATB               45    # unanchored, but after the ^Pulse rules\n"
+                             "^SOT-23            180\n"
+                             "^SOT-23-5          0     # never used, shadowed by ^SOT-23\n")
+                rdb = RotDB(filename, cache_size=16)
+            self.assertEqual(rdb.possible_rotate("Pulse_PH9585_TDK_ATB"), 90)
+            self.assertEqual(rdb.possible_rotate("Pulse_PH9585_ATB"), 270)
+            self.assertEqual(rdb.possible_rotate("Other_ATB"), 45)
+            self.assertEqual(rdb.possible_rotate("SOT-23-5"), 180)
+            self.assertEqual(rdb.possible_rotate("SOT-2"), 0)
+            self.assertEqual(rdb.possible_rotate("SOT-23-5"), 180)
+            info = rdb.cache_info()
+            self.assertEqual(info.hits, 1)
+            self.assertEqual(info.misses, 5)
+
+        def test_board(self):
+            board = Board()
+            board.addPoint(200, 400)
+            board.addPoint(200, 500)
+            board.addPoint(300, 500)
+            board.addPoint(300, 400)
+            board.shiftToZero()
+            self.assertEqual(board.xlist, [0, 0, 100, 100])
+            self.assertEqual(board.ylist, [0, 100, 100, 0])
+
+            def dummy_patch(xl, yl, **kwargs):
+                self.assertEqual(xl, [0, 0, 100, 100, 0])
+                self.assertEqual(yl, [0, 100, 100, 0, 0])
+                self.assertEqual(kwargs["foo"], 100)
+                self.assertEqual(kwargs["bar"], 200)
+
+            plot = Dummy()
+            setattr(plot, "patch", dummy_patch)
+            board.draw(plot, foo=100, bar=200)
+
+            # Single points and arrays of them can be mixed, and keep their order
+            board = Board()
+            board.addPoint(1, 2)
+            board.addPoints(np.array([ 3.0, 4.0 ]), np.array([ 5.0, 6.0 ]))
+            board.addPoint(7, 8)
+            self.assertEqual((board.xlist, board.ylist, board.minx, board.miny), ([ 1, 3, 4, 7 ], [ 2, 5, 6, 8 ], 1, 2))
+
+        def test_component(self):
+            # Create Dummy() board for minx/miny values
+            board = Dummy()
+            setattr(board, "minx", 100)
+            setattr(board, "miny", 200)
+            fields = { "ref": "R100", "value": "1k", "layer": "F.Cu", "footprint": "0402", "lcsc": "", 
+                        "x": str(500*1000000), "y": str(300*1000000), "rot": str(0),
+                        "left": str(480*1000000), "top": str(290*1000000), 
+                        "right": str(520*1000000), "bottom": str(310*1000000) }
+            # Test Component is created...
+            comp = Component(board, fields)
+            self.assertIsNotNone(comp)
+            # Check the re-alignment to the board is ok...
+            self.assertEqual(comp.plotter.origin.x, 380)
+            self.assertEqual(comp.plotter.origin.y, 90)
+            self.assertEqual(comp.plotter.size.w, 40)
+            self.assertEqual(comp.plotter.size.h, 20)
+            # Check it fails if fields are wrong...
+            del fields["footprint"]
+            with self.assertRaises(InvalidData):
+                comp = Component(board, fields)
+
+        def test_transform_symbol(self):
+            points = Resistor.SYMBOL
+            # Unrotated is just a scale and shift of the unit square...
+            xs, ys = transform_symbol(points, [10, 20], [5, 5], [2, 4], [1, 1], [0, 0])
+            self.assertEqual(xs.shape, (2, points.shape[1]))
+            np.testing.assert_allclose(xs[1], 20 + 4 * points[0])
+            np.testing.assert_allclose(ys[0], 5 + points[1])
+            # At 90 degrees the right hand lead (0.9, 0.5) ends up at the top centre...
+            xs, ys = transform_symbol(np.array([[0.9], [0.5]]), [0], [0], [2], [4], [90])
+            self.assertAlmostEqual(xs[0][0], 1.0)
+            self.assertAlmostEqual(ys[0][0], 0.4)
+            # The class symbol is shared and can't be changed by drawing...
+            self.assertIs(FerriteBead.SYMBOL, Resistor.SYMBOL)
+            self.assertFalse(points.flags.writeable)
+
+        def test_batchplot(self):
+            board = Dummy()
+            setattr(board, "minx", 0)
+            setattr(board, "miny", 0)
+            fields = { "value": "1k", "layer": "F.Cu", "footprint": "0402", "lcsc": "",
+                        "x": "0", "y": "0", "rot": "0", "left": "0", "top": "0",
+                        "right": str(2*1000000), "bottom": str(1*1000000) }
+            batch = BatchPlot()
+            for ref in [ "R1", "R2", "R3" ]:
+                Resistor(board, dict(fields, ref=ref)).draw(batch)
+            Unknown(board, dict(fields, ref="X1")).draw(batch)
+
+            calls = []
+            def glyph(name):
+                return lambda source, **kwargs: calls.append((name, len(source.data[kwargs["x"]])))
+            plot = Dummy()
+            for name in [ "block", "line", "ellipse" ]:
+                setattr(plot, name, glyph(name))
+            batch.flush(plot)
+
+            # One outline block for all four, one line glyph for the resistors (their 11
+            # point symbols each ended by a NaN) and one hatch
+            self.assertEqual(sorted(calls), [ ("block", 1), ("block", 4), ("line", 36) ])
+            self.assertEqual(batch.groups, {})
+
+        def test_board_levels(self):
+            # A 50mm radius round board with a point every 0.1 degrees
+            angles = np.radians(np.arange(3600) / 10.0)
+            board = Board()
+            board.addPoints(50 + 50 * np.cos(angles), 50 + 50 * np.sin(angles))
+            board.shiftToZero()
+
+            xs, ys = board.simplify(0.01)
+            self.assertLess(len(xs), 300)
+            # No chord strays more than the tolerance from the arc
+            kept = np.sort(np.arctan2(ys - 50, xs - 50))
+            gaps = np.diff(np.append(kept, kept[0] + 2 * math.pi))
+            self.assertLessEqual(float(np.max(50 * (1 - np.cos(gaps / 2)))), 0.01 + 1e-9)
+
+            levels = board.levels(0.01)
+            self.assertGreater(len(levels), 2)
+            counts = [ len(xs) for t, xs, ys in levels ]
+            self.assertEqual(counts, sorted(counts, reverse=True))
+
+            from bokeh.plotting import figure
+            plot = figure()
+            board.drawLevels(plot, 0.01)
+            self.assertEqual(len(plot.renderers), 1)
+            self.assertEqual(len(plot.x_range.js_property_callbacks["change:start"]), 1)
+
+        def test_kicad_pcb(self):
+            # The direct parse should agree with what the plugin exported from the same board
+            here = os.path.dirname(os.path.abspath(__file__))
+            outline, records = read_kicad_pcb(os.path.join(here, "sample", "test_board.kicad_pcb"))
+            with open(os.path.join(here, "sample", "board.csv")) as bfile:
+                expected = [ (int(row["x"]), int(row["y"])) for row in csv.DictReader(bfile) ]
+            self.assertEqual(sorted(outline), sorted(expected))
+
+            with open(os.path.join(here, "sample", "components.csv")) as cfile:
+                expected = { row["ref"]: row for row in csv.DictReader(cfile) }
+            self.assertEqual(sorted(r["ref"] for r in records), sorted(expected))
+            for record in records:
+                row = expected[record["ref"]]
+                for f in [ "value", "layer", "footprint", "lcsc" ]:
+                    self.assertEqual(record[f], row[f])
+                for f in [ "x", "y", "rot", "top", "left", "bottom", "right" ]:
+                    self.assertAlmostEqual(record[f], float(row[f]), delta=1)
+
+        def test_sexpr(self):
+            tokens = sexpr_tokens(io.StringIO('(kicad_pcb (version 1) (segment (start 0 0))\n'
+                                    '(gr_line (start 0 0) (end "1" 2) (layer "Edge \\"Cuts\\""))\n)\n'))
+            items = list(sexpr_items(tokens, ("gr_line",)))
+            self.assertEqual(items, [ ("gr_line", [ "gr_line", [ "start", "0", "0" ], [ "end", "1", "2" ],
+                                        [ "layer", 'Edge "Cuts"' ] ]) ])
+            # Three quarters of a circle, going the long way round through mid...
+            points = arc_points((1, 0), (-1, 0), (0, -1))
+            self.assertAlmostEqual(points[-1][0], 0)
+            self.assertAlmostEqual(points[-1][1], -1)
+            self.assertTrue(any(y > 0.99 for x, y in points))
+
+        def test_batch(self):
+            here = os.path.dirname(os.path.abspath(__file__))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                paths = [ os.path.join(here, "sample"), os.path.join(here, "sample", "test_board.kicad_pcb"),
+                            os.path.join(tmpdir, "missing") ]
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results = run_batch(paths, tmpdir, os.path.join(here, "rotations.cf"), workers=2)
+                self.assertEqual([ r["path"] for r in results ], paths)
+                self.assertEqual(results[0]["components"], 109)
+                self.assertEqual(results[1]["components"], 109)
+                self.assertIn("error", results[2])
+                for name in [ "sample", "test_board" ]:
+                    self.assertTrue(os.path.isfile(os.path.join(tmpdir, name, "out_cpl.csv")))
+            self.assertEqual(output_names([ "a/board", "b/board/", "board.kicad_pcb" ]), [ "board", "board-2", "board-3" ])
+
+        def test_incremental(self):
+            here = os.path.dirname(os.path.abspath(__file__))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                indir = os.path.join(tmpdir, "in")
+                outdir = os.path.join(tmpdir, "out")
+                os.makedirs(indir)
+                for f in [ "board.csv", "components.csv" ]:
+                    shutil.copy(os.path.join(here, "sample", f), indir)
+                rotfile = os.path.join(tmpdir, "rotations.cf")
+                shutil.copy(os.path.join(here, "rotations.cf"), rotfile)
+
+                def build():
+                    return process_board_incremental(indir, outdir, RotDB(rotfile), rotfile)[2]
+
+                report = build()
+                self.assertEqual((report["changed"], report["bom"], report["cpl"]), (109, "written", "written"))
+                with open(os.path.join(outdir, "out_cpl.csv"), "rb") as fh:
+                    first = fh.read()
+                self.assertEqual(build()["reused"], 109)
+
+                # Move one part, only that row is recomputed and the BOM stays as it was...
+                with open(os.path.join(indir, "components.csv")) as fh:
+                    text = fh.read()
+                with open(os.path.join(indir, "components.csv"), "w") as fh:
+                    fh.write(text.replace("C122,0.1uF,F.Cu,C_0402_1005Metric,C1525,142750000",
+                                            "C122,0.1uF,F.Cu,C_0402_1005Metric,C1525,142760000"))
+                report = build()
+                self.assertEqual((report["changed"], report["reused"]), (1, 108))
+                self.assertEqual((report["bom"], report["cpl"]), ("unchanged", "written"))
+
+                # A new rotation only recomputes the rows that use that footprint...
+                with open(rotfile, "a") as fh:
+                    fh.write("^D_SOD-323    90\n")
+                report = build()
+                self.assertEqual((report["changed"], report["rotated"]), (0, 4))
+
+                # And the result is the same as a full build, byte for byte
+                process_board(indir, tmpdir, RotDB(rotfile))
+                for name in [ "out_bom.csv", "out_cpl.csv" ]:
+                    with open(os.path.join(tmpdir, name), "rb") as a, open(os.path.join(outdir, name), "rb") as b:
+                        full = a.read()
+                        self.assertEqual(full, b.read())
+                    self.assertNotIn(b"\r\r\n", full)
+                self.assertNotEqual(first, full)
+
+        def test_incremental_check(self):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                # The checks are reported even when nothing has changed since the last run
+                for run in range(2):
+                    out = io.StringIO()
+                    with contextlib.redirect_stdout(out):
+                        main([ "-i", "--check", "--no-viz", "-o", tmpdir, "sample" ])
+                    self.assertIn("Check: ", out.getvalue())
+                self.assertIn("nothing changed", out.getvalue())
+
+        def test_incremental_catalogue(self):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with open(os.path.join(tmpdir, "parts.csv"), "w", newline="", encoding="utf-8") as fh:
+                    writer = csv.writer(fh)
+                    writer.writerow([ "LCSC Part", "MFR.Part", "Package", "Library Type", "Description", "Stock" ])
+                    writer.writerow([ "C1525", "CL05B104KO5NNNC", "0402", "Basic", "50V 100nF X7R ±10% 0402", "1000" ])
+                db = os.path.join(tmpdir, "parts.db")
+                import_catalogue(os.path.join(tmpdir, "parts.csv"), db)
+
+                # The catalogue isn't one of the inputs, so it is checked even with no changes
+                for run in range(2):
+                    out = io.StringIO()
+                    with contextlib.redirect_stdout(out):
+                        main([ "-i", "--catalogue", db, "--no-viz", "-o", tmpdir, "sample" ])
+                    self.assertIn("Catalogue: ", out.getvalue())
+                self.assertIn("nothing changed", out.getvalue())
+
+        def test_component_table(self):
+            here = os.path.dirname(os.path.abspath(__file__))
+            board = load_board(os.path.join(here, "sample", "board.csv"))
+            with open(os.path.join(here, "sample", "components.csv")) as cfile:
+                rows = list(csv.DictReader(cfile))
+            components = [ CLASS_MAPPING.get(reftype(row["ref"]), Unknown)(board, row) for row in rows ]
+            table = ComponentTable.fromRecords(board, rows)
+            rotdb = RotDB(os.path.join(here, "rotations.cf"))
+
+            # The columnar BOM/CPL are the same as building them from Component objects...
+            self.assertEqual(table.bom(), build_bom(components))
+            self.assertEqual(list(table.placementRows(rotdb)), build_placement(components, rotdb))
+            self.assertEqual(build_bom(table), build_bom(components))
+
+            # Views behave like the Component they stand in for...
+            view = table.view(3)
+            self.assertIsInstance(view, Capacitor)
+            self.assertEqual((view.getName(), view.getBOMKey()), (components[3].getName(), components[3].getBOMKey()))
+            self.assertEqual((view.x, view.y, view.rot), (components[3].x, components[3].y, components[3].rot))
+            self.assertAlmostEqual(view.plotter.origin.x, components[3].plotter.origin.x)
+            self.assertAlmostEqual(view.plotter.size.h, components[3].plotter.size.h)
+
+            # Strings are held once...
+            self.assertEqual(len(table.footprint.categories), len(set(row["footprint"] for row in rows)))
+            self.assertEqual(list(table.dataFrame()["Type"]), [ c.getName() for c in components ])
+
+            with self.assertRaises(InvalidData):
+                ComponentTable.fromRecords(board, [ { "ref": "R1" } ])
+
+        def test_reftypes(self):
+            refs = [ "R100", "R101", "FB101", "q100", "q", "+45", "ABC", "XY99Z", "100", "", "U1" ]
+            self.assertEqual(list(reftypes(refs)), [ reftype(r) for r in refs ])
+            self.assertEqual(len(reftypes([])), 0)
+
+        def test_bulk_load(self):
+            # The column loaders give byte-identical outputs to the row by row readers
+            here = os.path.dirname(os.path.abspath(__file__))
+            rotdb = RotDB(os.path.join(here, "rotations.cf"))
+            board = Board()
+            with open(os.path.join(here, "sample", "board.csv")) as bfile:
+                for row in csv.DictReader(bfile):
+                    board.addPoint(kicad_num(row["x"]), kicad_num(row["y"]))
+            board.shiftToZero()
+            fast = load_board(os.path.join(here, "sample", "board.csv"))
+            self.assertEqual((fast.xlist, fast.ylist, fast.minx, fast.miny), (board.xlist, board.ylist, board.minx, board.miny))
+
+            with open(os.path.join(here, "sample", "components.csv")) as cfile:
+                rows = list(csv.DictReader(cfile))
+            components = [ CLASS_MAPPING.get(reftype(row["ref"]), Unknown)(board, row) for row in rows ]
+            table = load_components(os.path.join(here, "sample", "components.csv"), fast)
+
+            for writer, a, b in [ (write_bom_csv, build_bom(components), table.bom()),
+                                    (write_cpl_csv, build_placement(components, rotdb), table.placementRows(rotdb)) ]:
+                expected, actual = io.StringIO(), io.StringIO()
+                writer(expected, a)
+                writer(actual, b)
+                self.assertEqual(actual.getvalue(), expected.getvalue())
+
+        def test_profiler(self):
+            profiler = Profiler()
+            with profiler.phase("work"):
+                square = profiler.timed("square", lambda x: x * x, key=lambda x: "odd" if (x % 2) else "even")
+                self.assertEqual([ square(i) for i in range(5) ], [ 0, 1, 4, 9, 16 ])
+            profiler.stop()
+            report = profiler.report(top=1)
+            self.assertEqual([ p["name"] for p in report["phases"] ], [ "work" ])
+            self.assertEqual(report["calls"]["square"]["calls"], 5)
+            json.dumps(report)
+
+            # When off, nothing is wrapped at all
+            func = lambda x: x
+            self.assertIs(NULL_PROFILER.timed("f", func), func)
+
+        def test_streaming(self):
+            rotdb = RotDB("rotations.cf")
+            board, table = load_input("sample")
+            with tempfile.TemporaryDirectory() as tmp:
+                self.assertEqual(process_board_streaming("sample", tmp, rotdb), len(table))
+                out = io.StringIO()
+                write_bom_csv(out, table.bom())
+                with open(os.path.join(tmp, "out_bom.csv"), newline="") as fh:
+                    self.assertEqual(fh.read(), out.getvalue())
+                out = io.StringIO()
+                write_cpl_csv(out, table.placementRows(rotdb))
+                with open(os.path.join(tmp, "out_cpl.csv"), newline="") as fh:
+                    self.assertEqual(fh.read(), out.getvalue())
+
+            # Refs are kept compactly, but come back as a list per line
+            bom = StreamingBOM(board)
+            for ref in [ "R1", "R2", "R3" ]:
+                bom.add({ "ref": ref, "value": "10k", "footprint": "0402", "lcsc": "", "layer": "F.Cu",
+                            "x": "0", "y": "0", "rot": "0", "left": "0", "top": "0", "right": "0", "bottom": "0" })
+            self.assertEqual([ info["refs"] for key, info in bom.items() ], [ [ "R1", "R2", "R3" ] ])
+
+        def test_design_checks(self):
+            # An L shaped board
+            board = Board()
+            board.addPoints([ 0, 20, 20, 10, 10, 0 ], [ 0, 0, 10, 10, 20, 20 ])
+            board.shiftToZero()
+            self.assertEqual(points_in_polygon([ 5, 15, 15, 5, 10 ], [ 5, 5, 15, 15, -1 ], board.xs, board.ys).tolist(),
+                                [ True, True, False, True, False ])
+
+            def part(ref, x, y, w, h, layer="F.Cu"):
+                return { "ref": ref, "value": "", "layer": layer, "footprint": "", "lcsc": "",
+                            "x": x * 1000000, "y": y * 1000000, "rot": 0,
+                            "left": (x - w/2) * 1000000, "right": (x + w/2) * 1000000,
+                            "top": (y - h/2) * 1000000, "bottom": (y + h/2) * 1000000 }
+            table = ComponentTable.fromRecords(board, [
+                part("R1", 2, 2, 2, 2), part("R2", 3, 3, 2, 2),     # overlap
+                part("R3", 5, 2, 2, 2),                             # touches R2's corner only
+                part("R4", 3, 3, 2, 2, "B.Cu"),                     # under R2
+                part("C1", 15, 15, 1, 1),                           # in the notch
+                part("C2", 19.5, 5, 2, 2) ])                        # hanging off the edge
+            report = check_board(board, table, 0)
+            self.assertEqual(report, { "overlaps": [ ("R1", "R2") ], "off_board": [ "C1" ], "overhanging": [ "C2" ] })
+
+            # The grid finds the same pairs as comparing everything with everything, on a
+            # square layout and on a tall strip (with a few large parts)
+            rng = np.random.default_rng(1)
+            for width, height in [ (100, 100), (5, 2000) ]:
+                x, y = rng.uniform(0, width, 500), rng.uniform(0, height, 500)
+                size = np.where(np.arange(500) % 50 == 0, 12, 3)
+                table = ComponentTable.fromRecords(board, [ part("R%d" % i, x[i], y[i], size[i], 2) for i in range(500) ])
+                naive = [ (a, b) for a in range(500) for b in range(a + 1, 500)
+                            if table.left[a] < table.right[b] and table.left[b] < table.right[a]
+                                and table.top[a] < table.bottom[b] and table.top[b] < table.bottom[a] ]
+                self.assertEqual([ tuple(p) for p in courtyard_overlaps(table, 0).tolist() ], naive)
+                self.assertLess(len(courtyard_overlaps(table)), len(naive))
+
+        def test_panelize(self):
+            board, table = load_input("sample")
+            rotdb = RotDB("rotations.cf")
+            n = len(table)
+            width = float(board.xs.max())
+            height = float(board.ys.max())
+
+            frame, panel, suffixes = panelize(board, table, 2, 3, rails=(5.0, 0.0))
+            self.assertEqual((len(panel), suffixes[-1]), (6 * n, "_6"))
+            self.assertAlmostEqual(float(frame.xs.max()), 3 * width + 10.0)
+            self.assertAlmostEqual(float(frame.ys.max()), 2 * height)
+
+            # The last instance (row 2, column 3) is the board moved by the pitch, exactly
+            base = list(table.placementRows(rotdb))
+            last = list(panel.placementRows(rotdb))[5*n:]
+            self.assertEqual([ r["Designator"] for r in last ], [ r["Designator"] + "_6" for r in base ])
+            self.assertEqual([ r["Rotation"] for r in last ], [ r["Rotation"] for r in base ])
+            self.assertTrue(np.array_equal(panel.x[5*n:], table.x + (5.0 + 2 * width) * 1000000.0))
+            self.assertTrue(np.allclose(panel.top[5*n:], table.top + height))
+
+            # The BOM is the single board BOM multiplied, the same as building it afresh
+            bom = panel_bom(table.bom(), suffixes)
+            self.assertEqual(bom, panel.bom())
+            self.assertEqual(sum(len(line["refs"]) for line in bom.values()), 6 * n)
+
+            # A board turned 180 degrees lands mirrored in its own place
+            frame, panel, suffixes = panelize(board, table, 1, 2, rotations=[ 0, 180 ])
+            self.assertTrue(np.allclose(panel.x[n:] / 1000000.0 - board.minx, 2 * width - (table.x / 1000000.0 - board.minx)))
+            self.assertTrue(np.allclose(panel.left[n:], 2 * width - table.right))
+            self.assertTrue(np.allclose(panel.rot[n:], table.rot + 180))
+            with self.assertRaises(InvalidData):
+                panelize(board, table, 1, 2, rotations=[ 0, 90, 180 ])
+
+            self.assertEqual(panel_size("2x3"), (2, 3))
+            self.assertEqual(mm_pair("5"), (5.0, 5.0))
+
+        def test_placement_order(self):
+            # Points along a line, shuffled, are toured end to end
+            xs = np.random.default_rng(1).permutation(100).astype(np.float64)
+            ys = np.zeros(100)
+            tour = grid_tour(xs, ys, int(np.argmin(xs)))
+            self.assertEqual(xs[tour].tolist(), list(range(100)))
+
+            # 2-opt undoes the doubling back of 0-2-1-3 along a line
+            xs = np.array([ 0.0, 1.0, 2.0, 3.0 ])
+            ys = np.zeros(4)
+            self.assertEqual(two_opt(xs, ys, np.array([ 0, 2, 1, 3 ]), time.perf_counter() + 1).tolist(), [ 0, 1, 2, 3 ])
+
+            board, table = load_input("sample")
+            order, report = placement_order(table)
+            self.assertEqual(sorted(order.tolist()), list(range(len(table))))
+            self.assertLess(report["after_mm"], report["before_mm"])
+
+            # Each BOM line (top layer first) is placed in one go
+            keys = table.bomKeys()
+            lines = [ keys[i] for i in order.tolist() ]
+            self.assertEqual(len([ k for k, _ in itertools.groupby(lines) ]), report["groups"])
+            layers = [ table.layer[i] for i in order.tolist() ]
+            self.assertEqual(layers, sorted(layers, key=lambda layer: layer != "F.Cu"))
+
+            rotdb = RotDB("rotations.cf")
+            rows = list(table.placementRows(rotdb, order))
+            self.assertEqual([ r["Designator"] for r in rows ], [ table.ref[i] for i in order.tolist() ])
+            self.assertEqual(sorted(rows, key=lambda r: r["Designator"]),
+                                sorted(table.placementRows(rotdb), key=lambda r: r["Designator"]))
+
+        def test_value_normalisation(self):
+            self.assertEqual([ canonical_value(v, "F") for v in [ "0.1uF", "100n", "100nF", ".1u", "100 nF", "10uH", "X7R" ] ],
+                                [ "100nF", "100nF", "100nF", "100nF", "100nF", "10uH", "X7R" ])
+            self.assertEqual([ canonical_value(v, "Ω") for v in [ "4k7", "4K7", "4.7k", "4700", "4R7", "0R", "1M" ] ],
+                                [ "4.7kΩ", "4.7kΩ", "4.7kΩ", "4.7kΩ", "4.7Ω", "0Ω", "1MΩ" ])
+
+            board = Dummy()
+            setattr(board, "minx", 0)
+            setattr(board, "miny", 0)
+            fields = { "layer": "F.Cu", "footprint": "C_0402_1005Metric", "lcsc": "C1525", "x": "0", "y": "0",
+                        "rot": "0", "left": "0", "top": "0", "right": "0", "bottom": "0" }
+            table = ComponentTable.fromRecords(board, [ dict(fields, ref="C1", value="0.1uF"), dict(fields, ref="C2", value="100n"),
+                                                        dict(fields, ref="U1", value="100n"), dict(fields, ref="L1", value="100n") ])
+            bom = table.bom()
+
+            # The capacitors share a line (under the first value), the IC and inductor don't
+            self.assertEqual([ (info["Component"], info["refs"]) for info in bom.values() ],
+                                [ ("0.1uF", [ "C1", "C2" ]), ("100n", [ "U1" ]), ("100n", [ "L1" ]) ])
+            self.assertEqual(list(table.value), [ "0.1uF", "100n", "100n", "100n" ])
+
+        def test_catalogue(self):
+            self.assertEqual(parse_value("100nF"), parse_value("0.1uF"))
+            self.assertEqual([ parse_value(v) for v in [ "4k7", "4R7", "1Mohm", "BAT54" ] ],
+                                [ (4700.0, ""), (4.7, "Ω"), (1e6, "Ω"), None ])
+            self.assertEqual([ footprint_package(f) for f in [ "C_0402_1005Metric", "Resistor_SMD:R_0603_1608Metric", "SOT-23-3" ] ],
+                                [ "0402", "0603", "SOT-23-3" ])
+
+            with tempfile.TemporaryDirectory() as tmp:
+                with open(os.path.join(tmp, "parts.csv"), "w", newline="", encoding="utf-8") as fh:
+                    writer = csv.writer(fh)
+                    writer.writerow([ "LCSC Part", "MFR.Part", "Package", "Library Type", "Description", "Stock" ])
+                    writer.writerow([ "C1525", "CL05B104KO5NNNC", "0402", "Basic", "50V 100nF X7R ±10% 0402", "1000" ])
+                    writer.writerow([ "C307331", "CL05B104KB54PNC", "0402", "Extended", "100nF 50V X7R 0402", "9000" ])
+                    writer.writerow([ "C25744", "0402WGF1002TCE", "0402", "Basic", "10kΩ ±1% 0402", "0" ])
+                    writer.writerow([ "C2286", "KT-0603R", "0603", "Extended", "Red LED", "500" ])
+                db = os.path.join(tmp, "parts.db")
+                self.assertEqual(import_catalogue(os.path.join(tmp, "parts.csv"), db), 4)
+
+                catalogue = Catalogue(db)
+                self.assertEqual(sorted(catalogue.lookup([ "C1525", "c2286", "C999", "" ])), [ "C1525", "C2286" ])
+                self.assertEqual(catalogue.suggest("0.1uF", "C_0402_1005Metric", "F"), [ "C1525", "C307331" ])
+
+                def line(value, footprint, lcsc, ref):
+                    return { "Component": value, "Footprint": footprint, "JLCPCB": lcsc, "refs": [ ref ] }
+                bom = { "a": line("100n", "C_0402_1005Metric", "", "C1"), "b": line("10k", "R_0402_1005Metric", "C25744", "R1"),
+                        "c": line("LED", "LED_0603", "C2286", "D1"), "d": line("100nF", "C_0402_1005Metric", "C1525", "C2"),
+                        "e": line("1k", "R_0402_1005Metric", "C42", "R2") }
+                problems = check_bom(bom, catalogue)
+                catalogue.close()
+            self.assertEqual([ (p["key"], p["problem"]) for p in problems ],
+                                [ ("a", "missing"), ("b", "out of stock"), ("c", "extended"), ("e", "unknown") ])
+            self.assertEqual(problems[0]["suggestions"], [ "C1525", "C307331" ])
+
+        def test_watch(self):
+            with tempfile.TemporaryDirectory() as tmp:
+                board_dir = os.path.join(tmp, "board")
+                shutil.copytree("sample", board_dir)
+                watcher = Watcher(board_dir, os.path.join(tmp, "out"), "rotations.cf", debounce=1.0)
+
+                # The first build is everything, after that nothing happens until a change
+                self.assertEqual(watcher.rebuild()["changed"], 109)
+                self.assertIsNone(watcher.poll(now=0))
+                rotdb = watcher.rotdb
+
+                component_file = os.path.join(board_dir, "components.csv")
+                with open(component_file) as fh:
+                    text = fh.read()
+                with open(component_file, "w") as fh:
+                    fh.write(text.replace("12MHz", "16MHz"))
+                os.utime(component_file, ns=(1, 1))
+
+                # ...and then only once the files have been left alone for the debounce time
+                self.assertIsNone(watcher.poll(now=10.0))
+                self.assertIsNone(watcher.poll(now=10.5))
+                report = watcher.poll(now=11.0)
+                self.assertEqual((report["changed"], report["reused"], report["bom"]), (1, 108, "written"))
+                self.assertIs(watcher.rotdb, rotdb)
+                self.assertIsNone(watcher.poll(now=12.0))
+
+                # A new watcher on the same (already built) outputs still has the board to draw
+                watcher = Watcher(board_dir, os.path.join(tmp, "out"), "rotations.cf", need_components=True)
+                report = watcher.rebuild()
+                self.assertEqual((report["changed"], report["bom"], report["cpl"]), (0, "unchanged", "unchanged"))
+                self.assertIsNotNone(watcher.board)
+                self.assertEqual(len(watcher.table), 109)
+
+        def test_process_data(self):
+            # Numbers straight from the plugin give the same outputs as the CSV files
+            rotdb = RotDB("rotations.cf")
+            with open(os.path.join("sample", "board.csv")) as fh:
+                outline = [ (int(row["x"]), int(row["y"])) for row in csv.DictReader(fh) ]
+            with open(os.path.join("sample", "components.csv")) as fh:
+                records = list(csv.DictReader(fh))
+            columns = { f: [ r[f] for r in records ] for f in COMPONENT_FIELDS }
+            for f in [ "x", "y", "top", "left", "bottom", "right" ]:
+                columns[f] = [ int(v) for v in columns[f] ]
+            columns["rot"] = [ float(v) for v in columns["rot"] ]
+
+            with tempfile.TemporaryDirectory() as tmp:
+                process_board("sample", os.path.join(tmp, "csv"), rotdb)
+                board, table = process_data(([ x for x, y in outline ], [ y for x, y in outline ]), columns,
+                                                os.path.join(tmp, "data"), rotdb)
+                self.assertEqual(len(table), len(records))
+                for name in [ "out_bom.csv", "out_cpl.csv" ]:
+                    with open(os.path.join(tmp, "csv", name), "rb") as a, open(os.path.join(tmp, "data", name), "rb") as b:
+                        self.assertEqual(a.read(), b.read())
+
+        def test_report(self):
+            board, table = load_input("sample")
+            layout, d = visualise_layout(board, table)
+            self.assertEqual(layout.children[0].output_backend, "webgl")
+
+            # The glyph columns are numpy arrays (sent as binary, not JSON lists)
+            sources = [ r.data_source for r in layout.children[0].renderers ]
+            self.assertTrue(all(isinstance(v, np.ndarray) for s in sources for v in s.data.values()))
+
+            with tempfile.TemporaryDirectory() as tmp:
+                save_report(layout, os.path.join(tmp, "report.html"))
+                with open(os.path.join(tmp, "report.html"), encoding="utf-8") as fh:
+                    html = fh.read()
+            self.assertIn("PCB layout", html)
+            self.assertIn('"type":"ndarray"', html.replace(" ", ""))
+
+        def test_density(self):
+            board, table = load_input("sample")
+            (x, y, width, height), grids = density_grids(table, bins=32)
+            area = np.abs((table.right - table.left) * (table.bottom - table.top))
+            size = max(width, height) / 32
+
+            # Nothing is lost in the binning, and the layers and types add up
+            self.assertAlmostEqual(float(grids["All"].sum()) * size * size, float(area.sum()), places=6)
+            self.assertTrue(np.allclose(sum(grids[layer] for layer in table.layer.categories), grids["All"]))
+            self.assertTrue(np.allclose(sum(g for name, g in grids.items() if name.startswith("F.Cu ")), grids["F.Cu"]))
+            self.assertIn("F.Cu Capacitor", grids)
+
+            # Over the threshold there is a single image (and a choice of grid) instead
+            layout, d = visualise_layout(board, table, density_threshold=50)
+            select, plot = layout.children[:2]
+            self.assertEqual(select.options[0], "All")
+            self.assertEqual([ type(r.glyph).__name__ for r in plot.renderers ], [ "Patch", "Image" ])
+
+        def test_diff(self):
+            with open(os.path.join("sample", "components.csv"), newline="") as fh:
+                rows = list(csv.DictReader(fh))
+            parts = { r["ref"]: r for r in rows }
+            parts["C122"]["x"] = str(int(parts["C122"]["x"]) + 500000)                   # moved 0.5mm
+            parts["C100"]["rot"] = "90.0"                                                # rotated
+            parts["R1"].update(value="10K", lcsc="C25744")                               # splits the 12K line
+            parts["R212"].update(value="1M", lcsc="C26083")                              # merges into 1M
+            parts["R2"]["value"] = "12k"                                                 # same BOM line
+            added = dict(parts["R213"], ref="R300")
+            rows = [ r for r in rows if r["ref"] != "R209" ] + [ added ]
+
+            with tempfile.TemporaryDirectory() as tmp:
+                shutil.copy(os.path.join("sample", "board.csv"), tmp)
+                with open(os.path.join(tmp, "components.csv"), "w", newline="") as fh:
+                    writer = csv.DictWriter(fh, fieldnames=COMPONENT_FIELDS)
+                    writer.writeheader()
+                    writer.writerows(rows)
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    report = run_diff("sample", tmp, tmp, RotDB("rotations.cf"), viz=False)
+                with open(os.path.join(tmp, "out_diff.json")) as fh:
+                    self.assertEqual(json.load(fh)["summary"], report["summary"])
+
+                # The overlay plot draws each kind of change
+                layout = diff_layout(*load_input("sample"), *load_input(tmp), report)
+                self.assertEqual(layout.children[1].title.text, "PCB changes")
+                self.assertEqual(sorted(item.label.value for item in layout.children[1].legend[0].items),
+                                    [ "added", "changed", "moved/rotated", "removed" ])
+
+            self.assertEqual([ a["ref"] for a in report["added"] ], [ "R300" ])
+            self.assertEqual([ r["ref"] for r in report["removed"] ], [ "R209" ])
+            changes = { c["ref"]: c["changes"] for c in report["changed"] }
+            self.assertEqual(changes, { "C122": [ "moved" ], "C100": [ "rotated" ], "R2": [ "value" ],
+                                        "R1": [ "value", "lcsc", "bom line" ], "R212": [ "value", "lcsc", "bom line" ] })
+            self.assertAlmostEqual(report["changed"][[ c["ref"] for c in report["changed"] ].index("C122")]["moved_mm"], 0.5)
+
+            bom = report["bom"]
+            self.assertEqual(bom["added"], [ "10kΩ//R_0402_1005Metric//C25744" ])
+            self.assertEqual(sorted(bom["removed"]), [ "100Ω//R_0402_1005Metric//C25076", "10Ω//R_0402_1005Metric//C25077" ])
+            self.assertEqual(bom["split"], [ { "line": "12kΩ//R_0402_1005Metric//C25752",
+                                                "into": { "12kΩ//R_0402_1005Metric//C25752": [ "R2", "R219" ],
+                                                            "10kΩ//R_0402_1005Metric//C25744": [ "R1" ] } } ])
+            self.assertEqual([ (m["line"], sorted(m["from"])) for m in bom["merged"] ],
+                                [ ("1MΩ//R_0402_1005Metric//C26083", [ "10Ω//R_0402_1005Metric//C25077",
+                                                                        "1MΩ//R_0402_1005Metric//C26083" ]) ])
+            self.assertEqual(report["summary"]["unchanged"], 108 - 5)
+
+        def test_service(self):
+            service = ConversionService("rotations.cf", workers=1, queue=0, timeout=30)
+            server = service_server(service)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            url = "http://127.0.0.1:%d" % server.server_address[1]
+
+            def post(payload):
+                request = urllib.request.Request(url + "/convert", data=json.dumps(payload).encode(), method="POST")
+                try:
+                    with urllib.request.urlopen(request) as response:
+                        return response.status, json.loads(response.read())
+                except urllib.error.HTTPError as e:
+                    return e.code, json.loads(e.read())
+
+            try:
+                # A path, and the same board sent as the file contents, give the same outputs
+                status, by_path = post({ "path": os.path.abspath("sample") })
+                self.assertEqual((status, by_path["components"]), (200, 109))
+                with open(os.path.join("sample", "board.csv")) as bfile, open(os.path.join("sample", "components.csv")) as cfile:
+                    status, by_content = post({ "board": bfile.read(), "components": cfile.read() })
+                self.assertEqual(by_content, by_path)
+
+                self.assertEqual(post({ "path": "/no/such/board" })[0], 422)
+                self.assertEqual(post({ "nothing": 1 })[0], 400)
+
+                # With the one slot taken, the next request is turned away
+                service.in_flight += 1
+                self.assertEqual(post({ "path": "sample" })[0], 503)
+                service.in_flight -= 1
+
+                with urllib.request.urlopen(url + "/metrics") as response:
+                    metrics = json.loads(response.read())
+                self.assertEqual((metrics["requests"], metrics["ok"], metrics["errors"], metrics["rejected"]), (5, 2, 2, 1))
+                self.assertEqual((metrics["in_flight"], metrics["queue_depth"], metrics["latency_ms"]["count"]), (0, 0, 2))
+                self.assertLessEqual(metrics["latency_ms"]["p50"], metrics["latency_ms"]["max"])
+            finally:
+                server.shutdown()
+                server.server_close()
+                service.close()
+
+        def test_service_timeout(self):
+            service = ConversionService("rotations.cf", workers=1, queue=1, timeout=1.0, job=slow_service_worker)
+            try:
+                stuck = service.idle[0]
+                start = time.perf_counter()
+                self.assertEqual(service.convert({ "path": "sample", "sleep": 30 })[0], 504)
+                self.assertLess(time.perf_counter() - start, 5)
+
+                # The stuck worker is gone and its replacement takes the next request
+                self.assertFalse(stuck.process.is_alive())
+                status, result = service.convert({ "path": "sample" })
+                self.assertEqual((status, result["components"]), (200, 109))
+                metrics = service.metrics()
+                self.assertEqual((metrics["timeouts"], metrics["ok"], metrics["in_flight"]), (1, 1, 0))
+            finally:
+                service.close()
+
+        def test_headless(self):
+            # Run in a fresh interpreter so nothing else has imported the visualisation stack
+            here = os.path.dirname(os.path.abspath(__file__))
+            script = ("import sys, process_files\n"
+                      "process_files.main(['--no-viz', sys.argv[1]])\n"
+                      "assert 'bokeh' not in sys.modules and 'pandas' not in sys.modules\n")
+            with tempfile.TemporaryDirectory() as tmpdir:
+                shutil.copy(os.path.join(here, "rotations.cf"), tmpdir)
+                subprocess.run([sys.executable, "-c", script, os.path.join(here, "sample")],
+                                cwd=tmpdir, check=True, env=dict(os.environ, PYTHONPATH=here))
+                self.assertTrue(os.path.isfile(os.path.join(tmpdir, "out_bom.csv")))
+                self.assertTrue(os.path.isfile(os.path.join(tmpdir, "out_cpl.csv")))
+
+# --------------------------------------------------------------------------------------
+# MAIN
+# --------------------------------------------------------------------------------------
+
+def main(argv=None):
+    # First process the command line argument...
+    # (1) command [options] <path_to_input_file_dir>
+    # (2) command -T [any other test arguments]
+    if (argv is None):
+        argv = sys.argv[1:]
+
+    if (len(argv) < 1):
+        print ("Usage: " + sys.argv[0] + " <-T [test_args] | [--no-viz] path_to_input_file_dir>")
+        sys.exit(1)
+
+    # Kick off the unit tests...
+    if (argv[0] == "-T"):
+        unittest.main(argv=[sys.argv[0]] + argv[1:])     # -T confuses unittest!
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Produce JLCPCB BOM and CPL files from KiCad exports")
+    parser.add_argument("path", nargs="*", help="directory containing board.csv and components.csv, "
+                                        "or a .kicad_pcb file (several, or a glob, for batch mode)")
+    parser.add_argument("--no-viz", "--headless", dest="viz", action="store_false",
+                        help="only write the BOM/CPL, never import or run the visualisation stack")
+    parser.add_argument("-o", "--output-dir", default=".",
+                        help="where to write the outputs (in batch mode, a directory per board)")
+    parser.add_argument("-r", "--rotations", default="rotations.cf", help="the rotations database")
+    parser.add_argument("--batch", action="store_true",
+                        help="process every board given in a pool of worker processes (no visualisation)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of batch worker processes (default: one per CPU)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="reuse the results of the last run for anything that hasn't changed")
+    parser.add_argument("--outline-tolerance", type=float, default=OUTLINE_TOLERANCE, metavar="MM",
+                        help="maximum error of the simplified board outline in the plot (default: %(default)s mm)")
+    parser.add_argument("--stream", action="store_true",
+                        help="write the CPL as the components are read, keeping only the BOM in memory "
+                                "(when there is no visualisation, --check or --catalogue)")
+    parser.add_argument("--panel", type=panel_size, default=None, metavar="ROWSxCOLS",
+                        help="step and repeat the board into a panel, e.g. 2x3")
+    parser.add_argument("--pitch", type=mm_pair, default=None, metavar="X,Y",
+                        help="distance in mm between the boards of the panel (default: the board size)")
+    parser.add_argument("--rails", type=mm_pair, default=(0.0, 0.0), metavar="X,Y",
+                        help="width in mm of the panel rails on each side (default: none)")
+    parser.add_argument("--panel-rotation", type=angle_list, default=None, metavar="DEG[,DEG...]",
+                        help="rotation of the boards in the panel, one for all or one per board row by row")
+    parser.add_argument("--order", type=float, nargs="?", const=ORDER_TIME, default=None, metavar="SECONDS",
+                        help="write the CPL in pick and place order (by layer and BOM line, with the shortest "
+                                "tour found in SECONDS, default %s)" % ORDER_TIME)
+    parser.add_argument("--check", action="store_true",
+                        help="report overlapping courtyards and parts off (or overhanging) the board")
+    parser.add_argument("--catalogue", metavar="PARTS.db", default=None,
+                        help="check the LCSC numbers in the BOM against an imported parts catalogue")
+    parser.add_argument("--import-catalogue", metavar="PARTS.csv", default=None,
+                        help="import a JLCPCB parts CSV into the --catalogue database and exit")
+    parser.add_argument("--report", metavar="FILE.html", default=None,
+                        help="save the visualisation to a standalone HTML file rather than opening a browser")
+    parser.add_argument("--density-threshold", type=int, default=DENSITY_THRESHOLD, metavar="N",
+                        help="draw boards with more than N components as a heatmap (default: %(default)s)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, rebuilding the outputs whenever the inputs change")
+    parser.add_argument("--port", type=int, default=5006,
+                        help="port for the visualisation served in watch mode (default: 5006)")
+    parser.add_argument("--diff", metavar="OLD", default=None,
+                        help="compare the board in path against an older revision OLD, writing out_diff.json")
+    parser.add_argument("--diff-position", type=float, default=DIFF_POSITION_TOLERANCE, metavar="MM",
+                        help="how far a part must move to count as moved (default: %(default)s mm)")
+    parser.add_argument("--diff-rotation", type=float, default=DIFF_ROTATION_TOLERANCE, metavar="DEG",
+                        help="how far a part must turn to count as rotated (default: %(default)s degrees)")
+    parser.add_argument("--service", type=int, default=None, metavar="PORT",
+                        help="run a local HTTP conversion service on PORT (with -j worker processes)")
+    parser.add_argument("--host", default="127.0.0.1", help="address for the service (default: 127.0.0.1)")
+    parser.add_argument("--queue", type=int, default=None,
+                        help="requests the service will hold waiting for a worker (default: one per worker)")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="seconds the service waits for each conversion (default: 30)")
+    parser.add_argument("--profile", metavar="REPORT.json", default=None,
+                        help="time each phase (and component draw/rotation lookup) and write a JSON report")
+    parser.add_argument("--profile-top", type=int, default=10,
+                        help="how many of the slowest components/footprints to report (default: 10)")
+    parser.add_argument("--profile-cprofile", action="store_true", help="include cProfile data in the profile")
+    parser.add_argument("--profile-memory", action="store_true", help="include tracemalloc data in the profile")
+    args = parser.parse_args(argv)
+
+    if (args.import_catalogue):
+        if (not args.catalogue):
+            parser.error("--import-catalogue needs --catalogue to say where to write it")
+        try:
+            count = import_catalogue(args.import_catalogue, args.catalogue)
+        except InvalidData as e:
+            print ("Error: " + e.args[-1])
+            sys.exit(1)
+        print ("Imported %d parts into %s" % (count, args.catalogue))
+        return
+
+    if (args.service is not None):
+        run_service(args.rotations, args.host, args.service, args.workers, args.queue, args.timeout)
+        return
+
+    if (not args.path):
+        parser.error("a board path is needed")
+    if (args.panel and (args.stream or args.incremental or args.batch or args.watch or args.diff)):
+        parser.error("--panel can't be used with --stream, --incremental, --batch, --watch or --diff")
+    if (args.order is not None and (args.stream or args.incremental or args.batch or args.watch)):
+        parser.error("--order can't be used with --stream, --incremental, --batch or --watch")
+    if (args.report and not args.viz):
+        parser.error("--report needs the visualisation, so can't be used with --no-viz")
+
+    paths = expand_inputs(args.path)
+
+    #
+    # Many boards (or --batch) fan out across a process pool...
+    #
+    if (args.batch or len(paths) > 1):
+        results = run_batch(paths, args.output_dir, args.rotations, args.workers, args.incremental,
+                                args.stream)
+        sys.exit(1 if any("error" in r for r in results) else 0)
+
+    if (not paths):
+        print ("Error: nothing matches " + " ".join(args.path))
+        sys.exit(1)
+
+    # Otherwise we are running against the input dir (or board file)...
+    file_path = paths[0]
+
+    if (args.diff):
+        try:
+            run_diff(args.diff, file_path, args.output_dir, RotDB(args.rotations), args.diff_position,
+                        args.diff_rotation, args.viz, args.report, args.outline_tolerance)
+        except InvalidData as e:
+            print ("Error: " + e.args[-1])
+            sys.exit(1)
+        return
+
+    if (args.watch):
+        watch(file_path, args.output_dir, args.rotations, port=args.port if (args.viz) else None,
+                tolerance=args.outline_tolerance)
+        return
+
+    profiler = NULL_PROFILER
+    if (args.profile):
+        profiler = Profiler(cprofile=args.profile_cprofile, memory=args.profile_memory)
+
+    #
+    # Create the rotations database object...
+    #
+    with profiler.phase("rotdb load"):
+        rotdb = RotDB(args.rotations)
+    rotdb.possible_rotate = profiler.timed("RotDB.possible_rotate", rotdb.possible_rotate,
+                                            key=lambda footprint: footprint)
+
+    try:
+        run(args, file_path, rotdb, profiler)
+    finally:
+        if (profiler.enabled):
+            profiler.stop()
+            report = profiler.report(args.profile_top, rotdb)
+            with open(args.profile, "w") as fh:
+                json.dump(report, fh, indent=2)
+            print (profiler.summary(report))
+
+def run(args, file_path, rotdb, profiler):
+    """
+    Process a single board as per the command line arguments.
+    """
+    #
+    # Now create the Board object, and the components on it, and output the BOM
+    # and placement information...
+    #
+    rerender = True
+    try:
+        if (args.stream and not (args.viz or args.check or args.catalogue)):
+            count = process_board_streaming(file_path, args.output_dir, rotdb, profiler=profiler)
+            print ("Streamed %d components" % count)
+            return
+        elif (args.panel):
+            board, table = process_panel(file_path, args.output_dir, rotdb, args.panel, args.pitch, args.rails,
+                                            args.panel_rotation, profiler=profiler, order=args.order)
+        elif (args.incremental):
+            with profiler.phase("incremental build"):
+                board, table, report = process_board_incremental(file_path, args.output_dir, rotdb,
+                                                    args.rotations,
+                                                    need_components=args.viz or args.check or args.catalogue,
+                                                    force=args.check or args.catalogue is not None)
+            print ("Incremental build: " + incremental_summary(report))
+            if (board is None):
+                return                  # nothing changed, and nothing else to do
+            rerender = not incremental_unchanged(report)     # the checks still run
+        else:
+            board, table = process_board(file_path, args.output_dir, rotdb, profiler=profiler, order=args.order)
+    except InvalidData as e:
+        print ("Error: " + e.args[-1])
+        sys.exit(1)
+
+    if (args.check):
+        with profiler.phase("design checks"):
+            print (check_summary(check_board(board, table)))
+
+    if (args.catalogue):
+        with profiler.phase("catalogue check"):
+            try:
+                catalogue = Catalogue(args.catalogue)
+            except InvalidData as e:
+                print ("Error: " + e.args[-1])
+                sys.exit(1)
+            print (catalogue_summary(check_bom(table.bom(), catalogue)))
+            catalogue.close()
+
+    #
+    # And only then worry about the visualisations...
+    #
+    if (args.viz and rerender):
+        visualise(board, table, profiler, args.outline_tolerance, args.report, args.density_threshold)
+
+
+if __name__ == '__main__':
+    main()